@@ -36,6 +36,7 @@ def build_queue_arg_parser(description):
     subparsers = parser.add_subparsers(title="sub-commands")
     retry_parser_desc = "set up 'dead' PagerDuty events for retry."
     status_parser_desc = "print out status of local event queue."
+    show_parser_desc = "print out events in local event queue."
 
     retry_parser = subparsers.add_parser(
         "retry",
@@ -64,6 +65,21 @@ def build_queue_arg_parser(description):
     )
     status_parser.set_defaults(func=_status)
 
+    show_parser = subparsers.add_parser(
+        "show",
+        description=show_parser_desc.capitalize(),  # printed as title
+        help=show_parser_desc  # printed in 'options' part of main cmd
+    )
+    show_parser.add_argument(
+        "-k", "--service-key", dest="service_key",
+        help="list only events in given Service API Key"
+    )
+    show_parser.add_argument(
+        "event_ids", nargs="*", metavar="EVENT_ID",
+        help="print given event (as listed without any EVENT_ID)"
+    )
+    show_parser.set_defaults(func=_show)
+
     return parser
 
 
@@ -88,13 +104,17 @@ def _retry(agent_config, parser, args):
 
 def _status(agent_config, _, args):
     # prints queue snapshot stats in this format:
-    # Service Key                           Pending   Success  In Error
-    # =================================================================
-    # key1                                        1         0         0
-    # key2                                        1         0         1
+    # Service Key                           Pending   Success  In Error Throttled
+    # ===========================================================================
+    # key1                                        1         0         0         0
+    # key2                                        1         0         1         1
+    # Expired events (total): 3
+    # Rejected service key key3: events fail without sending for 1800 more
+    # secs (or until 'retry').
+    # Disk usage: 40960 of 1048576 bytes, 12 of 1000 entries.
+    # Compression: 120 requests, 245760 to 40960 bytes (ratio 6.0) in 0.052
+    # CPU secs.
 
-    from pdagent.thirdparty.six import iteritems
-    from pdagent.thirdparty.six.moves import zip_longest
     from pdagent.pdagentutil import get_stats
 
     status = get_stats(
@@ -107,26 +127,106 @@ def _status(agent_config, _, args):
         print("Nothing to report.")
     else:
         # left-aligned service key, right-aligned counts.
-        flags = ["-", "", "", "", ""]
         widths = [35, 10, 10, 10, 10]
-        types = ["s", "s", "s", "s", "s"]
-        column_fmts = [
-            "%" + "".join(e)
-            for e in zip_longest(flags, map(str, widths), types)
-        ]
-        fmt = "".join(column_fmts)
-        print(fmt % ("Service Key", "Pending", "Success", "In Error"))
+        fmt = "%%-%ds" % widths[0] + "".join("%%%ds" % w for w in widths[1:])
+        print(fmt % (
+            "Service Key", "Pending", "Success", "In Error", "Throttled"
+        ))
         print("=" * sum(widths))
         empty_dict = dict()
-        for (svc_key, state) in sorted(iteritems(snapshot)):
+        for (svc_key, state) in sorted(snapshot.items()):
             print(fmt % (
                 svc_key,
                 state.get("pending_events", empty_dict).get("count", 0),
                 state.get("succeeded_events", empty_dict).get("count", 0),
-                state.get("failed_events", empty_dict).get("count", 0)
+                state.get("failed_events", empty_dict).get("count", 0),
                 (1 if state.get("throttled", False) else 0)
             ))
 
+    # events removed from the queue without being sent, if any.
+    aggregate = status.get("aggregate", dict())
+    for (counter, label) in [
+            ("expired_events_count", "Expired"),
+            ("compacted_events_count", "Compacted"),
+            ]:
+        if aggregate.get(counter):
+            print("%s events (total): %d" % (label, aggregate[counter]))
+
+    # service keys rejected by PagerDuty, whose events fail without sending.
+    for (svc_key, secs) in sorted(
+            status.get("rejected_service_keys", dict()).items()
+            ):
+        print(
+            "Rejected service key %s: events fail without sending for "
+            "%d more secs (or until 'retry')." % (svc_key, secs)
+            )
+
+    # disk usage against the quota, if there is one.
+    usage = status.get("usage")
+    if usage:
+        main_config = agent_config.get_main_config()
+        print(
+            "Disk usage: %d of %s bytes, %d of %s entries." % (
+                usage["bytes"], main_config["quota_max_bytes"] or "unlimited",
+                usage["entries"],
+                main_config["quota_max_entries"] or "unlimited"
+            ))
+
+    # request compression by the agent since it started, if any.
+    compression = status.get("compression")
+    if compression:
+        print(
+            "Compression: %d requests, %d to %d bytes (ratio %s) in %s "
+            "CPU secs." % (
+                compression["compressed_requests_count"],
+                compression["uncompressed_bytes"],
+                compression["compressed_bytes"],
+                compression["compression_ratio"],
+                compression["compression_secs"]
+            ))
+
+
+def _show(agent_config, _, args):
+    # without event ids, lists events (including archived events) like this:
+    # Event ID                                              State
+    # ===========================================================
+    # 1394151584121098_key1.txt                      Success (packed)
+    # 1394151590234165_key2.txt                             Pending
+    # with event ids, prints those events as they were queued.
+
+    import sys
+    from pdagent.pdagentutil import get_event, get_events
+
+    queue = agent_config.get_queue()
+    labels = {"pdq": "Pending", "suc": "Success", "err": "In Error"}
+
+    if not args.event_ids:
+        events = get_events(queue, args.service_key)  # 'None' for all-keys.
+        if not events:
+            print("Nothing to report.")
+            return
+        widths = [45, 20]
+        fmt = "%%-%ds%%%ds" % tuple(widths)
+        print(fmt % ("Event ID", "State"))
+        print("=" * sum(widths))
+        for (event_id, state, packed) in events:
+            print(fmt % (
+                event_id, labels[state] + (" (packed)" if packed else "")
+            ))
+        return
+
+    missing = False
+    for event_id in args.event_ids:
+        event = get_event(queue, event_id)
+        if event is None:
+            sys.stderr.write("Event %s not found.\n" % event_id)
+            missing = True
+        else:
+            # (events are not always valid UTF-8.)
+            print(event[1].decode("utf-8", "replace"))
+    if missing:
+        sys.exit(1)
+
 
 def main():
     from pdagent.config import load_agent_config
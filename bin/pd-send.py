@@ -28,19 +28,27 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+_EVENT_TYPES = ["trigger", "acknowledge", "resolve"]
+
+# event fields that can be given in a batch record, other than "details".
+_BATCH_FIELDS = [
+    "service_key", "event_type", "incident_key", "description", "client",
+    "client_url",
+    ]
+
 
 def build_queue_arg_parser(description):
     from pdagent.thirdparty.argparse import ArgumentParser
 
     parser = ArgumentParser(description=description)
     parser.add_argument(
-        "-k", "--service-key", dest="service_key", required=True,
-        help="Service API Key"
+        "-k", "--service-key", dest="service_key",
+        help="Service API Key (required unless --batch is used)"
         )
     parser.add_argument(
-        "-t", "--event-type", dest="event_type", required=True,
-        choices=["trigger", "acknowledge", "resolve"],
-        help="Event type"
+        "-t", "--event-type", dest="event_type",
+        choices=_EVENT_TYPES,
+        help="Event type (required unless --batch is used)"
         )
     parser.add_argument(
         "-d", "--description", dest="description",
@@ -62,6 +70,12 @@ def build_queue_arg_parser(description):
         "-f", "--field", action="append", dest="fields",
         help="Add given KEY=VALUE pair to the event details"
         )
+    parser.add_argument(
+        "-b", "--batch", action="store_true", dest="batch",
+        help="Queue up one event per line of standard input. Lines are JSON " +
+            "objects or KEY=VALUE pairs (use details.KEY=VALUE for event " +
+            "details.) Other options given act as defaults for every line."
+        )
     parser.add_argument(
         "-q", "--quiet", action="store_true", dest="quiet",
         help="Operate quietly (no output)"
@@ -75,43 +89,203 @@ def parse_fields(fields):
     return dict(f.split("=", 1) for f in fields)
 
 
+def parse_batch_line(line):
+    # returns a dict of the event fields given in a line of batch input, with
+    # the event details as a dict under "details". Lines look like:
+    # {"service_key": "abc", "event_type": "trigger", "description": "Foo"}
+    # service_key=abc event_type=trigger description="Foo" details.host=bar
+    # Raises ValueError if the line cannot be parsed.
+    if line.startswith("{"):
+        import json
+        from pdagent.thirdparty.six import string_types
+        record = json.loads(line)
+        if not isinstance(record, dict):
+            raise ValueError("Expected a JSON object")
+        details = record.pop("details", None) or {}
+        if not isinstance(details, dict):
+            raise ValueError("Expected a JSON object for details")
+        for key in sorted(record):
+            value = record[key]
+            if value is not None and not isinstance(value, string_types):
+                raise ValueError("Expected a string for %s" % key)
+    else:
+        import shlex
+        record = {}
+        details = {}
+        for token in shlex.split(line):
+            if "=" not in token:
+                raise ValueError("Expected KEY=VALUE, got: %s" % token)
+            key, value = token.split("=", 1)
+            if key.startswith("details."):
+                details[key[len("details."):]] = value
+            else:
+                record[key] = value
+    unknown = sorted(k for k in record if k not in _BATCH_FIELDS)
+    if unknown:
+        raise ValueError("Unknown field(s): %s" % ", ".join(unknown))
+    record["details"] = details
+    return record
+
+
+def check_event_args(service_key, event_type, incident_key, description):
+    # returns an error message if the given event arguments are not valid.
+    from pdagent.pdagentutil import get_event_error
+
+    if not service_key:
+        return "Service key is required"
+    if event_type not in _EVENT_TYPES:
+        return "Event type must be one of: %s" % ", ".join(_EVENT_TYPES)
+    return get_event_error(event_type, incident_key, description)
+
+
+# exit code when the queue is full (EX_TEMPFAIL), so that callers can retry.
+QUEUE_FULL_EXIT_CODE = 75
+
+
+def print_problems(problems, enqueuer):
+    from pdagent.constants import EnqueueWarnings
+
+    for problem in problems:
+        if problem == EnqueueWarnings.UMASK_TOO_RESTRICTIVE:
+            print(
+                "WARNING: Current umask too restrictive. " +
+                "Using default umask (%03o)." % enqueuer.default_umask
+                )
+            print(
+                "(For umask requirements, please refer: %s)" %
+                "https://www.pagerduty.com/docs/guides/agent-install-guide/"
+                )
+        elif problem == EnqueueWarnings.DUPLICATE_EVENT:
+            print(
+                "NOTE: Identical event queued in the last %d secs. " %
+                enqueuer.dedup_window_secs +
+                "Not queued again."
+                )
+
+
+def queue_batch(agent_config, args, lines):
+    # queues up an event for every non-empty line, and returns a tuple of the
+    # number of lines, the number of lines that could not be queued, and
+    # whether the queue was full (in which case the remaining lines are not
+    # queued.)
+    import sys
+    from pdagent.pdagentutil import queue_event
+    from pdagent.pdqueue import QueueFullError
+
+    enqueuer = agent_config.get_enqueuer()
+    agent_id = agent_config.get_agent_id()
+    defaults = {
+        "service_key": args.service_key,
+        "event_type": args.event_type,
+        "incident_key": args.incident_key,
+        "description": args.description,
+        "client": args.client,
+        "client_url": args.client_url,
+        }
+    default_details = parse_fields(args.fields)
+
+    all_problems = set()
+    count = 0
+    errors = 0
+    queue_full = False
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        count += 1
+        try:
+            record = parse_batch_line(line)
+            event = dict(defaults)
+            event.update(record)
+            event["details"] = dict(default_details)
+            event["details"].update(record["details"])
+            error = check_event_args(
+                event["service_key"], event["event_type"],
+                event["incident_key"], event["description"]
+                )
+            if error:
+                raise ValueError(error)
+            incident_key, problems = queue_event(
+                enqueuer,
+                event["event_type"], event["service_key"],
+                event["incident_key"], event["description"],
+                event["client"], event["client_url"], event["details"],
+                agent_id, "pd-send",
+                )
+        except QueueFullError as e:
+            errors += 1
+            queue_full = True
+            sys.stderr.write("Line %d: ERROR: %s\n" % (line_number, e))
+            break
+        except (ValueError, IOError, OSError) as e:
+            errors += 1
+            sys.stderr.write("Line %d: ERROR: %s\n" % (line_number, e))
+        else:
+            all_problems.update(problems)
+            if not args.quiet:
+                print(
+                    "Line %d: Event processed. Incident Key: %s" %
+                    (line_number, incident_key)
+                    )
+
+    if not args.quiet:
+        print_problems(sorted(all_problems), enqueuer)
+    return count, errors, queue_full
+
+
 def main():
+    import sys
+    import time
     from pdagent.pdagentutil import queue_event
     from pdagent.config import load_agent_config
-    from pdagent.constants import EnqueueWarnings
+    from pdagent.pdqueue import QueueFullError
 
+    start_time = time.time()
     description = "Queue up a trigger, acknowledge, or resolve event to PagerDuty."
     parser = build_queue_arg_parser(description)
     args = parser.parse_args()
+
+    if args.batch:
+        count, errors, queue_full = \
+            queue_batch(load_agent_config(), args, sys.stdin)
+        if not args.quiet:
+            print(
+                "Processed %d of %d event(s) in %.3f secs." %
+                (count - errors, count, time.time() - start_time)
+                )
+        if queue_full:
+            sys.exit(QUEUE_FULL_EXIT_CODE)
+        if errors:
+            sys.exit(1)
+        return
+
+    if not args.service_key:
+        parser.error("argument -k/--service-key is required")
+    if not args.event_type:
+        parser.error("argument -t/--event-type is required")
     details = parse_fields(args.fields)
 
-    if args.event_type == "trigger":
-        if (not args.description) or (not args.description.strip()):
-            parser.error("Event type '%s' requires description" % args.event_type)
-    else:
-        if not args.incident_key:
-            parser.error("Event type '%s' requires incident key" % args.event_type)
+    error = check_event_args(
+        args.service_key, args.event_type, args.incident_key, args.description
+        )
+    if error:
+        parser.error(error)
 
     agent_config = load_agent_config()
 
     enqueuer = agent_config.get_enqueuer()
-    incident_key, problems = queue_event(
-        enqueuer,
-        args.event_type, args.service_key, args.incident_key, args.description,
-        args.client, args.client_url, details,
-        agent_config.get_agent_id(), "pd-send",
-        )
+    try:
+        incident_key, problems = queue_event(
+            enqueuer,
+            args.event_type, args.service_key, args.incident_key,
+            args.description, args.client, args.client_url, details,
+            agent_config.get_agent_id(), "pd-send",
+            )
+    except QueueFullError as e:
+        sys.stderr.write("ERROR: %s Try again later.\n" % e)
+        sys.exit(QUEUE_FULL_EXIT_CODE)
     if not args.quiet:
-        for problem in problems:
-            if problem == EnqueueWarnings.UMASK_TOO_RESTRICTIVE:
-                print(
-                    "WARNING: Current umask too restrictive. " +
-                    "Using default umask (%03o)." % enqueuer.default_umask
-                    )
-                print(
-                    "(For umask requirements, please refer: %s)" %
-                    "https://www.pagerduty.com/docs/guides/agent-install-guide/"
-                    )
+        print_problems(problems, enqueuer)
         print("Event processed. Incident Key:", incident_key)
 
 
@@ -32,13 +32,13 @@
 #
 
 # standard python modules
+import errno
 import logging.handlers
 import os
 import platform
 import signal
 import socket
 import sys
-import time
 import uuid
 
 
@@ -114,11 +114,33 @@ def _ensure_writable_directories(make_missing_dir, directories):
     return problem_directories
 
 
+def _make_ram_queue_dirs(ram_queue_dir):
+    # the RAM queue directory is usually on a tmpfs, so its subdirectories
+    # are (re)made on every start, with the permissions of their counterparts
+    # in the queue directory.
+    from pdagent.pdqueue import RAM_QUEUE_SUBDIRS
+    for d in RAM_QUEUE_SUBDIRS:
+        ram_d = os.path.join(ram_queue_dir, d)
+        if not os.path.isdir(ram_d):
+            try:
+                os.makedirs(ram_d)
+                os.chmod(
+                    ram_d, os.stat(os.path.join(outqueue_dir, d)).st_mode
+                    )
+            except OSError:
+                pass  # handled in the directory checks.
+
+
 def _check_dirs():
-    from pdagent.pdqueue import QUEUE_SUBDIRS
+    from pdagent.pdqueue import QUEUE_SUBDIRS, RAM_QUEUE_SUBDIRS
     dirs_to_check = [pidfile_dir, log_dir, data_dir, outqueue_dir, db_dir]
     for d in QUEUE_SUBDIRS:
         dirs_to_check.append(os.path.join(outqueue_dir, d))
+    ram_queue_dir = main_config["ram_queue_dir"]
+    if ram_queue_dir:
+        _make_ram_queue_dirs(ram_queue_dir)
+        for d in RAM_QUEUE_SUBDIRS:
+            dirs_to_check.append(os.path.join(ram_queue_dir, d))
     problem_directories = _ensure_writable_directories(
         agent_config.is_dev_layout(),  # create directories in development
         dirs_to_check
@@ -148,7 +170,9 @@ pd_queue = agent_config.get_queue()
 # Import agent modules
 import pdagent
 from pdagent.thirdparty.daemon import daemonize
-from pdagent.pdthread import RepeatingTaskThread
+from pdagent.http import RequestCompressor
+from pdagent.pdthread import RepeatingTaskScheduler
+from pdagent.cleanup import CleanupTask
 from pdagent.heartbeat import HeartbeatTask
 from pdagent.sendevent import SendEventTask
 
@@ -158,10 +182,17 @@ from pdagent.sendevent import SendEventTask
 
 # Non-config globals
 stop_signal = False
+reload_signal = False
 main_logger = None
 agent_id = None
 system_stats = None
-task_threads = None
+# shared by the tasks so that compression totals cover all requests.
+request_compressor = RequestCompressor(
+    main_config['compress_min_bytes'], main_config['compress_level']
+    )
+# (read, write) ends of a pipe that wakes up the main thread when a signal
+# arrives or the task scheduler stops.
+wakeup_fds = None
 
 
 def _sig_term_handler(signum, frame):
@@ -171,18 +202,65 @@ def _sig_term_handler(signum, frame):
         stop_signal = True
 
 
+def _sig_hup_handler(signum, frame):
+    global reload_signal
+    reload_signal = True
+
+
+def _make_wakeup_fds():
+    global wakeup_fds
+    import fcntl
+    wakeup_fds = os.pipe()
+    # writes must not block signal handling if the pipe is full.
+    flags = fcntl.fcntl(wakeup_fds[1], fcntl.F_GETFL)
+    fcntl.fcntl(wakeup_fds[1], fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    signal.set_wakeup_fd(wakeup_fds[1])
+
+
+def _wake_main_thread():
+    try:
+        os.write(wakeup_fds[1], b'\0')
+    except OSError as e:
+        if e.errno != errno.EAGAIN:
+            raise
+
+
+def _wait_for_wakeup():
+    try:
+        os.read(wakeup_fds[0], 64)
+    except OSError as e:
+        # (Python 2 doesn't retry reads interrupted by a signal.)
+        if e.errno != errno.EINTR:
+            raise
+
+
+# runs all agent tasks.
+task_scheduler = RepeatingTaskScheduler(
+    main_config['task_workers'], exit_callback=_wake_main_thread
+    )
+
+
 def make_sendevent_task():
     # Send event thread config
     send_interval_secs = main_config['send_interval_secs']
-    cleanup_interval_secs = main_config['cleanup_interval_secs']
-    cleanup_threshold_secs = main_config['cleanup_threshold_secs']
     source_address = main_config['source_address']
     return SendEventTask(
         pd_queue,
         send_interval_secs,
-        cleanup_interval_secs,
-        cleanup_threshold_secs,
-        source_address
+        source_address,
+        request_compressor,
+        main_config['send_interval_min_secs'],
+        main_config['send_interval_max_secs']
+        )
+
+
+def make_cleanup_task():
+    return CleanupTask(
+        pd_queue,
+        main_config['cleanup_interval_secs'],
+        main_config['cleanup_threshold_secs'],
+        main_config['cleanup_slice_secs'],
+        main_config['cleanup_pause_secs']
         )
 
 
@@ -195,7 +273,9 @@ def make_heartbeat_task():
         agent_id,
         pd_queue,
         system_stats,
-        source_address
+        source_address,
+        request_compressor,
+        task_scheduler
         )
 
 
@@ -203,42 +283,76 @@ def make_agent_tasks():
     mk_tasks = [
         make_sendevent_task,
         make_heartbeat_task,
+        make_cleanup_task,
         ]
     return [mk_task() for mk_task in mk_tasks]
 
 
-def create_and_start_task_threads(tasks):
-    global task_threads
-    task_threads = []
-    for task in tasks:
-        try:
-            rtthread = RepeatingTaskThread(task)
-            rtthread.setDaemon(True)  # don't let thread block exit
-            rtthread.start()
-            task_threads.append(rtthread)
-        except:
-            main_logger.fatal(
-                "Error starting thread for task %s" % task.get_name(),
-                exc_info=True
+# reads the config file again, and passes the changed values that don't need
+# a restart on to the queue and the tasks.
+def reload_config(tasks):
+    main_logger.info("Reloading config file %s" % agent_config.conf_file)
+    try:
+        changes = agent_config.reload()
+    except pdagent.config.ConfigError as e:
+        main_logger.error("Not reloading config: %s" % e)
+        return
+    if not changes:
+        main_logger.info("Config is unchanged")
+        return
+    for key, (old, new) in sorted(changes.items()):
+        if key in pdagent.config.RELOADABLE_KEYS:
+            main_logger.info(
+                "Config %s changed from %r to %r" % (key, old, new)
                 )
-            return False
+        else:
+            main_logger.warning(
+                "Config %s changed from %r to %r; restart the agent to use it"
+                % (key, old, new)
+                )
+
+    try:
+        pd_queue.reconfigure_backoff(
+            main_config['backoff_interval_secs'],
+            main_config['retry_limit_for_possible_errors']
+            )
+        source_address = main_config['source_address']
+        for task in tasks:
+            if isinstance(task, SendEventTask):
+                task.reconfigure(
+                    main_config['send_interval_secs'],
+                    source_address,
+                    main_config['send_interval_min_secs'],
+                    main_config['send_interval_max_secs']
+                    )
+                task_scheduler.wake(task)
+            elif isinstance(task, HeartbeatTask):
+                task.set_source_address(source_address)
+    except:
+        main_logger.error("Error while reloading config:", exc_info=True)
+
+
+def start_tasks(tasks):
+    try:
+        for task in tasks:
+            task_scheduler.add_task(task)
+        task_scheduler.daemon = True  # don't let threads block exit
+        task_scheduler.start()
+    except:
+        main_logger.fatal("Error starting task scheduler", exc_info=True)
+        return False
     return True
 
 
-def stop_task_threads():
-    global task_threads
-    for rtthread in task_threads:
-        try:
-            rtthread.stop_and_join()
-        except:
-            main_logger.error(
-                "Error stopping thread %s:" % rtthread, exc_info=True
-                )
-    task_threads = None
+def stop_tasks():
+    try:
+        task_scheduler.stop_and_join()
+    except:
+        main_logger.error("Error stopping task scheduler:", exc_info=True)
 
 
 def run():
-    global main_logger, agent_id, system_stats
+    global main_logger, agent_id, system_stats, reload_signal
     pid = os.getpid()
     init_logging(log_dir)
     main_logger = logging.getLogger('main')
@@ -277,6 +391,9 @@ def run():
         # Configure SIGTERM handler
         main_logger.debug("Setting signal handler for SIGTERM")
         signal.signal(signal.SIGTERM, _sig_term_handler)
+        # Configure SIGHUP handler for config reloads
+        signal.signal(signal.SIGHUP, _sig_hup_handler)
+        _make_wakeup_fds()
 
         # Set default socket timeout
         default_socket_timeout = 10
@@ -285,9 +402,12 @@ def run():
             )
         socket.setdefaulttimeout(default_socket_timeout)
 
-        # Create tasks and task runner threads
+        # Queue again what was spilled from the RAM queue, if any
+        pd_queue.replay_spill()
+
+        # Create tasks and start running them
         tasks = make_agent_tasks()
-        all_ok = create_and_start_task_threads(tasks)
+        all_ok = start_tasks(tasks)
 
         # Sleep till it's time to exit
         if all_ok:
@@ -295,20 +415,25 @@ def run():
                 main_logger.info(
                     "Main thread idling till we need to stop!"
                     )
-                while all_ok and not stop_signal:
-                    time.sleep(1.0)
-                    for rtthread in task_threads:
-                        if not rtthread.is_alive():
-                            main_logger.fatal(
-                                "Thread %s is not alive!" % rtthread
-                                )
-                            all_ok = False
+                while not stop_signal:
+                    if reload_signal:
+                        reload_signal = False
+                        reload_config(tasks)
+                    if not task_scheduler.is_alive() or \
+                            task_scheduler.is_stop_invoked():
+                        main_logger.fatal("Task scheduler is not alive!")
+                        all_ok = False
+                        break
+                    _wait_for_wakeup()
             except:
                 main_logger.fatal("Error while sleeping", exc_info=True)
                 all_ok = False
 
-        # Stop task runner threads
-        stop_task_threads()
+        # Stop running tasks
+        stop_tasks()
+
+        # Keep pending events of the RAM queue, if any
+        pd_queue.spill()
 
     except SystemExit:
         all_ok = False
@@ -88,7 +88,9 @@ mkdir -p \
     data/var/lib/pdagent/outqueue/pdq \
     data/var/lib/pdagent/outqueue/tmp \
     data/var/lib/pdagent/outqueue/err \
-    data/var/lib/pdagent/outqueue/suc
+    data/var/lib/pdagent/outqueue/suc \
+    data/var/lib/pdagent/outqueue/dup \
+    data/var/lib/pdagent/outqueue/pack
 mkdir -p data/var/lib/pdagent/scripts
 # stage sysV & systemd service files for pkg postinst
 cp pdagent.init data/var/lib/pdagent/scripts/pdagent.init
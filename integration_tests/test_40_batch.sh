@@ -0,0 +1,64 @@
+#
+# Checks batch mode of pd-send.
+#
+# Copyright (c) 2013-2014, PagerDuty, Inc. <info@pagerduty.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the copyright holder nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+. $(dirname $0)/util.sh
+
+set -e
+set -x
+
+# stop agent and clear outqueue if required.
+test -z "$(agent_pid)" || stop_agent
+test -d $OUTQUEUE_DIR
+
+# pd-send must queue up one event per valid line of batch input.
+test_batch() {
+  sudo find $OUTQUEUE_DIR -type f -exec rm -f {} \;
+
+  printf '%s\n' \
+    '{"service_key":"key1","event_type":"trigger","description":"Test 1"}' \
+    '' \
+    'service_key=key1 event_type=resolve incident_key=test1 details.foo=bar' \
+    'event_type=trigger description="no service key"' \
+    | $BIN_PD_SEND --batch >/tmp/pd-send-batch.out 2>&1 && exit 1
+  grep -q '^Line 4: ERROR: ' /tmp/pd-send-batch.out
+  grep -q '^Processed 2 of 3 event(s)' /tmp/pd-send-batch.out
+
+  test $(sudo find $OUTQUEUE_DIR/pdq -type f | wc -l) -eq 2
+  sudo grep -q '"details":{"foo":"bar"}' \
+    $(sudo find $OUTQUEUE_DIR/pdq -type f | sort | tail -n1)
+
+  # options on the command line are defaults for every line.
+  echo 'event_type=trigger description="Test 2"' \
+    | $BIN_PD_SEND --batch -k key2 -q
+  test $(sudo find $OUTQUEUE_DIR/pdq -type f -name '*_key2.txt' | wc -l) -eq 1
+}
+
+test_batch
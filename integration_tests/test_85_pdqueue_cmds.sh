@@ -57,11 +57,11 @@ test_status() {
 
   stats=$(sudo $BIN_PD_QUEUE status | tail -n+3 | tr -s " " \
         | hexdump -e '"%_c"')
-  test "$stats" = 'key1 1 0 0\nkey2 1 0 1\nkey3 0 1 0\n'
+  test "$stats" = 'key1 1 0 0 0\nkey2 1 0 1 0\nkey3 0 1 0 0\n'
 
   stats=$(sudo $BIN_PD_QUEUE status -k key2 | tail -n+3 | tr -s " " \
         | hexdump -e '"%_c"')
-  test "$stats" = 'key2 1 0 1\n'
+  test "$stats" = 'key2 1 0 1 0\n'
 }
 
 # agent must flush out queue when it wakes up.
@@ -0,0 +1,143 @@
+#
+# Copyright (c) 2013-2014, PagerDuty, Inc. <info@pagerduty.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the copyright holder nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from contextlib import contextmanager
+import logging
+import platform
+import sys
+
+from pdagent.pdthread import RepeatingTask
+
+
+logger = logging.getLogger(__name__)
+
+
+# ioprio_set and ioprio_get system call numbers, by machine and pointer size
+# in bytes. The machine is the kernel's, so a 32-bit Python on a 64-bit
+# kernel (which uses other numbers) does not match any entry.
+_IOPRIO_SYSCALLS = {
+    ("x86_64", 8): (251, 252),
+    ("i386", 4): (289, 290),
+    ("i686", 4): (289, 290),
+    ("aarch64", 8): (30, 31),
+    }
+_IOPRIO_WHO_PROCESS = 1
+# lowest priority of the best-effort class, which unprivileged threads can
+# set and undo (unlike the idle class, or 'nice'.)
+_IOPRIO_LOWEST_BEST_EFFORT = (2 << 13) | 7
+
+
+class CleanupTask(RepeatingTask):
+
+    def __init__(
+            self,
+            pd_queue,
+            cleanup_interval_secs,
+            cleanup_threshold_secs,
+            slice_secs=0,
+            pause_secs=0
+            ):
+        RepeatingTask.__init__(self, cleanup_interval_secs, False)
+        self.pd_queue = pd_queue
+        self.cleanup_threshold_secs = cleanup_threshold_secs
+        self.slice_secs = slice_secs
+        self.pause_secs = pause_secs
+        self._io_priority = _low_io_priority  # to ease unit testing.
+
+    def tick(self):
+        # this runs alongside sending, which must not wait for the disk.
+        with self._io_priority():
+            # archive and clean up.
+            try:
+                self.pd_queue.pack()
+            except:
+                logger.error("Error while packing queue:", exc_info=True)
+            try:
+                stats = self.pd_queue.cleanup(
+                    self.cleanup_threshold_secs,
+                    self.slice_secs,
+                    self.pause_secs,
+                    self.is_stop_invoked
+                    )
+                logger.info(
+                    "Cleanup removed %d files and %d packs in %.3f secs" % (
+                        stats["removed_files_count"],
+                        stats["removed_packs_count"],
+                        stats["duration_secs"]
+                        )
+                    )
+            except:
+                logger.error("Error while cleaning up queue:", exc_info=True)
+
+
+@contextmanager
+def _low_io_priority():
+    # lowers the I/O priority of the calling thread, where supported, and
+    # restores it afterwards, as the thread may go on to run other tasks.
+    ioprio = _get_ioprio_syscalls()
+    orig_priority = ioprio[1]() if ioprio else -1
+    lowered = orig_priority >= 0 and \
+        ioprio[0](_IOPRIO_LOWEST_BEST_EFFORT) == 0
+    try:
+        yield
+    finally:
+        if lowered:
+            ioprio[0](orig_priority)
+
+
+_ioprio_syscalls = None
+
+
+def _get_ioprio_syscalls():
+    # returns (set, get) functions for the I/O priority of the calling
+    # thread, or None if not supported.
+    global _ioprio_syscalls
+    if _ioprio_syscalls is None:
+        _ioprio_syscalls = ()
+        if sys.platform.startswith("linux"):
+            try:
+                import ctypes
+                numbers = _IOPRIO_SYSCALLS[
+                    (platform.machine(), ctypes.sizeof(ctypes.c_void_p))
+                    ]
+                syscall = ctypes.CDLL(None).syscall
+                # (thread ID 0 means the calling thread.)
+                _ioprio_syscalls = (
+                    lambda priority: syscall(
+                        numbers[0], _IOPRIO_WHO_PROCESS, 0, priority
+                        ),
+                    lambda: syscall(numbers[1], _IOPRIO_WHO_PROCESS, 0)
+                    )
+            except KeyError:
+                logger.info(
+                    "Cannot change I/O priority on %s" % platform.machine()
+                    )
+            except (ImportError, OSError, AttributeError):
+                logger.info("Cannot change I/O priority", exc_info=True)
+    return _ioprio_syscalls or None
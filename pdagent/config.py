@@ -28,26 +28,121 @@
 #
 
 
+# pd-send runs this module on every event, so keep module-level imports to
+# the minimum needed for queueing an event. (See scripts/bench-startup.py)
+import json
 import os
+import re
 import sys
 import time
-import uuid
 
+import pdagent
 from pdagent.confdirs import getconfdirs
 from pdagent.thirdparty.filelock import FileLock
-from pdagent.thirdparty.six.moves import configparser
 
 
 _ENQUEUE_FILE_MODE = 0o644  # rw-r--r--
 _ENQUEUE_DEFAULT_UMASK = 0o022  # default umask for world-readability of files.
 
+# snapshot of parsed config, so that the config file need not be parsed again
+# until it changes. It is world-readable, like the config file itself.
+_CONFIG_SNAPSHOT_FILE_MODE = 0o644  # rw-r--r--
+
+# bump this when the config defaults or the parsing of config values change,
+# so that snapshots of the old parsed values are not used. (test_config checks
+# that the defaults don't change without it.)
+_CONFIG_SNAPSHOT_VERSION = 4
+
+# main config defaults.
+_MAIN_CONFIG_DEFAULTS = {
+    "flush_policy": "fifo",
+    "flush_max_events": "0",
+    "flush_max_secs": "0",
+    "compaction": "none",
+    "compaction_target": "suc",
+    "event_ttl_secs": "0",
+    "event_ttl_secs_by_service_key": "",
+    "dedup_window_secs": "0",
+    "dedup_max_entries": "10000",
+    "storm_max_triggers": "0",
+    "storm_window_secs": "60",
+    "rejected_key_ttl_secs": "0",
+    "incident_states_max_entries": "0",
+    "incident_states_ttl_secs": "86400",
+    "event_validation": "off",
+    "payload_cache_max_bytes": "0",
+    "prefetch_events": "0",
+    "compress_min_bytes": "0",
+    "compress_level": "6",
+    "pack_after_secs": "0",
+    "pack_max_events": "1000",
+    "success_policy": "keep",
+    "receipt_log_max_bytes": "1048576",
+    "quota_max_bytes": "0",
+    "quota_max_entries": "0",
+    "ram_queue_dir": "",
+    "ram_spill_secs": "5",
+    "head_checkpoint_events": "100",
+    "task_workers": "3",
+    "cleanup_slice_secs": "1",
+    "cleanup_pause_secs": "1",
+    "send_interval_min_secs": "0.5",
+    "send_interval_max_secs": "0",
+    }
+
+_CANONICAL_UUID_RE = re.compile(
+    "^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$"
+    )
+
+# main config values that a running agent can pick up on reload. Changes to
+# other values need a restart.
+RELOADABLE_KEYS = frozenset([
+    "backoff_interval_secs",
+    "retry_limit_for_possible_errors",
+    "send_interval_max_secs",
+    "send_interval_min_secs",
+    "send_interval_secs",
+    "source_address",
+    ])
+
+
+class ConfigError(Exception):
+    pass
+
 
 class AgentConfig:
 
-    def __init__(self, dev_layout, default_dirs, main_config):
+    def __init__(self, dev_layout, default_dirs, main_config, conf_file=None):
         self.dev_layout = dev_layout
         self.default_dirs = default_dirs
         self.main_config = main_config
+        self.conf_file = conf_file
+
+    def reload(self):
+        """
+        Reads the config file again, and updates the main config with the
+        changed values of RELOADABLE_KEYS.
+
+        Returns a dict of the changed values, as (old, new) tuples by key,
+        including values that need a restart, which are not updated. Raises
+        ConfigError if the config file is not valid, leaving the main config
+        as it is.
+        """
+        cfg = _parse_main_config(self.conf_file)
+        _store_config_snapshot(
+            self.conf_file, _get_snapshot_file(self.default_dirs), cfg
+            )
+        changes = {}
+        for key in set(cfg) | set(self.main_config):
+            old, new = self.main_config.get(key), cfg.get(key)
+            if old != new:
+                changes[key] = (old, new)
+        # all reloadable values are updated together, once they are valid.
+        self.main_config.update(
+            (key, new) for (key, (_, new)) in changes.items()
+            if key in RELOADABLE_KEYS
+            )
+        return changes
 
     def is_dev_layout(self):
         return self.dev_layout
@@ -72,7 +167,13 @@ class AgentConfig:
         fd = None
         try:
             fd = open(self.get_agent_id_file(), "r")
-            return str(uuid.UUID(fd.readline().strip()))
+            agent_id = fd.readline().strip()
+            if not _CANONICAL_UUID_RE.match(agent_id):
+                # importing uuid is slow, so only do it for the uncommon
+                # case of an id that isn't written the way pdagentd does.
+                import uuid
+                agent_id = str(uuid.UUID(agent_id))
+            return agent_id
         except (IOError, ValueError):
             return None
         finally:
@@ -86,7 +187,11 @@ class AgentConfig:
             queue_dir=self.default_dirs["outqueue_dir"],
             time_calc=time,
             enqueue_file_mode=_ENQUEUE_FILE_MODE,
-            default_umask=_ENQUEUE_DEFAULT_UMASK
+            default_umask=_ENQUEUE_DEFAULT_UMASK,
+            dedup_window_secs=self.main_config["dedup_window_secs"],
+            quota_max_bytes=self.main_config["quota_max_bytes"],
+            quota_max_entries=self.main_config["quota_max_entries"],
+            ram_queue_dir=self.main_config["ram_queue_dir"] or None
             )
 
     def get_queue(self):
@@ -97,6 +202,16 @@ class AgentConfig:
         retry_limit_for_possible_errors = \
             self.main_config["retry_limit_for_possible_errors"]
         counter_db = JsonStore("aggregates", self.default_dirs["db_dir"])
+        rejected_keys_db = \
+            JsonStore("rejected_keys", self.default_dirs["db_dir"])
+        incident_states_db = \
+            JsonStore("incident_states", self.default_dirs["db_dir"])
+        head_db = JsonStore("head", self.default_dirs["db_dir"])
+        compression_db = JsonStore("compression", self.default_dirs["db_dir"])
+        event_validator = None
+        if self.main_config["event_validation"] == "on":
+            from pdagent.pdagentutil import make_event_validator
+            event_validator = make_event_validator()
         return PDQueue(
             lock_class=FileLock,
             queue_dir=self.default_dirs["outqueue_dir"],
@@ -105,7 +220,41 @@ class AgentConfig:
             backoff_db=backoff_db,
             backoff_interval=backoff_interval,
             retry_limit_for_possible_errors=retry_limit_for_possible_errors,
-            counter_db=counter_db
+            counter_db=counter_db,
+            flush_policy=self.main_config["flush_policy"],
+            max_events_per_pass=self.main_config["flush_max_events"],
+            max_secs_per_pass=self.main_config["flush_max_secs"],
+            compaction=self.main_config["compaction"],
+            compaction_target=self.main_config["compaction_target"],
+            event_ttl_secs=self.main_config["event_ttl_secs"],
+            event_ttl_secs_by_service_key=
+                self.main_config["event_ttl_secs_by_service_key"],
+            dedup_window_secs=self.main_config["dedup_window_secs"],
+            dedup_max_entries=self.main_config["dedup_max_entries"],
+            storm_max_triggers=self.main_config["storm_max_triggers"],
+            storm_window_secs=self.main_config["storm_window_secs"],
+            rejected_keys_db=rejected_keys_db,
+            rejected_key_ttl_secs=self.main_config["rejected_key_ttl_secs"],
+            incident_states_db=incident_states_db,
+            incident_states_max_entries=
+                self.main_config["incident_states_max_entries"],
+            incident_states_ttl_secs=
+                self.main_config["incident_states_ttl_secs"],
+            event_validator=event_validator,
+            payload_cache_max_bytes=
+                self.main_config["payload_cache_max_bytes"],
+            prefetch_events=self.main_config["prefetch_events"],
+            pack_after_secs=self.main_config["pack_after_secs"],
+            pack_max_events=self.main_config["pack_max_events"],
+            success_policy=self.main_config["success_policy"],
+            receipt_log_max_bytes=self.main_config["receipt_log_max_bytes"],
+            quota_max_bytes=self.main_config["quota_max_bytes"],
+            quota_max_entries=self.main_config["quota_max_entries"],
+            ram_queue_dir=self.main_config["ram_queue_dir"] or None,
+            ram_spill_secs=self.main_config["ram_spill_secs"],
+            head_db=head_db,
+            head_checkpoint_events=self.main_config["head_checkpoint_events"],
+            compression_db=compression_db
             )
 
 
@@ -113,8 +262,10 @@ _agent_config = None
 
 
 def load_agent_config():
+    # loads the config once; use reload() on the result for later changes.
     global _agent_config
-    assert not _agent_config, "Cannot load config twice!"
+    if _agent_config:
+        return _agent_config
 
     # (Re)figure out if we're in dev or prod layout
     # Main script logic must match this!!!
@@ -133,24 +284,42 @@ def load_agent_config():
             % conf_file
             )
 
-    # Main config defaults
-    cfg = dict()
+    snapshot_file = _get_snapshot_file(default_dirs)
+    cfg = _load_config_snapshot(conf_file, snapshot_file)
+    if cfg is None:
+        try:
+            cfg = _parse_main_config(conf_file)
+        except ConfigError as e:
+            print(e)
+            print('Agent will now quit')
+            sys.exit(1)
+        _store_config_snapshot(conf_file, snapshot_file, cfg)
+
+    _agent_config = AgentConfig(dev_layout, default_dirs, cfg, conf_file)
+
+    return _agent_config
+
+
+def _get_snapshot_file(default_dirs):
+    return os.path.join(default_dirs["data_dir"], "config_snapshot.json")
+
+
+# raises ConfigError if the config file is not valid.
+def _parse_main_config(conf_file):
+    from pdagent.thirdparty.six.moves import configparser
+
+    cfg = dict(_MAIN_CONFIG_DEFAULTS)
 
     # Load config file
     try:
         config = configparser.SafeConfigParser()
         config.read(conf_file)
     except configparser.Error as e:
-        raise SystemExit(
-            "Error loading config: %s\nAgent will now quit"
-            % e.message
-            )
+        raise ConfigError("Error loading config: %s" % e)
 
     # Convert Main section into dictionary entries
     if not config.has_section("Main"):
-        raise SystemExit(
-            "Config is missing [Main] section\nAgent will now quit"
-            )
+        raise ConfigError("Config is missing [Main] section")
     for option in config.options("Main"):
         cfg[option] = config.get("Main", option)
 
@@ -158,17 +327,161 @@ def load_agent_config():
     for key in [
             "backoff_interval_secs",
             "cleanup_interval_secs",
+            "cleanup_pause_secs",
+            "cleanup_slice_secs",
             "cleanup_threshold_secs",
+            "compress_level",
+            "compress_min_bytes",
+            "dedup_max_entries",
+            "dedup_window_secs",
+            "event_ttl_secs",
+            "flush_max_events",
+            "flush_max_secs",
+            "head_checkpoint_events",
+            "incident_states_max_entries",
+            "incident_states_ttl_secs",
+            "pack_after_secs",
+            "pack_max_events",
+            "payload_cache_max_bytes",
+            "prefetch_events",
+            "quota_max_bytes",
+            "quota_max_entries",
+            "ram_spill_secs",
+            "receipt_log_max_bytes",
+            "rejected_key_ttl_secs",
             "retry_limit_for_possible_errors",
             "send_interval_secs",
+            "storm_max_triggers",
+            "storm_window_secs",
+            "task_workers",
             ]:
         try:
             cfg[key] = int(cfg[key])
         except ValueError:
-            print('Bad %s in config file: %s' % (key, conf_file))
-            print('Agent will now quit')
-            sys.exit(1)
+            raise ConfigError(
+                'Bad %s in config file: %s' % (key, conf_file)
+                )
 
-    _agent_config = AgentConfig(dev_layout, default_dirs, cfg)
+    # parse decimal values.
+    for key in [
+            "send_interval_max_secs",
+            "send_interval_min_secs",
+            ]:
+        try:
+            cfg[key] = float(cfg[key])
+        except ValueError:
+            raise ConfigError(
+                'Bad %s in config file: %s' % (key, conf_file)
+                )
 
-    return _agent_config
+    # parse per-service-key values, given as comma-separated key=value pairs.
+    for key in [
+            "event_ttl_secs_by_service_key",
+            ]:
+        try:
+            cfg[key] = dict(
+                (svc_key.strip(), int(value))
+                for (svc_key, value) in (
+                    item.split("=", 1)
+                    for item in cfg[key].split(",") if item.strip()
+                    )
+                )
+        except ValueError:
+            raise ConfigError(
+                'Bad %s in config file: %s' % (key, conf_file)
+                )
+
+    # check values that must be one of a set of choices.
+    from pdagent.constants import COMPACTION_MODES, FLUSH_POLICIES, \
+        SUCCESS_POLICIES
+    for key, choices in [
+            ("flush_policy", FLUSH_POLICIES),
+            ("compaction", COMPACTION_MODES),
+            ("compaction_target", ["suc", "err"]),
+            ("event_validation", ["on", "off"]),
+            ("success_policy", SUCCESS_POLICIES),
+            ("compress_level", list(range(1, 10))),
+            ]:
+        if cfg[key] not in choices:
+            raise ConfigError(
+                'Bad %s in config file: %s\nMust be one of: %s' % (
+                    key, conf_file, ", ".join(str(c) for c in choices)
+                    )
+                )
+
+    # check values that must be at least 1.
+    for key in [
+            "task_workers",
+            ]:
+        if cfg[key] < 1:
+            raise ConfigError(
+                'Bad %s in config file: %s\nMust be at least 1' %
+                (key, conf_file)
+                )
+
+    # the send interval adapts between its min and max, which is never less
+    # than send_interval_secs.
+    if cfg["send_interval_max_secs"] < cfg["send_interval_secs"]:
+        cfg["send_interval_max_secs"] = float(cfg["send_interval_secs"])
+    if not 0 < cfg["send_interval_min_secs"] <= \
+            cfg["send_interval_max_secs"]:
+        raise ConfigError(
+            'Bad send_interval_min_secs in config file: %s\n'
+            'Must be more than 0, and at most send_interval_max_secs' %
+            conf_file
+            )
+
+    return cfg
+
+
+def _config_file_signature(conf_file):
+    # the snapshot is valid only for the same config file contents (going by
+    # its modification time and size), and the same agent version and
+    # snapshot version.
+    st = os.stat(conf_file)
+    return {
+        "agent_version": pdagent.__version__,
+        "conf_file": conf_file,
+        "mtime": st.st_mtime,
+        "size": st.st_size,
+        "version": _CONFIG_SNAPSHOT_VERSION,
+        }
+
+
+def _load_config_snapshot(conf_file, snapshot_file):
+    # returns the main config in the snapshot if it is still valid, else None.
+    try:
+        with open(snapshot_file) as f:
+            snapshot = json.load(f)
+        if snapshot.get("signature") == _config_file_signature(conf_file):
+            return snapshot["main_config"]
+    except (IOError, OSError, ValueError, KeyError, AttributeError):
+        pass
+    return None
+
+
+def _store_config_snapshot(conf_file, snapshot_file, cfg):
+    # best-effort; only users that can write to the data directory (e.g. the
+    # agent itself) are able to refresh the snapshot.
+    tmp_file = "%s.%d" % (snapshot_file, os.getpid())
+    try:
+        snapshot = {
+            "signature": _config_file_signature(conf_file),
+            "main_config": cfg,
+            }
+        fd = os.open(
+            tmp_file,
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+            _CONFIG_SNAPSHOT_FILE_MODE
+            )
+        try:
+            os.fchmod(fd, _CONFIG_SNAPSHOT_FILE_MODE)
+            os.write(fd, json.dumps(snapshot, sort_keys=True).encode())
+        finally:
+            os.close(fd)
+        os.rename(tmp_file, snapshot_file)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
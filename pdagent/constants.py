@@ -38,10 +38,11 @@ ConsumeEvent = enum(
     'STOP_ALL',
     'BACKOFF_SVCKEY_BAD_ENTRY',
     'BACKOFF_SVCKEY_NOT_CONSUMED',
+    'BAD_SVCKEY',
 )
 
 # PDEnqueue warnings.
-EnqueueWarnings = enum('UMASK_TOO_RESTRICTIVE')
+EnqueueWarnings = enum('UMASK_TOO_RESTRICTIVE', 'DUPLICATE_EVENT')
 
 # PD event integration API.
 EVENTS_API_BASE = \
@@ -52,3 +53,26 @@ HEARTBEAT_URI = "https://api.pagerduty.com/agent/2014-03-14/heartbeat"
 
 # Maximum length of the description field (any longer and API will send 400)
 MAX_DESCRIPTION_LEN = 1024
+
+# Orders in which a flush can process queued events:
+# - fifo: enqueue order.
+# - round_robin: one event of every service key at a time, so that a large
+#     backlog in one service key does not hold up other service keys.
+# - priority: triggers, then acknowledges, then resolves, while events of the
+#     same incident are still processed in enqueue order.
+FLUSH_POLICIES = ["fifo", "round_robin", "priority"]
+
+# Ways to compact the queue before sending, by dropping events that are
+# superseded by a later resolve of the same incident:
+# - none: don't compact.
+# - keep_resolve: drop every event that is followed by a resolve, i.e. send
+#     only the last resolve.
+# - drop_resolved: like keep_resolve, but also drop the resolve if the
+#     incident was triggered in the queue, i.e. send nothing.
+COMPACTION_MODES = ["none", "keep_resolve", "drop_resolved"]
+
+# What happens to events once they are sent (or skipped as redundant):
+# - keep: move them to 'suc', where they are kept until cleanup.
+# - receipt: remove them, and append a receipt of each to a receipt log in
+#     the queue directory instead.
+SUCCESS_POLICIES = ["keep", "receipt"]
@@ -30,6 +30,7 @@
 
 import json
 import logging
+import threading
 import time
 
 import pdagent
@@ -56,18 +57,39 @@ class HeartbeatTask(RepeatingTask):
             pd_queue,
             system_info,
             source_address='0.0.0.0',
+            compressor=None,
+            task_scheduler=None
             ):
         RepeatingTask.__init__(self, heartbeat_interval_secs, True)
         self._agent_id = agent_id
         self._pd_queue = pd_queue
         self._system_info = system_info
+        self._task_scheduler = task_scheduler
         # The following variables exist to ease unit testing:
         self._source_address = source_address
+        self._compressor = compressor or http.RequestCompressor()
         self._urllib2 = http
         self._retry_gap_secs = RETRY_GAP_SECS
         self._heartbeat_max_retries = HEARTBEAT_MAX_RETRIES
+        # set_source_address() is called from outside the task runner;
+        # tick() picks up the new address before its next heartbeat.
+        self._pending_source_address = None
+        self._pending_source_address_lock = threading.Lock()
+
+    def set_source_address(self, source_address):
+        # takes effect at the start of the next tick().
+        with self._pending_source_address_lock:
+            self._pending_source_address = source_address
+
+    def _apply_pending_source_address(self):
+        with self._pending_source_address_lock:
+            source_address = self._pending_source_address
+            self._pending_source_address = None
+        if source_address:
+            self._source_address = source_address
 
     def tick(self):
+        self._apply_pending_source_address()
         try:
             logger.debug("Sending heartbeat")
             # max time is half an interval
@@ -128,6 +150,10 @@ class HeartbeatTask(RepeatingTask):
             }
         if self._system_info:
             hb_data["system_info"] = self._system_info
+        if self._compressor.min_bytes:
+            hb_data["compression_stats"] = self._compressor.get_stats()
+        if self._task_scheduler:
+            hb_data["task_stats"] = self._task_scheduler.get_stats()
         return hb_data
 
     def _heartbeat(self, heartbeat_data):
@@ -135,7 +161,7 @@ class HeartbeatTask(RepeatingTask):
         request = Request(HEARTBEAT_URI)
         request.add_header("Content-Type", "application/json")
         heartbeat_json_str = json.dumps(heartbeat_data).encode()
-        request.data = heartbeat_json_str
+        self._compressor.set_data(request, heartbeat_json_str)
         response = self._urllib2.urlopen(request,
             source_address=self._source_address)
         response_str = response.read()
@@ -51,7 +51,11 @@
 # Agreement.
 #
 
+import logging
 import ssl
+import threading
+import time
+import zlib
 
 from pdagent.pdagentutil import find_in_sys_path
 from pdagent.thirdparty.six.moves.http_client import HTTPSConnection
@@ -65,6 +69,8 @@ except ImportError:
     # From Python > 2.7.9, < 3.6.
     from ssl import PROTOCOL_TLSv1_2 as ssl_client_protocol
 
+logger = logging.getLogger(__name__)
+
 # Custom HTTPS handler primarily for allowing us to pass a `source_address`
 # through to `HTTPSConnection`
 class CustomHTTPSHandler(request.HTTPSHandler):
@@ -100,3 +106,53 @@ def _create_ssl_context():
     context.load_default_certs()
     return context
 
+
+class RequestCompressor(object):
+    # Sets request bodies, gzipping the ones that are at least min_bytes
+    # large (0 means never), and keeps totals for reporting.
+
+    def __init__(self, min_bytes=0, level=6):
+        self.min_bytes = min_bytes
+        self.level = level
+        self.requests_count = 0
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        self.compression_secs = 0.0
+        self._lock = threading.Lock()
+
+    def set_data(self, req, data):
+        if not self.min_bytes or len(data) < self.min_bytes:
+            req.data = data
+            return
+        start_time = time.time()
+        # wbits of 16 + MAX_WBITS makes zlib write a gzip header and trailer.
+        compressor = zlib.compressobj(
+            self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+        compressed = compressor.compress(data) + compressor.flush()
+        secs = time.time() - start_time
+        req.add_header("Content-Encoding", "gzip")
+        req.data = compressed
+        with self._lock:
+            self.requests_count += 1
+            self.uncompressed_bytes += len(data)
+            self.compressed_bytes += len(compressed)
+            self.compression_secs += secs
+        logger.debug(
+            "Compressed request body from %d to %d bytes in %.1f ms" %
+            (len(data), len(compressed), secs * 1000)
+            )
+
+    def get_stats(self):
+        ratio = None
+        if self.compressed_bytes:
+            ratio = round(
+                float(self.uncompressed_bytes) / self.compressed_bytes, 2
+                )
+        return {
+            "compressed_requests_count": self.requests_count,
+            "uncompressed_bytes": self.uncompressed_bytes,
+            "compressed_bytes": self.compressed_bytes,
+            "compression_ratio": ratio,
+            "compression_secs": round(self.compression_secs, 3),
+            }
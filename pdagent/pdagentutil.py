@@ -84,10 +84,68 @@ def queue_event(
     return incident_key, problems
 
 
+def get_event_error(event_type, incident_key, description):
+    # returns a message describing what is wrong with the given event
+    # arguments, or None if they can be queued.
+    if event_type == "trigger":
+        if (not description) or (not description.strip()):
+            return "Event type '%s' requires description" % event_type
+    else:
+        if not incident_key:
+            return "Event type '%s' requires incident key" % event_type
+    return None
+
+
+def make_event_validator(max_description_len=MAX_DESCRIPTION_LEN):
+    # returns a function that returns a message describing what is wrong with
+    # the given event JSON (str or UTF-8 bytes), or None if it can be sent.
+    # (imported here, as pd-send imports this module, but not the validator.)
+    from .thirdparty.six import string_types
+    event_types = frozenset(["trigger", "acknowledge", "resolve"])
+    string_fields = ["incident_key", "description", "client", "client_url"]
+
+    def get_error(s):
+        try:
+            if isinstance(s, bytes):
+                s = s.decode("utf-8")
+            event = json.loads(s)
+        except ValueError as e:
+            return "Invalid JSON: %s" % e
+        if not isinstance(event, dict):
+            return "Event is not a JSON object"
+        service_key = event.get("service_key")
+        if not isinstance(service_key, string_types) or not service_key:
+            return "Missing service key"
+        event_type = event.get("event_type")
+        if event_type not in event_types:
+            return "Unsupported event type %r" % (event_type,)
+        for field in string_fields:
+            value = event.get(field)
+            if value is not None and not isinstance(value, string_types):
+                return "Field '%s' is not a string" % field
+        description = event.get("description")
+        if description and len(description) > max_description_len:
+            return "Description is longer than %d characters" % \
+                max_description_len
+        return get_event_error(
+            event_type, event.get("incident_key"), description
+            )
+
+    return get_error
+
+
 def resurrect_events(queue, service_key):
     return queue.resurrect(service_key)
 
 
+def get_event(queue, event_id):
+    return queue.read_event(event_id)
+
+
+def get_events(queue, service_key):
+    return queue.list_events(service_key)
+
+
 def get_stats(queue, service_key):
     return queue.get_stats(
         detailed_snapshot=True,
@@ -37,6 +37,8 @@ Notes:
 - Designed for multiple processes concurrently using the queue.
 - Each entry in the queue is written to a separate file in the
     queue directory.
+- Aged succeeded and failed entries can be archived into compressed pack
+    files, each with an index of its entries (see PDQueue.pack.)
 - Files are named so that sorting by file name is queue order.
 - Concurrent enqueues use exclusive file create and retries to avoid
     using the same file name.
@@ -47,11 +49,17 @@ Notes:
 """
 
 
+from collections import OrderedDict
 import errno
+import heapq
+import io
+import json
 import logging
 import os
+import threading
 
-from .constants import ConsumeEvent, EnqueueWarnings
+from .constants import COMPACTION_MODES, ConsumeEvent, EnqueueWarnings, \
+    FLUSH_POLICIES, SUCCESS_POLICIES
 from .pdagentutil import ensure_readable_directory, ensure_writable_directory, \
     utcnow_isoformat
 
@@ -59,23 +67,100 @@ from .pdagentutil import ensure_readable_directory, ensure_writable_directory, \
 logger = logging.getLogger(__name__)
 
 
-QUEUE_SUBDIRS = ["pdq", "tmp", "suc", "err"]
+# 'dup' holds the enqueue-time deduplication index (see PDQEnqueuer.)
+# 'pack' holds archived succeeded and failed events (see PDQueue.pack.)
+QUEUE_SUBDIRS = ["pdq", "tmp", "suc", "err", "dup", "pack"]
+
+# event types that are archived in packs.
+_PACKED_TYPES = ["suc", "err"]
+
+# subdirectories that are kept in the RAM queue directory, if any, instead of
+# the queue directory (see PDQueue.spill.)
+RAM_QUEUE_SUBDIRS = ["pdq", "tmp"]
+
+# file in the queue directory to which the agent publishes the queue's disk
+# usage, for enqueuers to check against the quota.
+QUEUE_USAGE_FILE = "usage.json"
+
+# queue subdirectories whose disk usage counts towards the quota.
+_USAGE_TYPES = ["pdq", "suc", "err", "pack"]
+
+# fraction of the quota above which succeeded events are pruned.
+_QUOTA_PRUNE_RATIO = 0.9
+
+# incident key of the summary events that replace triggers of a service key
+# in an event storm.
+STORM_INCIDENT_KEY = "pdagent-event-storm"
+
+_STRING_TYPES = (str, type(u""))
+
+# processing rank of event types for the 'priority' flush policy.
+_EVENT_TYPE_PRIORITIES = {
+    "trigger": 0,
+    "acknowledge": 1,
+    "resolve": 2,
+    }
 
 
 class EmptyQueueError(Exception):
     pass
 
 
+class QueueFullError(Exception):
+    pass
+
+
 class PDQueueBase(object):
 
-    def __init__(self, queue_dir, lock_class, time_calc):
+    def __init__(self, queue_dir, lock_class, time_calc, ram_queue_dir=None):
         self.queue_dir = queue_dir
         self.lock_class = lock_class
         self.time = time_calc
+        # if given, pending events are queued in this directory (e.g. on a
+        # tmpfs), trading durability for speed.
+        self.ram_queue_dir = ram_queue_dir
 
     def _abspath(self, ftype, fname):
+        if self.ram_queue_dir and ftype in RAM_QUEUE_SUBDIRS:
+            return os.path.join(self.ram_queue_dir, ftype, fname)
+        return self._disk_abspath(ftype, fname)
+
+    def _disk_abspath(self, ftype, fname):
         return os.path.join(self.queue_dir, ftype, fname)
 
+    def _create_with_retry(self, ftype, fname_fmt, mode):
+        n = 0
+        t_microsecs = int(self.time.time() * 1e6)
+        while True:
+            fname = fname_fmt % (t_microsecs + n)
+            fname_abs = self._abspath(ftype, fname)
+            fd = _open_creat_excl(fname_abs, mode)
+            if fd is None:
+                n += 1
+                if n >= 100:
+                    raise Exception(
+                        "Too many retries! (Last attempted name: %s)"
+                        % fname_abs
+                        )
+            else:
+                return fname, fname_abs, fd
+
+    def _link_with_retry(self, ftype, fname_fmt, orig_abs):
+        n = 0
+        t_microsecs = int(self.time.time() * 1e6)
+        while True:
+            fname = fname_fmt % (t_microsecs + n)
+            fname_abs = self._abspath(ftype, fname)
+            if _link(orig_abs, fname_abs):
+                return fname, fname_abs
+            else:
+                n += 1
+                if n >= 100:
+                    raise Exception(
+                        "Too many retries! (Last attempted name: %s)"
+                        % fname_abs
+                        )
+
 
 class PDQEnqueuer(PDQueueBase):
 
@@ -85,34 +170,133 @@ class PDQEnqueuer(PDQueueBase):
             lock_class,
             time_calc,
             enqueue_file_mode,
-            default_umask
+            default_umask,
+            dedup_window_secs=0,
+            quota_max_bytes=0,
+            quota_max_entries=0,
+            ram_queue_dir=None
             ):
-        PDQueueBase.__init__(self, queue_dir, lock_class, time_calc)
+        PDQueueBase.__init__(
+            self, queue_dir, lock_class, time_calc, ram_queue_dir
+            )
         self.enqueue_file_mode = enqueue_file_mode
         self.default_umask = default_umask
+        # 0 means no deduplication.
+        self.dedup_window_secs = dedup_window_secs
+        # 0 means no limit.
+        self.quota_max_bytes = quota_max_bytes
+        self.quota_max_entries = quota_max_entries
+
+        # the agent makes the RAM queue directories when it starts, so they
+        # can be missing until then (e.g. on a tmpfs after a reboot.) Events
+        # are queued on disk meanwhile, and the agent queues them in RAM when
+        # it starts (see PDQueue.replay_spill.)
+        if self.ram_queue_dir and not all(
+                os.path.isdir(self._abspath(t, ""))
+                for t in RAM_QUEUE_SUBDIRS
+                ):
+            logger.info(
+                "RAM queue directory %s is not ready; queueing on disk" %
+                self.ram_queue_dir
+                )
+            self.ram_queue_dir = None
 
         # Enqueue needs only write access to the 'tmp' and 'pdq' directories
-        ensure_writable_directory(os.path.join(self.queue_dir, "tmp"))
-        ensure_writable_directory(os.path.join(self.queue_dir, "pdq"))
+        ensure_writable_directory(self._abspath("tmp", ""))
+        ensure_writable_directory(self._abspath("pdq", ""))
 
     def enqueue(self, service_key, s):
-        # write to an exclusive temp file
-        _, tmp_fname_abs, tmp_fd, problems = self._open_creat_excl_with_retry(
-            "tmp",
-            "%%d_%s.txt" % service_key
-            )
-        os.write(tmp_fd, s.encode())
-        os.close(tmp_fd)
-        # link to an exclusive queue entry file
-        pdq_fname, _ = self._link_with_retry(
-            "pdq",
-            "%%d_%s.txt" % service_key,
-            tmp_fname_abs
-            )
+        data = s.encode()
+        if self.quota_max_bytes > 0 or self.quota_max_entries > 0:
+            self._check_quota(len(data))
+        marker_abs = None
+        if self.dedup_window_secs > 0:
+            is_duplicate, marker_abs = self._is_duplicate(service_key, s)
+            if is_duplicate:
+                return None, [EnqueueWarnings.DUPLICATE_EVENT]
+        try:
+            # write to an exclusive temp file
+            _, tmp_fname_abs, tmp_fd, problems = \
+                self._open_creat_excl_with_retry(
+                    "tmp",
+                    "%%d_%s.txt" % service_key
+                    )
+            os.write(tmp_fd, data)
+            os.close(tmp_fd)
+            # link to an exclusive queue entry file
+            pdq_fname, _ = self._link_with_retry(
+                "pdq",
+                "%%d_%s.txt" % service_key,
+                tmp_fname_abs
+                )
+        except:
+            # the event is not queued, so a retry must not be taken for a
+            # duplicate of it.
+            if marker_abs:
+                try:
+                    os.unlink(marker_abs)
+                except OSError:
+                    pass
+            raise
         # unlink the temp file
         os.unlink(tmp_fname_abs)
         return pdq_fname, problems
 
+    # Raises QueueFullError if an event of given size would take the queue
+    # over its quota, going by the usage last published by the agent. Events
+    # are queued if there is no usage to go by.
+    def _check_quota(self, size):
+        usage = _read_queue_usage(self._abspath("", QUEUE_USAGE_FILE))
+        if usage is None:
+            return
+        if (self.quota_max_bytes > 0 and
+                usage["bytes"] + size > self.quota_max_bytes) or \
+                (self.quota_max_entries > 0 and
+                    usage["entries"] + 1 > self.quota_max_entries):
+            raise QueueFullError(
+                "Event queue is full (%d bytes in %d entries); "
+                "event not queued." % (usage["bytes"], usage["entries"])
+                )
+
+    # Returns (True, None) if an identical event was queued in the last
+    # dedup_window_secs. Otherwise, records the event and returns (False,
+    # path of its marker), or (False, None) if the index can't be used.
+    #
+    # The index has a marker file per event hash and time bucket (of window
+    # length), named <bucket>_<hash>, holding the time at which the event was
+    # queued. Only the enqueuer that creates the marker of the current bucket
+    # can queue the event, so this is safe for concurrent enqueuers without
+    # locking. If the event turns out to be a duplicate of one queued in the
+    # previous bucket, the marker is removed again. Problems with the index
+    # are ignored, so that events are queued rather than lost.
+    def _is_duplicate(self, service_key, s):
+        now = int(self.time.time())
+        bucket = now // self.dedup_window_secs
+        event_hash = _dedup_hash(service_key, s)
+        marker_abs = self._abspath("dup", "%d_%s" % (bucket, event_hash))
+        try:
+            fd = _open_creat_excl(marker_abs, self.enqueue_file_mode)
+            if fd is None:
+                return True, None
+            try:
+                last_queued = _read_dedup_marker(
+                    self._abspath("dup", "%d_%s" % (bucket - 1, event_hash))
+                    )
+                if last_queued is not None and \
+                        now - last_queued < self.dedup_window_secs:
+                    os.unlink(marker_abs)
+                    return True, None
+                try:
+                    os.write(fd, str(now).encode())
+                except (IOError, OSError):
+                    os.unlink(marker_abs)
+                    raise
+                return False, marker_abs
+            finally:
+                os.close(fd)
+        except (IOError, OSError):
+            return False, None
+
     def _open_creat_excl_with_retry(self, ftype, fname_fmt):
         problems = []
         # we're changing the umask globally here, because this is not supposed
@@ -122,40 +306,13 @@ class PDQEnqueuer(PDQueueBase):
             # current user's umask is very restrictive.
             problems.append(EnqueueWarnings.UMASK_TOO_RESTRICTIVE)
         try:
-            n = 0
-            t_microsecs = int(self.time.time() * 1e6)
-            while True:
-                fname = fname_fmt % (t_microsecs + n)
-                fname_abs = self._abspath(ftype, fname)
-                fd = _open_creat_excl(fname_abs, self.enqueue_file_mode)
-                if fd is None:
-                    n += 1
-                    if n >= 100:
-                        raise Exception(
-                            "Too many retries! (Last attempted name: %s)"
-                            % fname_abs
-                            )
-                else:
-                    return fname, fname_abs, fd, problems
+            fname, fname_abs, fd = self._create_with_retry(
+                ftype, fname_fmt, self.enqueue_file_mode
+                )
+            return fname, fname_abs, fd, problems
         finally:
             os.umask(orig_umask)
 
-    def _link_with_retry(self, ftype, fname_fmt, orig_abs):
-        n = 0
-        t_microsecs = int(self.time.time() * 1e6)
-        while True:
-            fname = fname_fmt % (t_microsecs + n)
-            fname_abs = self._abspath(ftype, fname)
-            if _link(orig_abs, fname_abs):
-                return fname, fname_abs
-            else:
-                n += 1
-                if n >= 100:
-                    raise Exception(
-                        "Too many retries! (Last attempted name: %s)"
-                        % fname_abs
-                        )
-
 
 class PDQueue(PDQueueBase):
 
@@ -168,18 +325,67 @@ class PDQueue(PDQueueBase):
             backoff_interval,
             retry_limit_for_possible_errors,
             backoff_db,
-            counter_db
+            counter_db,
+            flush_policy="fifo",
+            max_events_per_pass=0,
+            max_secs_per_pass=0,
+            compaction="none",
+            compaction_target="suc",
+            event_ttl_secs=0,
+            event_ttl_secs_by_service_key=None,
+            dedup_window_secs=0,
+            dedup_max_entries=0,
+            storm_max_triggers=0,
+            storm_window_secs=60,
+            rejected_keys_db=None,
+            rejected_key_ttl_secs=0,
+            incident_states_db=None,
+            incident_states_max_entries=0,
+            incident_states_ttl_secs=0,
+            event_validator=None,
+            payload_cache_max_bytes=0,
+            prefetch_events=0,
+            pack_after_secs=0,
+            pack_max_events=1000,
+            success_policy="keep",
+            receipt_log_max_bytes=0,
+            quota_max_bytes=0,
+            quota_max_entries=0,
+            ram_queue_dir=None,
+            ram_spill_secs=5,
+            head_db=None,
+            head_checkpoint_events=0,
+            compression_db=None
             ):
-        PDQueueBase.__init__(self, queue_dir, lock_class, time_calc)
+        PDQueueBase.__init__(
+            self, queue_dir, lock_class, time_calc, ram_queue_dir
+            )
+
+        if flush_policy not in FLUSH_POLICIES:
+            raise ValueError("Unsupported flush policy %s" % flush_policy)
+        if compaction not in COMPACTION_MODES:
+            raise ValueError("Unsupported compaction mode %s" % compaction)
+        if compaction_target not in ["suc", "err"]:
+            raise ValueError(
+                "Unsupported compaction target %s" % compaction_target
+                )
+        if success_policy not in SUCCESS_POLICIES:
+            raise ValueError("Unsupported success policy %s" % success_policy)
 
         for ftype in QUEUE_SUBDIRS:
-            d = os.path.join(self.queue_dir, ftype)
-            ensure_readable_directory(d)
-            ensure_writable_directory(d)
+            dirs = set([self._abspath(ftype, ""), self._disk_abspath(ftype, "")])
+            for d in dirs:
+                ensure_readable_directory(d)
+                ensure_writable_directory(d)
 
         self._dequeue_lockfile = os.path.join(
             self.queue_dir, "dequeue.lock"
             )
+        # serializes changes to packs, e.g. by the agent and 'pd-queue retry'.
+        self._pack_lockfile = os.path.join(self.queue_dir, "pack.lock")
+        # file locks don't exclude threads of the same process, e.g. the
+        # agent's send and cleanup tasks.
+        self._pack_thread_lock = threading.Lock()
 
         self.event_size_max_bytes = event_size_max_bytes
         self.backoff_info = _BackoffInfo(
@@ -189,10 +395,85 @@ class PDQueue(PDQueueBase):
             time_calc
             )
         self.counter_info = _CounterInfo(counter_db, time_calc)
+        # 0 means rejected service keys are not remembered.
+        self.rejected_keys_info = _RejectedKeysInfo(
+            rejected_keys_db, rejected_key_ttl_secs, time_calc
+            )
+        # 0 means no incident states are kept, and no events are skipped.
+        self.incident_state_info = _IncidentStateInfo(
+            incident_states_db,
+            incident_states_max_entries,
+            incident_states_ttl_secs,
+            time_calc
+            )
+
+        self.flush_policy = flush_policy
+        # 0 means no limit.
+        self.max_events_per_pass = max_events_per_pass
+        self.max_secs_per_pass = max_secs_per_pass
+        self.compaction = compaction
+        self.compaction_target = compaction_target
+        self.event_ttl_secs = event_ttl_secs
+        self.event_ttl_secs_by_service_key = \
+            event_ttl_secs_by_service_key or {}
+        self.dedup_window_secs = dedup_window_secs
+        self.dedup_max_entries = dedup_max_entries
+        # 0 means no storm control.
+        self.storm_max_triggers = storm_max_triggers
+        self.storm_window_secs = storm_window_secs
+        # returns what is wrong with an event string, or None if it is valid.
+        self.event_validator = event_validator
+        # payloads of events that stay queued after being processed, to save
+        # re-reading them in later passes. 0 means no caching.
+        self.payload_cache = _PayloadCache(payload_cache_max_bytes)
+        # number of events to read ahead while an event is being consumed.
+        # 0 means no read-ahead.
+        self.prefetch_events = prefetch_events
+        # 0 means succeeded and failed events are not archived in packs.
+        self.pack_after_secs = pack_after_secs
+        self.pack_max_events = pack_max_events
+        self.success_policy = success_policy
+        # read for stats whatever the policy, as it may have been changed.
+        self.receipt_log = _ReceiptLog(
+            os.path.join(self.queue_dir, "receipts.log"), receipt_log_max_bytes
+            )
+        # 0 means no limit. Usage is tracked only if there is a limit.
+        self.quota_max_bytes = quota_max_bytes
+        self.quota_max_entries = quota_max_entries
+        self.usage = _QueueUsage(self._abspath)
+        # pending events in the RAM queue directory are copied to the queue
+        # directory once they are this old.
+        self.ram_spill_secs = ram_spill_secs
+        # names of pending events with a copy in the queue directory.
+        self._spilled = set()
+        # 0 means the oldest pending events are not remembered across
+        # restarts. Compaction and storm control need the whole queue, so
+        # the checkpoint is not used with them.
+        self.head_checkpoint = _HeadCheckpoint(head_db, head_checkpoint_events)
+        self._head = []
+        if compaction == "none" and storm_max_triggers <= 0:
+            self._head = self.head_checkpoint.load()
+        self.head_events_count = len(self._head)
+        # names of events that left the pending state in the current pass.
+        self._pass_dequeued = set()
+        self._start_time = time_calc.time()
+        self.time_to_first_send_secs = None
+        self.last_flush_stats = None
+        self.last_cleanup_stats = None
+        # totals of request compression by the agent, which are saved so
+        # that other processes (e.g. 'pd-queue status') can report them.
+        self._compression_db = compression_db
+        self._compression_stats = None
+        # (event_type, incident_key) of queued events, by file name.
+        self._event_info = {}
+        # enqueue times of recent triggers by file name, and state of ongoing
+        # storms, by service key.
+        self._recent_triggers = {}
+        self._storms = {}
 
     # Get the list of queued files from the queue directory in enqueue order
     def _queued_files(self, ftype="pdq"):
-        fnames = sorted(os.listdir(os.path.join(self.queue_dir, ftype)))
+        fnames = sorted(os.listdir(self._abspath(ftype, "")))
         return fnames
 
     def dequeue(self, consume_func, stop_check_func=lambda: False):
@@ -204,12 +485,13 @@ class PDQueue(PDQueueBase):
             )
 
     def flush(self, consume_func, stop_check_func):
-        # process all events in queue.
+        # process all events in queue, and return the stats of the pass.
         self._process_queue(
             lambda events: events,
             consume_func,
             stop_check_func
             )
+        return self.last_flush_stats
 
     def _process_queue(
             self,
@@ -218,59 +500,465 @@ class PDQueue(PDQueueBase):
             should_stop_func
             ):
 
-        if not self._queued_files():
+        # on the first pass, the oldest events known from the last run are
+        # processed before the queue directory is scanned, which can take a
+        # while with a large backlog.
+        head = self._take_head()
+        if not head and not self._queued_files():
             raise EmptyQueueError
 
         lock = self.lock_class(self._dequeue_lockfile)
         lock.acquire()
 
         try:
-            file_names = self._queued_files()
-            if not len(file_names):
-                raise EmptyQueueError
-
-            file_names = filter_events_to_process_func(file_names)
-            if not len(file_names):
-                return
-
-            now = self.time.time()
+            if self.ram_queue_dir:
+                self._spill(self.ram_spill_secs)
+            head = [
+                fname for fname in head
+                if os.path.exists(self._abspath("pdq", fname))
+                ]
+
+            pass_stats = PassStats(self.flush_policy, self.time)
             err_svc_keys = set()
+            self._pass_dequeued = set()
 
             self.backoff_info.update()
-            for fname in file_names:
+            self.rejected_keys_info.update()
+
+            stopped = False
+            if head:
+                logger.info(
+                    "Processing %d events from the head checkpoint" % len(head)
+                    )
+                if self.event_ttl_secs or self.event_ttl_secs_by_service_key:
+                    head = self._expire(head)
+                head_count = len(head)
+                head = self._schedule(filter_events_to_process_func(head))
+                stopped = self._process_files(
+                    head, consume_func, should_stop_func, pass_stats,
+                    err_svc_keys
+                    )
+                # (e.g. dequeue processes only the first event.)
+                stopped = stopped or len(head) < head_count
+
+            if not stopped:
+                file_names = self._queued_files()
+                if not len(file_names) and not head:
+                    raise EmptyQueueError
+                self._prune_event_info(file_names)
+                self.payload_cache.prune(file_names)
+                if self._has_quota():
+                    self.usage.sync_pending(file_names)
+                queued_names = file_names
+                if self.event_ttl_secs or self.event_ttl_secs_by_service_key:
+                    file_names = self._expire(file_names)
+                if self.compaction != "none":
+                    file_names = self._compact(file_names)
+                if self.storm_max_triggers > 0:
+                    file_names = self._control_storms(file_names)
+                if len(file_names) < len(queued_names):
+                    self.counter_info.store()
+                if head:
+                    # events of the head have had their chance this pass.
+                    head = set(head)
+                    file_names = [f for f in file_names if f not in head]
+
+                file_names = filter_events_to_process_func(file_names)
+                self._process_files(
+                    self._schedule(file_names), consume_func,
+                    should_stop_func, pass_stats, err_svc_keys
+                    )
+                self._store_head(queued_names)
+
+            self.backoff_info.store()
+            self.rejected_keys_info.store()
+            self.incident_state_info.store()
+            self.counter_info.store()
+            self.last_flush_stats = pass_stats.to_dict()
+            if self._has_quota():
+                self._enforce_quota()
+        finally:
+            lock.release()
+
+    # Processes the given queued events in order, and returns true if no more
+    # events must be processed in this pass.
+    def _process_files(
+            self,
+            file_names,
+            consume_func,
+            should_stop_func,
+            pass_stats,
+            err_svc_keys
+            ):
+        if not file_names:
+            return False
+        now = self.time.time()
+
+        prefetcher = None
+        if self.prefetch_events > 0 and len(file_names) > 1:
+            prefetcher = _Prefetcher(
+                self,
+                self._get_prefetch_fnames(file_names, err_svc_keys, now),
+                self.prefetch_events
+                )
+
+        try:
+            for index, fname in enumerate(file_names):
+                prefetched = prefetcher.take(index) if prefetcher else None
                 if should_stop_func():
-                    break
+                    return True
+                if self._is_pass_limit_reached(pass_stats):
+                    logger.info(
+                        "Reached limit for this pass after %d events" %
+                        pass_stats.count
+                        )
+                    pass_stats.limit_reached = True
+                    return True
                 try:
-                    _, svc_key = _get_event_metadata(fname)
+                    enqueue_time, svc_key = _get_event_metadata(fname)
                 except _BadFileNameError:
                     logger.warning("Badly named event " + fname)
                     self._unsafe_change_event_type(fname, 'pdq', 'err')
                     continue
+                if self.rejected_keys_info.is_rejected(svc_key):
+                    # fail without sending; it would be rejected anyway.
+                    logger.info(
+                        "Not processing event %s -- service key %s was "
+                        "rejected" % (fname, svc_key)
+                        )
+                    self._unsafe_change_event_type(fname, 'pdq', 'err')
+                    self.counter_info.increment_failure()
+                    continue
                 if svc_key not in err_svc_keys and \
                         self.backoff_info.get_current_retry_at(svc_key) <= now:
                     # no back-off; nothing has gone wrong in this pass yet.
+                    pass_stats.add_event(enqueue_time)
                     try:
                         if not self._process_event(
-                                fname, consume_func, svc_key
+                                fname, consume_func, svc_key, pass_stats,
+                                prefetched
                                 ):
                             # this service key is problematic.
                             err_svc_keys.add(svc_key)
+                            if prefetcher:
+                                prefetcher.skip(svc_key)
+                            pass_stats.throttled = True
                     except StopIteration:
                         # no further processing must be done.
                         logger.info("Not processing any more events this time")
-                        break
-
-            self.backoff_info.store()
-            self.counter_info.store()
+                        pass_stats.throttled = True
+                        return True
+                else:
+                    # this service key is backing off.
+                    pass_stats.throttled = True
+            return False
         finally:
-            lock.release()
+            if prefetcher:
+                prefetcher.stop()
+
+    # Returns the given file names, with None in place of events that the
+    # pass won't read: events of service keys that are failing this pass,
+    # backed off or rejected, and events in the payload cache. This is worked
+    # out before the prefetcher starts, so that its thread does not look at
+    # state that the pass changes.
+    def _get_prefetch_fnames(self, file_names, err_svc_keys, now):
+        skipped_by_svc_key = {}
+        prefetch_fnames = []
+        for fname in file_names:
+            try:
+                _, svc_key = _get_event_metadata(fname)
+            except _BadFileNameError:
+                prefetch_fnames.append(None)
+                continue
+            if svc_key not in skipped_by_svc_key:
+                skipped_by_svc_key[svc_key] = (
+                    svc_key in err_svc_keys or
+                    self.backoff_info.get_current_retry_at(svc_key) > now or
+                    self.rejected_keys_info.is_rejected(svc_key)
+                    )
+            if skipped_by_svc_key[svc_key] or self.payload_cache.has(fname):
+                prefetch_fnames.append(None)
+            else:
+                prefetch_fnames.append(fname)
+        return prefetch_fnames
+
+    # Returns the names of the events in the head checkpoint on the first
+    # pass, and an empty list after that.
+    def _take_head(self):
+        head, self._head = self._head, []
+        return head
+
+    # Saves the names of the oldest events still queued after a pass, given
+    # the queued file names at the start of the pass.
+    def _store_head(self, queued_fnames):
+        if not self.head_checkpoint.enabled:
+            return
+        head = []
+        for fname in queued_fnames:
+            if len(head) >= self.head_checkpoint.max_events:
+                break
+            if fname not in self._pass_dequeued:
+                head.append(fname)
+        self.head_checkpoint.store(head)
+
+    # Returns the given queued file names in the order of the flush policy.
+    def _schedule(self, fnames):
+        if self.flush_policy == "round_robin":
+            return _round_robin_order(fnames)
+        elif self.flush_policy == "priority":
+            return _priority_order(fnames, self._get_event_info)
+        else:
+            return fnames
+
+    # Moves queued events older than their time-to-live to the error state,
+    # without reading them, and returns the remaining file names.
+    def _expire(self, fnames):
+        now = self.time.time()
+        remaining = []
+        for fname in fnames:
+            try:
+                enqueue_time, svc_key = _get_event_metadata(fname)
+            except _BadFileNameError:
+                remaining.append(fname)
+                continue
+            ttl = self.event_ttl_secs_by_service_key.get(
+                svc_key, self.event_ttl_secs
+                )
+            if ttl > 0 and now - enqueue_time > ttl:
+                logger.info(
+                    "Expiring %s -- queued for more than %d secs" %
+                    (fname, ttl)
+                    )
+                self._unsafe_change_event_type(fname, 'pdq', 'err')
+                self.counter_info.increment_expired()
+            else:
+                remaining.append(fname)
+        return remaining
+
+    # Moves queued events that are superseded by a later resolve of the same
+    # incident out of the queue, and returns the remaining file names.
+    def _compact(self, fnames):
+        incidents = {}
+        for fname in fnames:
+            try:
+                _, svc_key = _get_event_metadata(fname)
+            except _BadFileNameError:
+                continue
+            event_type, incident_key = self._get_event_info(fname)
+            if event_type is not None and incident_key is not None:
+                incidents.setdefault((svc_key, incident_key), []).append(
+                    (fname, event_type)
+                    )
+
+        drop_reasons = {}
+        for events in incidents.values():
+            event_types = [event_type for (_, event_type) in events]
+            if "resolve" not in event_types:
+                continue
+            last_resolve = len(events) - 1 - event_types[::-1].index("resolve")
+            resolve_fname = events[last_resolve][0]
+            for (fname, _) in events[:last_resolve]:
+                drop_reasons[fname] = "superseded by %s" % resolve_fname
+            if self.compaction == "drop_resolved" and \
+                    "trigger" in event_types[:last_resolve]:
+                drop_reasons[resolve_fname] = \
+                    "incident was triggered and resolved in queue"
+
+        remaining = []
+        for fname in fnames:
+            reason = drop_reasons.get(fname)
+            if reason is None:
+                remaining.append(fname)
+            else:
+                logger.info("Compaction: dropping %s -- %s" % (fname, reason))
+                self._unsafe_change_event_type(
+                    fname, 'pdq', self.compaction_target
+                    )
+                self.counter_info.increment_compacted()
+        return remaining
+
+    # Detects service keys receiving more than storm_max_triggers triggers in
+    # storm_window_secs, and replaces the queued triggers of such keys by a
+    # summary event once every storm_window_secs. Held-back triggers are not
+    # processed in this pass; other events of the key are not affected.
+    # Returns the file names to process in this pass.
+    def _control_storms(self, fnames):
+        now = self.time.time()
+        window_start = now - self.storm_window_secs
+        triggers = {}
+        for fname in fnames:
+            try:
+                enqueue_time, svc_key = _get_event_metadata(fname)
+            except _BadFileNameError:
+                continue
+            event_type, incident_key = self._get_event_info(fname)
+            if event_type != "trigger" or incident_key == STORM_INCIDENT_KEY:
+                continue
+            triggers.setdefault(svc_key, []).append(fname)
+            if enqueue_time >= window_start:
+                self._recent_triggers.setdefault(svc_key, {})[fname] = \
+                    enqueue_time
+
+        for svc_key in list(self._recent_triggers.keys()):
+            recent = dict(
+                (fname, t)
+                for (fname, t) in self._recent_triggers[svc_key].items()
+                if t >= window_start
+                )
+            if recent:
+                self._recent_triggers[svc_key] = recent
+            else:
+                del self._recent_triggers[svc_key]
+
+        taken_out = set()
+        for svc_key in set(triggers.keys()) | set(self._storms.keys()):
+            storm = self._storms.get(svc_key)
+            if len(self._recent_triggers.get(svc_key, [])) > \
+                    self.storm_max_triggers:
+                if storm is None:
+                    logger.warning("Event storm in service key %s" % svc_key)
+                    storm = self._storms[svc_key] = {
+                        "started_on": utcnow_isoformat(self.time),
+                        "last_summary_time": None,
+                        "suppressed_events_count": 0
+                        }
+                summary_due = storm["last_summary_time"] is None or \
+                    now - storm["last_summary_time"] >= self.storm_window_secs
+            else:
+                if storm is not None:
+                    logger.info(
+                        "Event storm in service key %s is over" % svc_key
+                        )
+                    del self._storms[svc_key]
+                # summarize any triggers held back during the storm.
+                summary_due = storm is not None
+            storm_triggers = triggers.get(svc_key)
+            if storm_triggers is None or storm is None:
+                continue
+            if summary_due:
+                self._summarize_storm(svc_key, storm_triggers)
+                storm["last_summary_time"] = now
+                storm["suppressed_events_count"] += len(storm_triggers)
+            taken_out.update(storm_triggers)
+
+        return [fname for fname in fnames if fname not in taken_out]
+
+    # Queues a summary event for the given triggers of a service key, and
+    # moves the triggers to the error state, as they are not sent.
+    def _summarize_storm(self, svc_key, fnames):
+        incident_keys = set()
+        descriptions = []
+        for fname in fnames:
+            try:
+                fname_abs = self._abspath("pdq", fname)
+                # events that are too large to send are aggregated unread.
+                if os.path.getsize(fname_abs) > self.event_size_max_bytes:
+                    continue
+                with open(fname_abs) as f:
+                    event = json.load(f)
+                incident_key = event.get("incident_key")
+                description = event.get("description")
+            except (IOError, OSError, ValueError, AttributeError):
+                continue
+            if isinstance(incident_key, _STRING_TYPES):
+                incident_keys.add(incident_key)
+            if description and len(descriptions) < 5 and \
+                    description not in descriptions:
+                descriptions.append(description)
+
+        summary = {
+            "service_key": svc_key,
+            "event_type": "trigger",
+            "incident_key": STORM_INCIDENT_KEY,
+            "description":
+                "Event storm: %d trigger(s) for %d incident key(s) "
+                "aggregated by PagerDuty Agent" %
+                (len(fnames), len(incident_keys)),
+            "details": {
+                "aggregated_events_count": len(fnames),
+                "incident_keys_count": len(incident_keys),
+                "incident_keys_sample": sorted(incident_keys)[:10],
+                "descriptions_sample": descriptions
+                },
+            "agent": {
+                "queued_by": "pdagentd",
+                "queued_at": utcnow_isoformat(self.time)
+                }
+            }
+        self._queue_event(
+            svc_key, json.dumps(summary, separators=(',', ':'), sort_keys=True)
+            )
+        logger.info(
+            "Event storm in service key %s: aggregated %d triggers" %
+            (svc_key, len(fnames))
+            )
+        for fname in fnames:
+            self._unsafe_change_event_type(fname, 'pdq', 'err')
+            self.counter_info.increment_storm_suppressed()
+
+    # Queues up the given event string, like PDQEnqueuer.enqueue does.
+    def _queue_event(self, svc_key, s):
+        _, tmp_fname_abs, tmp_fd = self._create_with_retry(
+            "tmp", "%%d_%s.txt" % svc_key, 0o644
+            )
+        os.write(tmp_fd, s.encode())
+        os.close(tmp_fd)
+        pdq_fname, _ = self._link_with_retry(
+            "pdq", "%%d_%s.txt" % svc_key, tmp_fname_abs
+            )
+        os.unlink(tmp_fname_abs)
+        return pdq_fname
+
+    def _is_pass_limit_reached(self, pass_stats):
+        if self.max_events_per_pass and \
+                pass_stats.count >= self.max_events_per_pass:
+            return True
+        if self.max_secs_per_pass and \
+                pass_stats.elapsed_secs() >= self.max_secs_per_pass:
+            return True
+        return False
+
+    # Returns (event_type, incident_key) of a queued event, or (None, None)
+    # if the event can't be read. Parsed info is remembered until the event
+    # leaves the queue, so that each event is read at most once for this.
+    def _get_event_info(self, fname):
+        info = self._event_info.get(fname)
+        if info is None:
+            info = (None, None)
+            try:
+                fname_abs = self._abspath("pdq", fname)
+                if os.path.getsize(fname_abs) <= self.event_size_max_bytes:
+                    with open(fname_abs, "rb") as f:
+                        info = _parse_event_info(f.read())
+            except (IOError, OSError):
+                pass
+            self._event_info[fname] = info
+        return info
+
+    # Forgets parsed info of events that are no longer queued.
+    def _prune_event_info(self, queued_fnames):
+        if self._event_info:
+            queued = set(queued_fnames)
+            for fname in list(self._event_info):
+                if fname not in queued:
+                    del self._event_info[fname]
 
     # Returns true if processing can continue for service key, false if not.
-    def _process_event(self, fname, consume_func, svc_key):
+    def _process_event(
+            self, fname, consume_func, svc_key, pass_stats=None, prefetched=None
+            ):
         fname_abs = self._abspath("pdq", fname)
+        st = os.stat(fname_abs)
         data = None
-        if not os.path.getsize(fname_abs) > self.event_size_max_bytes:
-            with open(fname_abs) as f:
+        if prefetched and _stat_signature(prefetched[0]) == _stat_signature(st):
+            data = prefetched[1]
+            if pass_stats:
+                pass_stats.prefetched_count += 1
+        if data is None:
+            data = self.payload_cache.get(fname, st)
+        if data is None and not st.st_size > self.event_size_max_bytes:
+            # read bytes as they are, to pass them on without any copies.
+            with open(fname_abs, "rb") as f:
                 data = f.read()
 
         # ensure that the event is not too large.
@@ -282,23 +970,87 @@ class PDQueue(PDQueueBase):
             self.counter_info.increment_failure()
             return True
 
+        # events that are parsed here are decoded once, and their bytes are
+        # dropped while parsing, so that a large event is in memory at most
+        # twice (as text, and as parsed JSON or as bytes to send.)
+        needs_event_info = self.incident_state_info.enabled or \
+            self.success_policy == "receipt"
+        text = None
+        if self.event_validator or (
+                needs_event_info and fname not in self._event_info
+                ):
+            text = _decode_event(data)
+            data = None
+
+        # fail invalid events without sending them.
+        if self.event_validator:
+            validation_start_time = self.time.time()
+            error = self.event_validator(text)
+            if pass_stats:
+                pass_stats.add_validation(
+                    self.time.time() - validation_start_time
+                    )
+            if error:
+                logger.info(
+                    "Not processing invalid event %s -- %s" % (fname, error)
+                    )
+                self._unsafe_change_event_type(fname, 'pdq', 'err')
+                self.counter_info.increment_failure()
+                self.counter_info.increment_invalid()
+                return True
+
+        event_type = incident_key = None
+        if needs_event_info:
+            if fname not in self._event_info:
+                self._event_info[fname] = _parse_event_info(text)
+            event_type, incident_key = self._event_info[fname]
+        if self.incident_state_info.is_redundant(
+                svc_key, incident_key, event_type
+                ):
+            logger.info(
+                "Not sending event %s -- incident %s is already resolved"
+                % (fname, incident_key)
+                )
+            self._succeed(fname, svc_key, incident_key, "redundant")
+            self.counter_info.increment_redundant()
+            return True
+
+        if data is None:
+            data = _encode_event(text)
+            text = None
+
         logger.info("Processing event " + fname)
+        if self.time_to_first_send_secs is None:
+            self.time_to_first_send_secs = \
+                self.time.time() - self._start_time
+            logger.info(
+                "Sending first event %.3f secs after startup" %
+                self.time_to_first_send_secs
+                )
         consume_code = consume_func(data, fname)
 
         if consume_code == ConsumeEvent.CONSUMED:
             # a failure here means duplicate event sends if the incident key
             # was not specified, i.e. if event was enqueued in a non-standard
             # manner (e.g. not using the pd* scripts.)
-            self._unsafe_change_event_type(fname, 'pdq', 'suc')
+            self._succeed(fname, svc_key, incident_key, "sent")
             self.counter_info.increment_success()
+            self.incident_state_info.update(svc_key, incident_key, event_type)
             return True
         elif consume_code == ConsumeEvent.STOP_ALL:
             # stop processing any more events.
+            self.payload_cache.put(fname, st, data)
             raise StopIteration
         elif consume_code == ConsumeEvent.BAD_ENTRY:
             self._unsafe_change_event_type(fname, 'pdq', 'err')
             self.counter_info.increment_failure()
             return True
+        elif consume_code == ConsumeEvent.BAD_SVCKEY:
+            logger.info("Service key %s was rejected" % svc_key)
+            self._unsafe_change_event_type(fname, 'pdq', 'err')
+            self.counter_info.increment_failure()
+            self.rejected_keys_info.reject(svc_key)
+            return True
         elif consume_code == ConsumeEvent.BACKOFF_SVCKEY_BAD_ENTRY:
             logger.info("Backing off service key " + svc_key)
             if self.backoff_info.is_threshold_breached(svc_key):
@@ -318,15 +1070,113 @@ class PDQueue(PDQueueBase):
                 return True
             else:
                 self.backoff_info.increment(svc_key)
+                self.payload_cache.put(fname, st, data)
                 return False
         elif consume_code == ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED:
             self.backoff_info.increment(svc_key)
+            self.payload_cache.put(fname, st, data)
             return False
         else:
             raise ValueError(
                 "Unsupported dequeue consume code %d" %
                 consume_code)
 
+    def _succeed(self, fname, svc_key, incident_key, status):
+        # moves a processed event to 'suc', or removes it and logs a receipt
+        # of it, as per the success policy.
+        if self.success_policy == "keep":
+            self._unsafe_change_event_type(fname, 'pdq', 'suc')
+            return
+        enqueue_time, _ = _get_event_metadata(fname)
+        self.receipt_log.append({
+            "event": fname,
+            "service_key": svc_key,
+            "incident_key": incident_key,
+            "status": status,
+            "latency_secs": round(self.time.time() - enqueue_time, 3),
+            })
+        logger.info("Removing %s event %s..." % (status, fname))
+        os.remove(self._abspath("pdq", fname))
+        self._pass_dequeued.add(fname)
+        self.usage.remove("pdq", fname)
+        self._remove_spilled(fname)
+
+    # In the RAM queue mode, copies pending events queued at least
+    # min_age_secs ago to the queue directory, so that they outlive the RAM
+    # queue directory (see replay_spill.) The agent does this every pass, and
+    # for all events when it stops.
+    def spill(self, min_age_secs=0):
+        if not self.ram_queue_dir:
+            return 0
+        lock = self.lock_class(self._dequeue_lockfile)
+        lock.acquire()
+        try:
+            return self._spill(min_age_secs)
+        finally:
+            lock.release()
+
+    def _spill(self, min_age_secs):
+        spill_before_time = self.time.time() - min_age_secs
+        count = 0
+        for fname in self._queued_files():
+            if fname in self._spilled:
+                continue
+            try:
+                enqueue_time, _ = _get_event_metadata(fname)
+            except _BadFileNameError:
+                continue
+            if enqueue_time > spill_before_time:
+                break  # the rest are newer.
+            try:
+                _copy_file(
+                    self._abspath("pdq", fname),
+                    self._disk_abspath("tmp", fname + ".spill"),
+                    self._disk_abspath("pdq", fname)
+                    )
+            except (IOError, OSError) as e:
+                if e.errno == errno.ENOENT:
+                    continue  # e.g. retried by someone else meanwhile.
+                raise
+            self._spilled.add(fname)
+            count += 1
+        if count:
+            logger.info("Spilled %d pending events to disk" % count)
+        return count
+
+    # In the RAM queue mode, queues the pending events spilled to the queue
+    # directory again, if they are not in the RAM queue directory (e.g. after
+    # a reboot.) Returns the number of events queued again.
+    def replay_spill(self):
+        if not self.ram_queue_dir:
+            return 0
+        lock = self.lock_class(self._dequeue_lockfile)
+        lock.acquire()
+        try:
+            count = 0
+            for fname in sorted(os.listdir(self._disk_abspath("pdq", ""))):
+                if not os.path.exists(self._abspath("pdq", fname)):
+                    _copy_file(
+                        self._disk_abspath("pdq", fname),
+                        self._abspath("tmp", fname + ".spill"),
+                        self._abspath("pdq", fname)
+                        )
+                    count += 1
+                self._spilled.add(fname)
+            if count:
+                logger.info("Replayed %d spilled events" % count)
+            return count
+        finally:
+            lock.release()
+
+    def _remove_spilled(self, fname):
+        if fname in self._spilled:
+            self._spilled.discard(fname)
+            try:
+                os.remove(self._disk_abspath("pdq", fname))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
     def resurrect(self, service_key=None):
         # move dead events of given service key back to queue.
         errnames = self._queued_files("err")
@@ -343,34 +1193,482 @@ class PDQueue(PDQueueBase):
                 # Don't resurrect badly named file
                 # TODO: log about this if logging will be available
                 pass
+        count += self._resurrect_packed(service_key)
+        # give resurrected events of rejected service keys another chance.
+        self.rejected_keys_info.update()
+        self.rejected_keys_info.clear(service_key)
+        self.rejected_keys_info.store()
         return count
 
-    def cleanup(self, delete_before_sec):
-        delete_before_time = int(self.time.time()) - delete_before_sec
+    # Records the given totals of request compression by the agent, to be
+    # reported with the queue's stats.
+    def record_compression_stats(self, compression_stats):
+        self._compression_stats = compression_stats
+        if self._compression_db:
+            try:
+                self._compression_db.set(compression_stats)
+            except:
+                logger.warning(
+                    "Unable to save compression stats", exc_info=True
+                    )
+
+    def _get_compression_stats(self):
+        # the agent's totals, as recorded here or by the running agent.
+        if self._compression_stats is None and self._compression_db:
+            try:
+                return self._compression_db.get()
+            except:
+                logger.warning(
+                    "Unable to load compression stats", exc_info=True
+                    )
+        return self._compression_stats
+
+    # Changes the back-off settings for later back-offs. Service keys that are
+    # already backing off keep their retry times and attempt counts.
+    def reconfigure_backoff(self, backoff_interval,
+            retry_limit_for_possible_errors):
+        self.backoff_info.reconfigure(
+            backoff_interval, retry_limit_for_possible_errors
+            )
+
+    # Removes deduplication index markers that can no longer match, and then
+    # markers of the oldest buckets beyond dedup_max_entries (if not 0).
+    def prune_dedup_index(self):
+        if self.dedup_window_secs <= 0:
+            return
+        current_bucket = int(self.time.time()) // self.dedup_window_secs
+        markers = []
+        for fname in self._queued_files("dup"):
+            try:
+                bucket = int(fname.split("_", 1)[0])
+            except ValueError:
+                bucket = None
+            if bucket is not None and bucket >= current_bucket - 1:
+                markers.append((bucket, fname))
+            else:
+                self._remove_dedup_marker(fname)
+        if self.dedup_max_entries > 0:
+            markers.sort()
+            for _, fname in markers[:-self.dedup_max_entries]:
+                self._remove_dedup_marker(fname)
+
+    def _remove_dedup_marker(self, fname):
+        try:
+            os.remove(self._abspath("dup", fname))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning(
+                    "Could not remove dedup marker %s: %s" % (fname, str(e))
+                    )
 
-        def _cleanup_files(ftype):
-            fnames = self._queued_files(ftype)
+    def _resurrect_packed(self, service_key):
+        # moves dead events of given service key from packs back to queue.
+        lock = self._new_pack_lock()
+        lock.acquire()
+        try:
+            count = 0
+            for (pack_name, ftype, index) in self._pack_indexes(["err"]):
+                fnames = set()
+                for fname in index["events"]:
+                    try:
+                        _, svc_key = _get_event_metadata(fname)
+                    except _BadFileNameError:
+                        continue
+                    if not service_key or svc_key == service_key:
+                        fnames.add(fname)
+                if not fnames:
+                    continue
+                # events are unpacked while the rest of the pack is written
+                # again, one event at a time.
+                unpacked = []
+
+                def remaining_entries():
+                    for (fname, data) in self._read_pack(pack_name, index):
+                        if fname in fnames:
+                            self._unpack_event(fname, data)
+                            unpacked.append(fname)
+                        else:
+                            yield fname, data
+                self._rewrite_pack(pack_name, ftype, remaining_entries())
+                count += len(unpacked)
+            return count
+        finally:
+            lock.release()
+
+    def _unpack_event(self, fname, data):
+        # events keep their name, and so their place in the queue.
+        logger.info("Unpacking event %s to pdq..." % fname)
+        tmp_abs = self._abspath("tmp", fname)
+        if os.path.exists(tmp_abs):
+            os.remove(tmp_abs)  # left over from an interrupted unpack.
+        fd = _open_creat_excl(tmp_abs, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp_abs, self._abspath("pdq", fname))
+
+    # Archives succeeded and failed events older than pack_after_secs into
+    # compressed pack files of up to pack_max_events each, and returns the
+    # number of events archived.
+    def pack(self):
+        if self.pack_after_secs <= 0:
+            return 0
+        pack_before_time = int(self.time.time()) - self.pack_after_secs
+        lock = self._new_pack_lock()
+        lock.acquire()
+        try:
+            count = 0
+            for ftype in _PACKED_TYPES:
+                fnames = []
+                for fname in self._queued_files(ftype):
+                    try:
+                        enqueue_time, _ = _get_event_metadata(fname)
+                    except _BadFileNameError:
+                        continue
+                    if enqueue_time < pack_before_time:
+                        fnames.append(fname)
+                max_events = self.pack_max_events or len(fnames)
+                for i in range(0, len(fnames), max_events):
+                    count += self._pack_files(ftype, fnames[i:i + max_events])
+            return count
+        finally:
+            lock.release()
+
+    def _pack_files(self, ftype, fnames):
+        packed = []
+
+        def entries():
+            # one event file is open at a time.
             for fname in fnames:
+                try:
+                    f = open(self._abspath(ftype, fname), "rb")
+                except (IOError, OSError) as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                with f:
+                    yield fname, f
+                packed.append(fname)
+
+        pack_name = self._write_pack(ftype, entries())
+        if not pack_name:
+            return 0
+        logger.info(
+            "Packed %d %s events into %s" % (len(packed), ftype, pack_name)
+            )
+        for fname in packed:
+            try:
+                os.remove(self._abspath(ftype, fname))
+                self.usage.remove(ftype, fname)
+            except OSError as e:
+                logger.warning(
+                    "Could not remove packed %s file %s: %s" %
+                    (ftype, fname, str(e))
+                    )
+        return len(packed)
+
+    # A pack is a gzip file of the concatenated events, and its index is a JSON
+    # file of the events' offsets and lengths in the uncompressed pack. A pack
+    # is complete once its index exists.
+    #
+    # Given (file name, readable file) of the events, in queue order, each
+    # event is copied into the pack in chunks, so that neither the events nor
+    # an event need be in memory as a whole. Returns the name of the pack, or
+    # None if there were no events.
+    def _write_pack(self, ftype, entries):
+        import gzip
+        pack_fname, pack_abs, fd = self._create_with_retry(
+            "pack", ftype + "_%d.pack", 0o644
+            )
+        pack_name = pack_fname[:-len(".pack")]
+        events = {}
+        newest_enqueue_time = 0
+        offset = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+                    for (fname, event_file) in entries:
+                        length = _copy_stream(event_file, gz)
+                        events[fname] = [offset, length]
+                        offset += length
+                        enqueue_time, _ = _get_event_metadata(fname)
+                        newest_enqueue_time = \
+                            max(newest_enqueue_time, enqueue_time)
+                f.flush()
+                os.fsync(f.fileno())
+        except:
+            os.remove(pack_abs)
+            raise
+        if not events:
+            os.remove(pack_abs)
+            return None
+        index_abs = self._abspath("pack", pack_name + ".idx")
+        with open(index_abs + ".tmp", "w") as f:
+            json.dump({
+                "newest_enqueue_time": newest_enqueue_time,
+                "events": events,
+                }, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(index_abs + ".tmp", index_abs)
+        self.usage.add("pack", pack_fname)
+        self.usage.add("pack", pack_name + ".idx")
+        return pack_name
+
+    def _rewrite_pack(self, pack_name, ftype, entries):
+        # replaces given pack with one of the given (file name, data) entries,
+        # if any.
+        self._write_pack(
+            ftype, ((fname, io.BytesIO(data)) for (fname, data) in entries)
+            )
+        self._remove_pack(pack_name)
+
+    def _remove_pack(self, pack_name):
+        # the index goes first, so that the pack is no longer used.
+        for suffix in [".idx", ".pack"]:
+            try:
+                os.remove(self._abspath("pack", pack_name + suffix))
+                self.usage.remove("pack", pack_name + suffix)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _pack_indexes(self, ftypes=_PACKED_TYPES):
+        # returns (pack name, event type, index) of complete packs of given
+        # event types, oldest first.
+        indexes = []
+        for fname in self._queued_files("pack"):
+            if not fname.endswith(".idx"):
+                continue
+            pack_name = fname[:-len(".idx")]
+            ftype = pack_name.split("_", 1)[0]
+            if ftype not in ftypes:
+                continue
+            try:
+                with open(self._abspath("pack", fname)) as f:
+                    index = json.load(f)
+            except (IOError, OSError) as e:
+                if e.errno == errno.ENOENT:
+                    continue  # removed since listing.
+                raise
+            except ValueError:
+                logger.warning("Ignoring unreadable pack index %s" % fname)
+                continue
+            indexes.append((pack_name, ftype, index))
+        return indexes
+
+    def _read_pack(self, pack_name, index):
+        # yields (file name, data) of the events in given pack, in queue
+        # order, reading one event at a time.
+        import gzip
+        events = sorted(index["events"].items(), key=lambda e: e[1][0])
+        with gzip.open(self._abspath("pack", pack_name + ".pack"), "rb") as f:
+            for (fname, (offset, length)) in events:
+                if f.tell() != offset:
+                    f.seek(offset)
+                yield fname, f.read(length)
+
+    # Returns (state, data) of the event with given file name, wherever it is
+    # in the queue or packs, or None if there is no such event.
+    def read_event(self, fname):
+        # names that can't be queue file names (e.g. paths, which would let
+        # callers read other files) are never found.
+        if not _is_valid_event_fname(fname):
+            return None
+        for ftype in ["pdq", "suc", "err"]:
+            try:
+                with open(self._abspath(ftype, fname), "rb") as f:
+                    return ftype, f.read()
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        for (pack_name, ftype, index) in self._pack_indexes():
+            if fname in index["events"]:
+                import gzip
+                offset, length = index["events"][fname]
+                pack_abs = self._abspath("pack", pack_name + ".pack")
+                with gzip.open(pack_abs, "rb") as f:
+                    f.seek(offset)
+                    return ftype, f.read(length)
+        return None
+
+    # Returns (file name, state, packed) of the events of given service key
+    # (or of all service keys), in queue order.
+    def list_events(self, service_key=None):
+        events = []
+        for ftype in ["pdq", "suc", "err"]:
+            events.extend(
+                (fname, ftype, False) for fname in self._queued_files(ftype)
+                )
+        for (_, ftype, index) in self._pack_indexes():
+            events.extend((fname, ftype, True) for fname in index["events"])
+        if service_key:
+            events = [
+                e for e in events
+                if e[0].endswith("_%s.txt" % service_key)
+                ]
+        return sorted(events)
+
+    # Removes succeeded, failed and temp files, and packs, older than
+    # delete_before_sec. With slice_secs, files are removed for at most
+    # slice_secs at a time, with a pause of pause_secs in between, so that
+    # cleanup does not take over the disk. Returns stats of the run, which
+    # are incomplete if it is stopped.
+    def cleanup(
+            self,
+            delete_before_sec,
+            slice_secs=0,
+            pause_secs=0,
+            stop_check_func=lambda: False
+            ):
+        slicer = _TimeSlicer(self.time, slice_secs, pause_secs, stop_check_func)
+        delete_before_time = int(self.time.time()) - delete_before_sec
+        stats = {
+            "removed_files_count": 0,
+            "removed_packs_count": 0,
+            "completed": False
+            }
+
+        def _cleanup_files(ftype, dir_abs):
+            for fname in sorted(os.listdir(dir_abs)):
                 try:
                     enqueue_time, _ = _get_event_metadata(fname)
                 except _BadFileNameError:
                     logger.info(
                         "Cleanup: ignoring invalid file name %s" % fname)
-                else:
-                    if enqueue_time < delete_before_time:
-                        try:
-                            logger.info("Cleanup: removing file %s" % fname)
-                            os.remove(self._abspath(ftype, fname))
-                        except IOError as e:
-                            logger.warning(
-                                "Could not clean up %s file %s: %s" %
-                                (ftype, fname, str(e))
-                                )
+                    continue
+                if enqueue_time >= delete_before_time:
+                    continue
+                fname_abs = os.path.join(dir_abs, fname)
+                try:
+                    if ftype == "tmp" and not fname.endswith(".txt") and \
+                            os.path.getmtime(fname_abs) >= delete_before_time:
+                        # the agent's own copy of an event, which may be in
+                        # progress.
+                        continue
+                    logger.info("Cleanup: removing file %s" % fname)
+                    os.remove(fname_abs)
+                    self.usage.remove(ftype, fname)
+                    stats["removed_files_count"] += 1
+                except (IOError, OSError) as e:
+                    logger.warning(
+                        "Could not clean up %s file %s: %s" %
+                        (ftype, fname, str(e))
+                        )
+                if not slicer.next():
+                    return False
+            return True
 
         # clean up bad / temp / success files created before delete-before-time.
-        _cleanup_files("err")
-        _cleanup_files("tmp")
-        _cleanup_files("suc")
+        dirs = [
+            ("err", self._abspath("err", "")),
+            ("tmp", self._abspath("tmp", "")),
+            ("suc", self._abspath("suc", "")),
+            ]
+        if self.ram_queue_dir:
+            # temp copies of spilled events are in the queue directory.
+            dirs.append(("tmp", self._disk_abspath("tmp", "")))
+        completed = all(
+            _cleanup_files(ftype, dir_abs) for (ftype, dir_abs) in dirs
+            ) and self._cleanup_packs(delete_before_time, slicer, stats)
+
+        # re-sync usage with the queue, e.g. after 'pd-queue retry'.
+        if self._has_quota():
+            self.usage.scan()
+            self._enforce_quota()
+
+        stats["completed"] = completed
+        stats["duration_secs"] = round(slicer.elapsed_secs(), 3)
+        self.last_cleanup_stats = stats
+        return stats
+
+    def _new_pack_lock(self):
+        return _ThreadSafeLock(
+            self.lock_class(self._pack_lockfile), self._pack_thread_lock
+            )
+
+    def _has_quota(self):
+        return self.quota_max_bytes > 0 or self.quota_max_entries > 0
+
+    def _is_near_quota(self):
+        usage = self.usage.to_dict()
+        return (
+            self.quota_max_bytes > 0 and
+            usage["bytes"] > self.quota_max_bytes * _QUOTA_PRUNE_RATIO
+            ) or (
+            self.quota_max_entries > 0 and
+            usage["entries"] > self.quota_max_entries * _QUOTA_PRUNE_RATIO
+            )
+
+    # Prunes the oldest succeeded events, and then packs of them, while the
+    # queue is near its quota, and publishes the queue's usage.
+    def _enforce_quota(self):
+        pruned = 0
+        if self._is_near_quota():
+            for fname in self._queued_files("suc"):
+                if not self._is_near_quota():
+                    break
+                try:
+                    os.remove(self._abspath("suc", fname))
+                    pruned += 1
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                self.usage.remove("suc", fname)
+        if self._is_near_quota():
+            lock = self._new_pack_lock()
+            lock.acquire()
+            try:
+                for (pack_name, _, index) in self._pack_indexes(["suc"]):
+                    if not self._is_near_quota():
+                        break
+                    self._remove_pack(pack_name)
+                    pruned += len(index["events"])
+            finally:
+                lock.release()
+        if pruned:
+            logger.info("Quota: pruned %d succeeded events" % pruned)
+        usage = self.usage.to_dict()
+        if self._is_near_quota():
+            logger.warning(
+                "Queue is near its quota, with %d bytes in %d entries" %
+                (usage["bytes"], usage["entries"])
+                )
+        usage["updated_at"] = int(self.time.time())
+        _write_queue_usage(self._abspath("", QUEUE_USAGE_FILE), usage)
+
+    def _cleanup_packs(self, delete_before_time, slicer, stats):
+        # packs expire as a whole, once their newest event expires. Returns
+        # false if the slicer stopped cleanup.
+        lock = self._new_pack_lock()
+        lock.acquire()
+        try:
+            indexed = set()
+            for (pack_name, _, index) in self._pack_indexes():
+                indexed.add(pack_name)
+                if index.get("newest_enqueue_time", 0) < delete_before_time:
+                    logger.info("Cleanup: removing pack %s" % pack_name)
+                    self._remove_pack(pack_name)
+                    stats["removed_packs_count"] += 1
+                    if not slicer.next():
+                        return False
+            # remove what is left over from interrupted pack writes.
+            for fname in self._queued_files("pack"):
+                pack_name = fname.split(".", 1)[0]
+                if pack_name in indexed or fname.endswith(".idx"):
+                    continue
+                fname_abs = self._abspath("pack", fname)
+                try:
+                    if os.path.getmtime(fname_abs) < delete_before_time:
+                        logger.info("Cleanup: removing file %s" % fname)
+                        os.remove(fname_abs)
+                        stats["removed_files_count"] += 1
+                except OSError as e:
+                    logger.warning(
+                        "Could not clean up pack file %s: %s" % (fname, str(e))
+                        )
+            return True
+        finally:
+            lock.release()
 
     def get_stats(
             self,
@@ -411,7 +1709,62 @@ class PDQueue(PDQueueBase):
             "aggregate": {
                 "successful_events_count": 20,
                 "failed_events_count": 2,
+                "compacted_events_count": 5,
+                "expired_events_count": 1,
+                "storm_suppressed_events_count": 250,
+                "redundant_events_count": 12,
+                "invalid_events_count": 3,
                 "started_on": "2014-03-18T20:49:02Z"
+            },
+            "last_flush": {
+                "policy": "fifo",
+                "events_count": 4,
+                "duration_secs": 1.25,
+                "limit_reached": False,
+                "avg_queueing_delay_secs": 12,
+                "max_queueing_delay_secs": 40,
+                "validated_events_count": 4,
+                "validation_secs": 0.000312
+            },
+            "storms": {
+                "svckey2": {
+                    "started_on": "2014-03-18T21:02:40Z",
+                    "suppressed_events_count": 250
+                }
+            },
+            "rejected_service_keys": {
+                "svckey3": 1800
+            },
+            "incident_states": {
+                "entries_count": 120,
+                "lookups_count": 40,
+                "hits_count": 12
+            },
+            "payload_cache": {
+                "entries_count": 2,
+                "bytes": 2048,
+                "max_bytes": 8388608,
+                "hits_count": 30,
+                "misses_count": 2,
+                "evictions_count": 0
+            },
+            "usage": {
+                "bytes": 40960,
+                "entries": 12,
+                "states": {
+                    "pdq": {"bytes": 8192, "entries": 3},
+                    "suc": {"bytes": 12288, "entries": 3},
+                    "err": {"bytes": 12288, "entries": 4},
+                    "pack": {"bytes": 8192, "entries": 2}
+                },
+                "updated_at": 1395175742
+            },
+            "compression": {
+                "compressed_requests_count": 120,
+                "uncompressed_bytes": 245760,
+                "compressed_bytes": 40960,
+                "compression_ratio": 6.0,
+                "compression_secs": 0.052
             }
         }
 
@@ -472,8 +1825,18 @@ class PDQueue(PDQueueBase):
 
         snapshot_stats = dict()
 
+        # names of archived and receipted events, by event type.
+        packed_files = {}
+        if detailed_snapshot:
+            for (_, ftype, index) in self._pack_indexes():
+                packed_files.setdefault(ftype, []).extend(index["events"])
+            packed_files.setdefault("suc", []).extend(
+                receipt["event"] for receipt in self.receipt_log.read()
+                )
+
         def add_stat(queue_file_type, stat_name):
-            for fname in self._queued_files(queue_file_type):
+            for fname in self._queued_files(queue_file_type) + \
+                    packed_files.get(queue_file_type, []):
                 try:
                     metadata = _get_event_metadata(fname)
                 except _BadFileNameError:
@@ -518,7 +1881,9 @@ class PDQueue(PDQueueBase):
                 if retry_at > now:
                     throttled_keys.add(key)
             if per_service_key_snapshot:
-                snapshot_stats[svc_key]["throttled"] = True
+                for svc_key in snapshot_stats:
+                    snapshot_stats[svc_key]["throttled"] = \
+                        svc_key in throttled_keys
             else:
                 snapshot_stats["throttled_service_keys_count"] = len(throttled_keys)
 
@@ -527,8 +1892,71 @@ class PDQueue(PDQueueBase):
             }
 
         # historical counter data for completed events (success, failure)
-        if self.counter_info._data:
-            stats["aggregate"] = self.counter_info._data
+        aggregate = self.counter_info.get()
+        if aggregate:
+            stats["aggregate"] = aggregate
+
+        # stats of the latest pass over the queue, if any.
+        if self.last_flush_stats:
+            stats["last_flush"] = self.last_flush_stats
+
+        # time from startup to the first send, once there has been one.
+        if self.time_to_first_send_secs is not None:
+            stats["startup"] = {
+                "time_to_first_send_secs":
+                    round(self.time_to_first_send_secs, 3),
+                "head_events_count": self.head_events_count
+                }
+
+        # stats of the latest cleanup, if any.
+        if self.last_cleanup_stats:
+            stats["last_cleanup"] = self.last_cleanup_stats
+
+        # totals of request compression by the agent, if any.
+        compression_stats = self._get_compression_stats()
+        if compression_stats:
+            stats["compression"] = compression_stats
+
+        # ongoing event storms, if any. (copied first, as a flush on another
+        # thread can change them meanwhile.)
+        storms = list(self._storms.items())
+        if storms:
+            stats["storms"] = dict(
+                (svc_key, {
+                    "started_on": storm["started_on"],
+                    "suppressed_events_count":
+                        storm["suppressed_events_count"]
+                    })
+                for (svc_key, storm) in storms
+                )
+
+        # service keys whose events are failed without sending, if any, with
+        # the number of seconds until they are sent again.
+        now = int(self.time.time())
+        rejected_keys = dict(
+            (svc_key, until - now)
+            for (svc_key, until) in self.rejected_keys_info.get().items()
+            if until > now and not (
+                per_service_key_snapshot and service_key and
+                svc_key != service_key
+                )
+            )
+        if rejected_keys:
+            stats["rejected_service_keys"] = rejected_keys
+
+        # disk usage of the queue, as last published, if there is a quota.
+        if self._has_quota():
+            usage = _read_queue_usage(self._abspath("", QUEUE_USAGE_FILE))
+            if usage:
+                stats["usage"] = usage
+
+        # use of the payload cache, if enabled.
+        if self.payload_cache.max_bytes > 0:
+            stats["payload_cache"] = self.payload_cache.to_dict()
+
+        # use of incident states to skip redundant events, if enabled.
+        if self.incident_state_info.enabled:
+            stats["incident_states"] = self.incident_state_info.to_dict()
 
         return stats
 
@@ -539,7 +1967,142 @@ class PDQueue(PDQueueBase):
         logger.info("Changing %s type: %s -> %s..." % (event_name, frm, to))
         old_abs = self._abspath(frm, event_name)
         new_abs = self._abspath(to, event_name)
-        os.rename(old_abs, new_abs)
+        if frm == "pdq" and event_name in self._spilled and \
+                to not in RAM_QUEUE_SUBDIRS:
+            # the spilled copy is already on the right file system.
+            self._spilled.discard(event_name)
+            os.rename(self._disk_abspath(frm, event_name), new_abs)
+            os.remove(old_abs)
+        else:
+            try:
+                os.rename(old_abs, new_abs)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # in the RAM queue mode, pdq is on another file system.
+                tmp_abs = self._abspath("tmp", event_name + ".move") \
+                    if to in RAM_QUEUE_SUBDIRS else \
+                    self._disk_abspath("tmp", event_name + ".move")
+                _copy_file(old_abs, tmp_abs, new_abs)
+                os.remove(old_abs)
+            if frm == "pdq":
+                self._remove_spilled(event_name)
+        if frm == "pdq":
+            self._pass_dequeued.add(event_name)
+        self.usage.move(event_name, frm, to)
+
+
+def _parse_event_info(s):
+    # returns (event_type, incident_key) of given event JSON, with None for
+    # anything missing or invalid.
+    try:
+        if isinstance(s, bytes):
+            s = s.decode("utf-8")
+        event = json.loads(s)
+        return tuple(
+            v if isinstance(v, _STRING_TYPES) else None
+            for v in (event.get("event_type"), event.get("incident_key"))
+            )
+    except (ValueError, AttributeError):
+        # (UnicodeDecodeError is a ValueError.)
+        return (None, None)
+
+
+def _decode_event(data):
+    # returns the text of given event bytes, or the bytes if they are not
+    # UTF-8 (which the event parsing then treats as invalid JSON.)
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data
+
+
+def _encode_event(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode("utf-8")
+
+
+def _dedup_hash(service_key, s):
+    # identical events differ only in their queue time.
+    import hashlib
+    try:
+        event = json.loads(s)
+        event.get("agent", {}).pop("queued_at", None)
+        s = json.dumps(event, sort_keys=True)
+    except (ValueError, AttributeError):
+        pass
+    return hashlib.sha1((service_key + "\n" + s).encode()).hexdigest()
+
+
+def _read_dedup_marker(fname_abs):
+    # returns the time recorded in the given marker, or None if there is no
+    # such marker.
+    try:
+        with open(fname_abs) as f:
+            return int(f.read())
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    except ValueError:
+        return None
+
+
+def _copy_stream(src, dst, chunk_size=64 * 1024):
+    # copies the rest of file src to dst, and returns the number of bytes.
+    length = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            return length
+        dst.write(chunk)
+        length += len(chunk)
+
+
+def _read_queue_usage(fname_abs):
+    # returns the queue usage published in given file, or None if there is
+    # no (readable) usage.
+    try:
+        with open(fname_abs) as f:
+            usage = json.load(f)
+        if isinstance(usage.get("bytes"), int) and \
+                isinstance(usage.get("entries"), int):
+            return usage
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def _write_queue_usage(fname_abs, usage):
+    # the file is replaced as a whole, and is world-readable, so that any
+    # enqueuer can read it. The flush and cleanup can write it at the same
+    # time, so each write goes through its own temp file.
+    import tempfile  # (only the agent writes this; keep enqueuers light.)
+    fd, tmp_abs = tempfile.mkstemp(
+        prefix=os.path.basename(fname_abs) + ".",
+        dir=os.path.dirname(fname_abs)
+        )
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(usage, f, separators=(",", ":"), sort_keys=True)
+        os.chmod(tmp_abs, 0o644)
+        os.rename(tmp_abs, fname_abs)
+    except:
+        try:
+            os.unlink(tmp_abs)
+        except OSError:
+            pass
+        raise
+
+
+def _copy_file(src_abs, tmp_abs, dst_abs):
+    # copies a file through a temp file on the destination's file system, so
+    # that the destination appears complete or not at all.
+    import shutil
+    shutil.copyfile(src_abs, tmp_abs)
+    os.chmod(tmp_abs, 0o644)
+    os.rename(tmp_abs, dst_abs)
 
 
 def _open_creat_excl(fname_abs, mode):
@@ -563,6 +2126,56 @@ def _link(orig_abs, new_abs):
             raise
 
 
+def _round_robin_order(fnames):
+    # i-th events of all service keys come before (i+1)-th events, and
+    # service keys take turns in the order of their oldest event.
+    key_order = {}
+    key_counts = {}
+    ranks = {}
+    for fname in fnames:
+        try:
+            _, svc_key = _get_event_metadata(fname)
+        except _BadFileNameError:
+            svc_key = None
+        if svc_key not in key_order:
+            key_order[svc_key] = len(key_order)
+        rank = key_counts.get(svc_key, 0)
+        key_counts[svc_key] = rank + 1
+        ranks[fname] = (rank, key_order[svc_key])
+    return sorted(fnames, key=ranks.get)
+
+
+def _priority_order(fnames, get_event_info):
+    # Events of an incident form a chain that must stay in enqueue order;
+    # among the first events of all chains, the one with the most important
+    # event type (oldest first, for the same type) is processed next.
+    chains = {}
+    for index, fname in enumerate(fnames):
+        try:
+            _, svc_key = _get_event_metadata(fname)
+            event_type, incident_key = get_event_info(fname)
+        except _BadFileNameError:
+            svc_key, event_type, incident_key = None, None, None
+        if incident_key is None:
+            chain_key = fname  # unrelated to any other event.
+        else:
+            chain_key = (svc_key, incident_key)
+        rank = _EVENT_TYPE_PRIORITIES.get(event_type, 0)
+        chains.setdefault(chain_key, []).append((rank, index, fname))
+
+    heap = []
+    for chain in chains.values():
+        chain.reverse()  # so that the next event can be popped off the end.
+        heapq.heappush(heap, chain.pop() + (chain,))
+    ordered = []
+    while heap:
+        _, _, fname, chain = heapq.heappop(heap)
+        ordered.append(fname)
+        if chain:
+            heapq.heappush(heap, chain.pop() + (chain,))
+    return ordered
+
+
 class _BadFileNameError(Exception):
     pass
 
@@ -579,6 +2192,17 @@ def _get_event_metadata(fname):
         raise _BadFileNameError
 
 
+def _is_valid_event_fname(fname):
+    if fname.startswith(".") or os.sep in fname or \
+            (os.altsep and os.altsep in fname):
+        return False
+    try:
+        _get_event_metadata(fname)
+    except _BadFileNameError:
+        return False
+    return True
+
+
 class _BackoffInfo(object):
     """
     Loads, accesses, modifies and saves back-off info for
@@ -615,6 +2239,16 @@ class _BackoffInfo(object):
         self._current_retry_at = data['next_retries']
         self.update()
 
+    def reconfigure(self, backoff_interval, retry_limit_for_possible_errors):
+        if (backoff_interval, retry_limit_for_possible_errors) != \
+                (self._backoff_interval, self._retry_limit_for_possible_errors):
+            logger.info(
+                "Back-off interval is now %d sec, retry limit %d" %
+                (backoff_interval, retry_limit_for_possible_errors)
+                )
+        self._backoff_interval = backoff_interval
+        self._retry_limit_for_possible_errors = retry_limit_for_possible_errors
+
     # returns true if `current-attempts`, or `previous-attempts + 1`,
     # results in a threshold breach of retry-limit.
     def is_threshold_breached(self, svc_key):
@@ -673,6 +2307,403 @@ class _BackoffInfo(object):
                 exc_info=True)
 
 
+class _RejectedKeysInfo(object):
+    """
+    Loads, accesses, modifies and saves the service keys that PagerDuty
+    rejected, along with the time until which their events are failed
+    without being sent.
+    """
+
+    def __init__(self, rejected_keys_db, ttl_secs, time_calc):
+        self._db = rejected_keys_db
+        self._ttl_secs = ttl_secs
+        self._time = time_calc
+        self._rejected_until = {}
+        self._changed = False
+        self.update()
+
+    def is_rejected(self, svc_key):
+        return self._rejected_until.get(svc_key, 0) > self._time.time()
+
+    def reject(self, svc_key):
+        if self._ttl_secs > 0:
+            logger.info(
+                "Failing events of service key %s for %d sec" %
+                (svc_key, self._ttl_secs)
+                )
+            self._rejected_until[svc_key] = \
+                int(self._time.time() + self._ttl_secs)
+            self._changed = True
+
+    # forgets the rejection of given service key, or of all keys if None.
+    def clear(self, svc_key=None):
+        for key in list(self._rejected_until.keys()):
+            if svc_key is None or key == svc_key:
+                del self._rejected_until[key]
+                self._changed = True
+
+    # returns the rejection expiry time of every rejected service key.
+    def get(self):
+        return dict(self._rejected_until)
+
+    # reloads persisted data, which can be changed by other processes (e.g.
+    # pd-queue retry), and drops expired rejections.
+    def update(self):
+        if self._db is None or self._ttl_secs <= 0:
+            return
+        try:
+            data = self._db.get()
+        except:
+            logger.warning(
+                "Unable to load rejected service keys",
+                exc_info=True
+                )
+            data = None
+        time_now = self._time.time()
+        self._rejected_until = dict(
+            (svc_key, until) for (svc_key, until) in (data or {}).items()
+            if until > time_now
+            )
+        self._changed = len(self._rejected_until) != len(data or {})
+
+    # persists rejected service keys, if they have changed.
+    def store(self):
+        if self._db is None or not self._changed:
+            return
+        try:
+            self._db.set(self._rejected_until)
+            self._changed = False
+        except:
+            logger.warning(
+                "Unable to save rejected service keys",
+                exc_info=True)
+
+
+class _IncidentStateInfo(object):
+    """
+    Loads, accesses, modifies and saves the last successfully sent event type
+    of incidents, by service key and incident key. Only the most recently
+    updated max_entries incidents are kept, each for up to ttl_secs (if not
+    0).
+    """
+
+    def __init__(self, incident_states_db, max_entries, ttl_secs, time_calc):
+        self._db = incident_states_db
+        self._max_entries = max_entries
+        self._ttl_secs = ttl_secs
+        self._time = time_calc
+        self.enabled = incident_states_db is not None and max_entries > 0
+        self.lookups = 0
+        self.hits = 0
+        self._changed = False
+        # (svc_key, incident_key) -> (event_type, update time), oldest first.
+        self._states = OrderedDict()
+        if self.enabled:
+            try:
+                data = self._db.get()
+                for (svc_key, incident_key, event_type, t) in \
+                        (data or {}).get("states", []):
+                    self._states[(svc_key, incident_key)] = (event_type, t)
+            except:
+                logger.warning(
+                    "Unable to load incident states",
+                    exc_info=True
+                    )
+                self._states = OrderedDict()
+            self._evict()
+
+    # returns true if given event cannot change its incident, going by the
+    # incident's last known state: acknowledging or resolving a resolved
+    # incident does nothing.
+    def is_redundant(self, svc_key, incident_key, event_type):
+        if not self.enabled or incident_key is None or \
+                event_type not in ("acknowledge", "resolve"):
+            return False
+        self.lookups += 1
+        last_event_type, t = \
+            self._states.get((svc_key, incident_key), (None, None))
+        if last_event_type != "resolve" or self._is_expired(t):
+            return False
+        self.hits += 1
+        return True
+
+    # records the type of a successfully sent event as its incident's state.
+    def update(self, svc_key, incident_key, event_type):
+        if not self.enabled or incident_key is None or event_type is None:
+            return
+        key = (svc_key, incident_key)
+        self._states.pop(key, None)
+        self._states[key] = (event_type, int(self._time.time()))
+        self._changed = True
+        self._evict()
+
+    def to_dict(self):
+        return {
+            "entries_count": len(self._states),
+            "lookups_count": self.lookups,
+            "hits_count": self.hits
+            }
+
+    # persists incident states, if they have changed.
+    def store(self):
+        if not self._changed:
+            return
+        try:
+            self._db.set({
+                "states": [
+                    [svc_key, incident_key, event_type, t]
+                    for ((svc_key, incident_key), (event_type, t))
+                    in self._states.items()
+                    ]
+                })
+            self._changed = False
+        except:
+            logger.warning(
+                "Unable to save incident states",
+                exc_info=True)
+
+    def _is_expired(self, t):
+        return self._ttl_secs > 0 and t < self._time.time() - self._ttl_secs
+
+    # drops the oldest states beyond max_entries, and expired states.
+    def _evict(self):
+        while self._states:
+            key = next(iter(self._states))
+            if len(self._states) <= self._max_entries and \
+                    not self._is_expired(self._states[key][1]):
+                break
+            del self._states[key]
+            self._changed = True
+
+
+class _HeadCheckpoint(object):
+    """
+    Loads and saves the names of the oldest pending events, so that the agent
+    can start sending them after a restart before it scans the queue.
+    """
+
+    def __init__(self, head_db, max_events):
+        self._db = head_db
+        self.max_events = max_events
+        self.enabled = head_db is not None and max_events > 0
+        self._events = []
+
+    def load(self):
+        if not self.enabled:
+            return []
+        try:
+            data = self._db.get()
+        except:
+            logger.warning("Unable to load head checkpoint", exc_info=True)
+            data = None
+        events = data.get("events") if isinstance(data, dict) else None
+        self._events = [
+            fname for fname in (events or [])
+            if isinstance(fname, _STRING_TYPES)
+            ][:self.max_events]
+        return list(self._events)
+
+    # persists given event names, if they have changed.
+    def store(self, events):
+        if not self.enabled or events == self._events:
+            return
+        try:
+            self._db.set({"events": events})
+            self._events = events
+        except:
+            logger.warning("Unable to save head checkpoint", exc_info=True)
+
+
+class _ReceiptLog(object):
+    # Append-only log of events removed on success, with a JSON record per
+    # line, e.g.:
+    # {"event":"1394151584121098_key1.txt","incident_key":"abc",
+    #  "latency_secs":1.25,"service_key":"key1","status":"sent"}
+    # The log is rotated to <path>.1 once it would grow beyond max_bytes (0
+    # means never.)
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def append(self, receipt):
+        line = json.dumps(receipt, separators=(",", ":"), sort_keys=True)
+        line += "\n"
+        if self.max_bytes > 0:
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                size = 0
+            if size and size + len(line) > self.max_bytes:
+                os.rename(self.path, self.path + ".1")
+        with open(self.path, "a") as f:
+            f.write(line)
+
+    # Returns the receipts in the rotated and current log, oldest first.
+    def read(self):
+        receipts = []
+        for path in [self.path + ".1", self.path]:
+            try:
+                with open(path) as f:
+                    lines = f.readlines()
+            except (IOError, OSError) as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            for line in lines:
+                try:
+                    receipt = json.loads(line)
+                except ValueError:
+                    continue  # e.g. a partly written last line.
+                if isinstance(receipt, dict) and "event" in receipt:
+                    receipts.append(receipt)
+        return receipts
+
+
+class _QueueUsage(object):
+    # Bytes and entries used by the queue, by state. The agent counts the
+    # queue once, and then keeps the counts up to date as it changes the
+    # queue, and as it finds newly queued events in its passes. Changes
+    # before the queue is counted are ignored.
+
+    def __init__(self, abspath_func):
+        # (pending events are in the RAM queue directory, if there is one.)
+        self._abspath = abspath_func
+        # {state: {file name: size}}, once counted.
+        self._sizes = None
+        self._bytes = None
+        # the agent's tasks change the queue from different threads.
+        self._lock = threading.RLock()
+
+    def scan(self):
+        with self._lock:
+            self._sizes = dict((ftype, {}) for ftype in _USAGE_TYPES)
+            self._bytes = dict((ftype, 0) for ftype in _USAGE_TYPES)
+            for ftype in _USAGE_TYPES:
+                for fname in os.listdir(self._abspath(ftype, "")):
+                    self.add(ftype, fname)
+
+    def sync_pending(self, queued_fnames):
+        # accounts for events queued and removed by others since the last
+        # sync, given all currently queued events.
+        with self._lock:
+            if self._sizes is None:
+                self.scan()
+                return
+            pending = self._sizes["pdq"]
+            for fname in queued_fnames:
+                if fname not in pending:
+                    self.add("pdq", fname)
+            if len(pending) > len(queued_fnames):
+                for fname in set(pending).difference(queued_fnames):
+                    self.remove("pdq", fname)
+
+    def add(self, ftype, fname):
+        with self._lock:
+            if self._sizes is None or ftype not in self._sizes:
+                return
+            try:
+                size = os.path.getsize(self._abspath(ftype, fname))
+            except OSError:
+                return
+            self._set(ftype, fname, size)
+
+    def remove(self, ftype, fname):
+        with self._lock:
+            if self._sizes is None or ftype not in self._sizes:
+                return
+            size = self._sizes[ftype].pop(fname, None)
+            if size is not None:
+                self._bytes[ftype] -= size
+
+    def move(self, fname, frm, to):
+        with self._lock:
+            if self._sizes is None:
+                return
+            size = self._sizes.get(frm, {}).get(fname)
+            self.remove(frm, fname)
+            if size is None:
+                self.add(to, fname)
+            elif to in self._sizes:
+                self._set(to, fname, size)
+
+    def _set(self, ftype, fname, size):
+        self.remove(ftype, fname)
+        self._sizes[ftype][fname] = size
+        self._bytes[ftype] += size
+
+    def to_dict(self):
+        with self._lock:
+            if self._sizes is None:
+                self.scan()
+            states = dict(
+                (ftype, {
+                    "bytes": self._bytes[ftype],
+                    "entries": len(self._sizes[ftype]),
+                    })
+                for ftype in _USAGE_TYPES
+                )
+        return {
+            "bytes": sum(s["bytes"] for s in states.values()),
+            "entries": sum(s["entries"] for s in states.values()),
+            "states": states,
+            }
+
+
+class _ThreadSafeLock(object):
+    """
+    A file lock that also excludes other threads of this process, using a
+    lock shared by them.
+    """
+
+    def __init__(self, file_lock, thread_lock):
+        self._file_lock = file_lock
+        self._thread_lock = thread_lock
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        try:
+            self._file_lock.acquire()
+        except:
+            self._thread_lock.release()
+            raise
+
+    def release(self):
+        try:
+            self._file_lock.release()
+        finally:
+            self._thread_lock.release()
+
+
+class _TimeSlicer(object):
+    """
+    Paces a long-running loop: next() is called after every unit of work,
+    pauses for pause_secs after every slice_secs of work (if not 0), and
+    returns false once the loop must stop.
+    """
+
+    def __init__(self, time_calc, slice_secs, pause_secs, stop_check_func):
+        self._time = time_calc
+        self._slice_secs = slice_secs
+        self._pause_secs = pause_secs
+        self._stop_check_func = stop_check_func
+        self._start_time = time_calc.time()
+        self._slice_start_time = self._start_time
+
+    def next(self):
+        if self._stop_check_func():
+            return False
+        if self._slice_secs > 0 and \
+                self._time.time() - self._slice_start_time >= self._slice_secs:
+            self._time.sleep(self._pause_secs)
+            self._slice_start_time = self._time.time()
+            if self._stop_check_func():
+                return False
+        return True
+
+    def elapsed_secs(self):
+        return self._time.time() - self._start_time
+
 
 class _CounterInfo(object):
     """
@@ -709,6 +2740,11 @@ class _CounterInfo(object):
         # persisted data invalid.
         self.store(reset_data_if_failed=True)
 
+    # returns a copy of the counters, which a flush on another thread can
+    # change meanwhile.
+    def get(self):
+        return dict(self._data)
+
     # increments success count by 1.
     def increment_success(self):
         self._increment("successful_events_count")
@@ -717,6 +2753,26 @@ class _CounterInfo(object):
     def increment_failure(self):
         self._increment("failed_events_count")
 
+    # increments count of events dropped by compaction by 1.
+    def increment_compacted(self):
+        self._increment("compacted_events_count")
+
+    # increments count of events expired before sending by 1.
+    def increment_expired(self):
+        self._increment("expired_events_count")
+
+    # increments count of events failed by local validation by 1.
+    def increment_invalid(self):
+        self._increment("invalid_events_count")
+
+    # increments count of events skipped as redundant by 1.
+    def increment_redundant(self):
+        self._increment("redundant_events_count")
+
+    # increments count of triggers aggregated in event storms by 1.
+    def increment_storm_suppressed(self):
+        self._increment("storm_suppressed_events_count")
+
     # increments count of given type by 1.
     def _increment(self, counter_type):
         self._data[counter_type] = self._data.get(counter_type, 0) + 1
@@ -777,3 +2833,210 @@ class SnapshotStats(object):
             return {
                 "count": self.count
                 }
+
+
+class PassStats(object):
+    """
+    Stats of a single pass over the queue.
+    """
+    def __init__(self, policy, time_calc):
+        self.policy = policy
+        self.count = 0
+        self.total_queueing_delay = 0
+        self.max_queueing_delay = 0
+        self.limit_reached = False
+        self.throttled = False
+        self.validated_count = 0
+        self.validation_secs = 0
+        self.prefetched_count = 0
+        self._time = time_calc
+        self._start_time = time_calc.time()
+
+    # records an event that is about to be processed.
+    def add_event(self, enqueue_time):
+        delay = max(self._time.time() - enqueue_time, 0)
+        self.count += 1
+        self.total_queueing_delay += delay
+        self.max_queueing_delay = max(self.max_queueing_delay, delay)
+
+    # records the time taken to validate an event.
+    def add_validation(self, secs):
+        self.validated_count += 1
+        self.validation_secs += secs
+
+    def elapsed_secs(self):
+        return self._time.time() - self._start_time
+
+    def to_dict(self):
+        d = {
+            "policy": self.policy,
+            "events_count": self.count,
+            "duration_secs": round(self.elapsed_secs(), 3),
+            "limit_reached": self.limit_reached
+            }
+        if self.count:
+            d["avg_queueing_delay_secs"] = \
+                int(self.total_queueing_delay / self.count)
+            d["max_queueing_delay_secs"] = int(self.max_queueing_delay)
+        if self.throttled:
+            d["throttled"] = True
+        if self.validated_count:
+            d["validated_events_count"] = self.validated_count
+            d["validation_secs"] = round(self.validation_secs, 6)
+        if self.prefetched_count:
+            d["prefetched_events_count"] = self.prefetched_count
+        return d
+
+
+class _PayloadCache(object):
+    """
+    Byte-budgeted LRU cache of event payloads by queued file name. Entries
+    are only used while the file's inode, size and modification time are
+    unchanged. A miss is a payload that was cached, but has to be read again
+    (as it was evicted, or its file changed.)
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # fname -> ((inode, size, mtime), payload), least recently used first.
+        self._entries = OrderedDict()
+        # names of events whose payloads were evicted.
+        self._evicted = set()
+
+    # returns the cached payload of given file with given stat, or None.
+    def get(self, fname, st):
+        if self.max_bytes <= 0:
+            return None
+        entry = self._entries.pop(fname, None)
+        if entry is not None and entry[0] == _stat_signature(st):
+            self._entries[fname] = entry
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            self.bytes -= len(entry[1])
+            self.misses += 1
+        elif fname in self._evicted:
+            self._evicted.discard(fname)
+            self.misses += 1
+        return None
+
+    def put(self, fname, st, payload):
+        if payload is None or len(payload) > self.max_bytes:
+            return
+        self.discard(fname)
+        self._entries[fname] = (_stat_signature(st), payload)
+        self.bytes += len(payload)
+        while self.bytes > self.max_bytes:
+            evicted_fname, (_, evicted) = self._entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.evictions += 1
+            self._evicted.add(evicted_fname)
+
+    def has(self, fname):
+        return fname in self._entries
+
+    def discard(self, fname):
+        self._evicted.discard(fname)
+        entry = self._entries.pop(fname, None)
+        if entry is not None:
+            self.bytes -= len(entry[1])
+
+    # forgets payloads of events that are no longer queued.
+    def prune(self, queued_fnames):
+        if self._entries or self._evicted:
+            queued = set(queued_fnames)
+            for fname in list(self._entries) + list(self._evicted):
+                if fname not in queued:
+                    self.discard(fname)
+
+    def to_dict(self):
+        return {
+            "entries_count": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits_count": self.hits,
+            "misses_count": self.misses,
+            "evictions_count": self.evictions
+            }
+
+
+class _Prefetcher(object):
+    """
+    Reads queued events in a background thread, ahead of their processing
+    in a pass, so that disk reads overlap with consuming earlier events. At
+    most max_events events are held in memory. fnames has None in place of
+    events not to be read, and events of service keys passed to skip() are
+    not read either.
+    """
+    def __init__(self, queue, fnames, max_events):
+        self._queue = queue
+        self._fnames = fnames
+        self._max_events = max_events
+        # service keys whose events won't be consumed in the rest of the pass.
+        self._skipped_svc_keys = set()
+        # index in fnames -> (stat, payload)
+        self._buffer = {}
+        # index of the next event to be processed.
+        self._position = 0
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="PDQueuePrefetcher"
+            )
+        self._thread.daemon = True
+        self._thread.start()
+
+    # returns the (stat, payload) read for the event at given index, if any,
+    # and lets read-ahead move past it.
+    def take(self, index):
+        with self._cond:
+            self._position = index + 1
+            entry = self._buffer.pop(index, None)
+            self._cond.notify()
+        return entry
+
+    # stops reading events of the given service key.
+    def skip(self, svc_key):
+        with self._cond:
+            self._skipped_svc_keys.add(svc_key)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        for (index, fname) in enumerate(self._fnames):
+            if fname is None:
+                continue
+            with self._cond:
+                while not self._stopped and \
+                        len(self._buffer) >= self._max_events:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                if index < self._position or \
+                        _get_event_metadata(fname)[1] in \
+                        self._skipped_svc_keys:
+                    continue
+            try:
+                fname_abs = self._queue._abspath("pdq", fname)
+                st = os.stat(fname_abs)
+                if st.st_size > self._queue.event_size_max_bytes:
+                    continue
+                with open(fname_abs, "rb") as f:
+                    data = f.read()
+            except (IOError, OSError):
+                # the event is handled (or was already) by the processing.
+                continue
+            with self._cond:
+                if index >= self._position:
+                    self._buffer[index] = (st, data)
+
+
+def _stat_signature(st):
+    return (st.st_ino, st.st_size, st.st_mtime)
@@ -27,14 +27,31 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+from collections import deque
+import heapq
 import logging
-from threading import Thread
+from threading import Condition, Thread
 import time
 
 
 logger = logging.getLogger(__name__)
 
 
+# What a RepeatingTaskScheduler does when a task's next call to tick() is due
+# while its previous call is still running:
+# - skip: drop the due call.
+# - coalesce: make one call as soon as the running call is complete, however
+#     many calls were due meanwhile.
+# - queue: make every call that was due, one after the other, as soon as the
+#     running call is complete.
+OVERRUN_POLICIES = ["skip", "coalesce", "queue"]
+
+# delays before a RepeatingTaskScheduler runs a task again after its tick()
+# raises an error; doubled for every consecutive error, up to the maximum.
+RESTART_BACKOFF_SECS = 1
+RESTART_BACKOFF_MAX_SECS = 300
+
+
 class RepeatingTask:
     """
     Code that runs repeatedly at a regular interval.
@@ -50,7 +67,8 @@ class RepeatingTask:
         """
         Create a RepeatingTask with given settings.
 
-        interval_secs = the interval between calls to tick()
+        interval_secs = the interval between calls to tick(), which may be a
+                        fraction of a second
         is_absolute = whether interval is "absolute" or "relative"
 
         When is_absolute=False, the task wants interval_secs to be the time
@@ -68,7 +86,7 @@ class RepeatingTask:
         check the implementations details of the task runner used to run the
         task for details on how overdue calls are handled.
         """
-        assert interval_secs >= 1
+        assert interval_secs > 0
         self._interval_secs = interval_secs
         self._is_absolute = is_absolute
         self._stop = False
@@ -87,10 +105,10 @@ class RepeatingTask:
         raise NotImplementedError
 
     def set_interval_secs(self, interval_secs):
-        assert interval_secs >= 1
+        assert interval_secs > 0
         if interval_secs != self._interval_secs:
             self._interval_secs = interval_secs
-            logger.info(
+            logger.debug(
                 "%s changed interval_secs to %s"
                 % (self.get_name(), interval_secs)
                 )
@@ -123,13 +141,15 @@ class RepeatingTaskThread(Thread):
 
     Notes:
     - the first call to tick() will happen as soon as you start the thread
-    - the task's interval_secs is sampled just after the end of a tick()
+    - the task's interval_secs is sampled just after the end of a tick(); call
+      reschedule() after changing it from outside tick()
+    - wake() and stop_async() take effect immediately between calls to tick()
 
     Handling of is_absolute=True:
-    If a call to tick() takes longer than interval_secs, the next call will
-    happen immediately. If a call takes long enough that more than one call is
-    overdue, the extra missed calls are lost. In all overdue cases, clock
-    alignment will be lost. See implementation and unit tests for details.
+    Calls are aligned to multiples of interval_secs from the first call. If a
+    call to tick() takes longer than interval_secs, the next call will happen
+    immediately, and the calls that were missed meanwhile are lost. Calls after
+    that are aligned again. See implementation and unit tests for details.
     """
 
     def __init__(self, repeating_task):
@@ -137,43 +157,93 @@ class RepeatingTaskThread(Thread):
         Thread.__init__(self, name=repeating_task.get_name())
         self._rtask = repeating_task
         self._customStop = False
+        self._woken = False
+        self._rescheduled = False
+        # guards the flags above, and is notified when any of them changes.
+        self._cond = Condition()
         logger.info("RepeatingTaskThread created for %s" % self.getName())
 
     def run(self):
+        # time of the last call to tick(): as scheduled for is_absolute=True,
+        # to keep alignment, and of its end for is_absolute=False.
+        last_run_time = None
         next_run_time = time.time()
         try:
-            while not self._customStop:
-                s = next_run_time - time.time()
-                if s <= 0:
-                    self._rtask.tick()
-                    if self._rtask.is_absolute():
-                        # drop extra missed ticks if we fall behind
-                        next_run_time = max(
-                            next_run_time + self._rtask.get_interval_secs(),
-                            time.time()
-                            )
-                        # the above logic ruins clock alignment but it's
-                        # simpler than trying to do float modulo math :)
-                    else:
-                        next_run_time = \
-                            time.time() + self._rtask.get_interval_secs()
+            while True:
+                with self._cond:
+                    while not self._customStop and not self._woken:
+                        if self._rescheduled:
+                            self._rescheduled = False
+                            next_run_time = \
+                                self._get_next_run_time(last_run_time)
+                        s = next_run_time - time.time()
+                        if s <= 0:
+                            break
+                        self._cond.wait(s)
+                    if self._customStop:
+                        break
+                    woken = self._woken
+                    self._woken = False
+                    self._rescheduled = False
+
+                if not self._rtask.is_absolute() or last_run_time is None:
+                    run_time = time.time()
+                elif woken and next_run_time > time.time():
+                    # an extra call; keep to the schedule.
+                    run_time = last_run_time
                 else:
-                    # Sleep at most 1 sec at a time to allow graceful stop
-                    time.sleep(min(s, 1.0))
+                    # if more than one call is overdue, drop the extra ones.
+                    interval_secs = self._rtask.get_interval_secs()
+                    missed = int(
+                        (time.time() - next_run_time) // interval_secs
+                        )
+                    run_time = next_run_time + max(missed, 0) * interval_secs
+
+                self._rtask.tick()
+                if self._rtask.is_absolute():
+                    last_run_time = run_time
+                else:
+                    last_run_time = time.time()
+                next_run_time = self._get_next_run_time(last_run_time)
         except:
             logger.error("Error in run(); Stopping.", exc_info=True)
 
+    def _get_next_run_time(self, last_run_time):
+        if last_run_time is None:
+            return time.time()
+        return last_run_time + self._rtask.get_interval_secs()
+
+    def wake(self):
+        """
+        Ask the thread to call tick() now.
+
+        This call does NOT block. If the thread is in the task's tick(), the
+        next call will happen as soon as tick() is complete. For
+        is_absolute=True, this does not change when the calls after that
+        happen.
+        """
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+
+    def reschedule(self):
+        "Let the thread know that the task's interval_secs has changed."
+        with self._cond:
+            self._rescheduled = True
+            self._cond.notify()
+
     def stop_async(self):
         """
         Ask the thread to stop.
 
         This call does NOT block. This method will call the task's stop()
         method to let the task know about the stop request. If the thread is
-        in the interval between task runs it checks for this stop signal every
-        1 second. If the thread is in the task's tick() it will only stop after
-        tick() is complete.
+        in the interval between task runs it stops right away. If the thread
+        is in the task's tick() it will only stop after tick() is complete.
         """
-        self._customStop = True
+        with self._cond:
+            self._customStop = True
+            self._cond.notify()
         self._rtask.stop_async()
 
     def stop_and_join(self):
@@ -181,3 +251,309 @@ class RepeatingTaskThread(Thread):
         self.stop_async()
         self.join()
 
+
+class RepeatingTaskScheduler(Thread):
+    """
+    A thread that runs any number of RepeatingTasks on a fixed number of
+    worker threads.
+
+    To use:
+    - create an instance with the number of worker threads
+    - add tasks with add_task()
+    - call start() to start the scheduler and its workers
+
+    Notes:
+    - calls to tick() are made as described for RepeatingTaskThread, with
+      is_absolute=True tasks aligned to their first call
+    - a task's calls to tick() never overlap; what happens to calls that are
+      due while the task is in tick() depends on its overrun policy (see
+      OVERRUN_POLICIES)
+    - if all workers are busy, due calls wait for a worker; see get_stats()
+      for how late calls were
+    - if tick() raises an error, the task is run again after a back-off that
+      doubles with every consecutive error (see RESTART_BACKOFF_SECS), and
+      the schedule starts over from that call
+    - exit_callback, if given, is called when the scheduler stops, for
+      whatever reason
+    """
+
+    def __init__(
+            self,
+            max_workers,
+            restart_backoff_secs=RESTART_BACKOFF_SECS,
+            restart_backoff_max_secs=RESTART_BACKOFF_MAX_SECS,
+            exit_callback=None
+            ):
+        assert max_workers >= 1
+        Thread.__init__(self, name="RepeatingTaskScheduler")
+        self._max_workers = max_workers
+        self._restart_backoff_secs = restart_backoff_secs
+        self._restart_backoff_max_secs = restart_backoff_max_secs
+        self._exit_callback = exit_callback
+        self._tasks = []
+        # (run time, sequence number, version, task) of scheduled calls.
+        self._heap = []
+        self._seq = 0
+        # (task, scheduled run time) of calls waiting for a worker.
+        self._ready = deque()
+        self._customStop = False
+        # guards the state above, and is notified when any of it changes.
+        self._cond = Condition()
+        logger.info(
+            "RepeatingTaskScheduler created with %d workers" % max_workers
+            )
+
+    def add_task(self, repeating_task, overrun_policy="coalesce"):
+        assert isinstance(repeating_task, RepeatingTask)
+        if overrun_policy not in OVERRUN_POLICIES:
+            raise ValueError("Unsupported overrun policy %s" % overrun_policy)
+        with self._cond:
+            stask = _ScheduledTask(repeating_task, overrun_policy)
+            self._tasks.append(stask)
+            self._push(stask, time.time())
+            self._cond.notify_all()
+
+    def run(self):
+        workers = []
+        try:
+            for i in range(self._max_workers):
+                worker = Thread(
+                    target=self._work,
+                    name="%s-%d" % (self.name, i + 1)
+                    )
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+            with self._cond:
+                while not self._customStop:
+                    now = time.time()
+                    while self._heap and self._heap[0][0] <= now:
+                        run_time, _, version, stask = \
+                            heapq.heappop(self._heap)
+                        if version == stask.version:
+                            self._due(stask, run_time)
+                    if self._heap:
+                        self._cond.wait(self._heap[0][0] - now)
+                    else:
+                        self._cond.wait()
+        except:
+            logger.error("Error in run(); Stopping.", exc_info=True)
+        self.stop_async()
+        for worker in workers:
+            worker.join()
+        if self._exit_callback:
+            self._exit_callback()
+
+    # Called with the lock held when a scheduled call of a task is due.
+    def _due(self, stask, run_time):
+        rtask = stask.rtask
+        if rtask.is_absolute():
+            # keep to the schedule, whatever happens to this call.
+            stask.last_run_time = run_time
+            self._push(stask, run_time + rtask.get_interval_secs())
+        if not stask.running:
+            self._dispatch(stask, run_time)
+        elif stask.overrun_policy == "queue":
+            stask.pending.append(run_time)
+        else:
+            if stask.overrun_policy == "skip" or stask.pending:
+                stask.stats.skipped_count += 1
+            if stask.overrun_policy == "coalesce":
+                stask.pending = [run_time]
+
+    def _dispatch(self, stask, run_time):
+        if not stask.rtask.is_absolute():
+            # the next call is scheduled when this one is complete.
+            stask.version += 1
+        stask.running = True
+        self._ready.append((stask, run_time))
+        self._cond.notify_all()
+
+    def _push(self, stask, run_time):
+        self._seq += 1
+        heapq.heappush(self._heap, (run_time, self._seq, stask.version, stask))
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._customStop:
+                    self._cond.wait()
+                if self._customStop:
+                    return
+                stask, run_time = self._ready.popleft()
+
+            rtask = stask.rtask
+            start_time = time.time()
+            failed = False
+            try:
+                rtask.tick()
+            except:
+                logger.error(
+                    "Error in tick() of %s:" % rtask.get_name(),
+                    exc_info=True
+                    )
+                failed = True
+            end_time = time.time()
+
+            with self._cond:
+                stask.running = False
+                stask.stats.add_tick(
+                    end_time - start_time, max(start_time - run_time, 0)
+                    )
+                if failed:
+                    self._restart(stask, end_time)
+                    continue
+                stask.errors = 0
+                if stask.pending:
+                    self._dispatch(stask, stask.pending.pop(0))
+                elif not rtask.is_absolute():
+                    stask.last_run_time = end_time
+                    self._push(stask, end_time + rtask.get_interval_secs())
+                self._cond.notify_all()
+
+    # Called with the lock held when a task's tick() has raised an error.
+    def _restart(self, stask, now):
+        stask.errors += 1
+        stask.stats.restarts_count += 1
+        delay = min(
+            self._restart_backoff_secs * 2 ** (stask.errors - 1),
+            self._restart_backoff_max_secs
+            )
+        logger.info(
+            "Restarting %s in %s secs" % (stask.rtask.get_name(), delay)
+            )
+        # forget the old schedule and any calls that were due.
+        stask.version += 1
+        stask.pending = []
+        stask.last_run_time = None
+        self._push(stask, now + delay)
+        self._cond.notify_all()
+
+    def wake(self, repeating_task):
+        """
+        Ask the scheduler to call the task's tick() now.
+
+        This call does NOT block. If the task is in tick(), the next call
+        will happen as soon as tick() is complete. For is_absolute=True, this
+        does not change when the calls after that happen.
+        """
+        with self._cond:
+            stask = self._get_scheduled_task(repeating_task)
+            if not stask.running:
+                self._dispatch(stask, time.time())
+            elif not stask.pending:
+                stask.pending.append(time.time())
+
+    def reschedule(self, repeating_task):
+        "Let the scheduler know that the task's interval_secs has changed."
+        with self._cond:
+            stask = self._get_scheduled_task(repeating_task)
+            if stask.last_run_time is None or \
+                    (stask.running and not stask.rtask.is_absolute()):
+                return
+            stask.version += 1
+            self._push(
+                stask,
+                stask.last_run_time + stask.rtask.get_interval_secs()
+                )
+            self._cond.notify_all()
+
+    def _get_scheduled_task(self, repeating_task):
+        for stask in self._tasks:
+            if stask.rtask is repeating_task:
+                return stask
+        raise ValueError("Unknown task %s" % repeating_task.get_name())
+
+    def get_stats(self):
+        "Returns the overrun policy and tick stats of every task, by name."
+        with self._cond:
+            stats = {}
+            for stask in self._tasks:
+                d = stask.stats.to_dict()
+                d["overrun_policy"] = stask.overrun_policy
+                stats[stask.rtask.get_name()] = d
+            return stats
+
+    def stop_async(self):
+        """
+        Ask the scheduler to stop.
+
+        This call does NOT block. This method will call the stop() method of
+        every task to let it know about the stop request. Calls to tick() that
+        have not started yet are dropped, and calls that are in progress are
+        completed before the scheduler stops.
+        """
+        with self._cond:
+            self._customStop = True
+            self._cond.notify_all()
+            tasks = list(self._tasks)
+        for stask in tasks:
+            stask.rtask.stop_async()
+
+    def is_stop_invoked(self):
+        # true once the scheduler is stopping, even if it is still alive.
+        return self._customStop
+
+    def stop_and_join(self):
+        "Helper function - equivalent to calling stop() and then join()"
+        self.stop_async()
+        self.join()
+
+
+class _ScheduledTask(object):
+    """
+    Scheduling state of a task in a RepeatingTaskScheduler.
+    """
+
+    def __init__(self, rtask, overrun_policy):
+        self.rtask = rtask
+        self.overrun_policy = overrun_policy
+        # scheduled calls of an older version are ignored.
+        self.version = 0
+        # time the last call was scheduled for (is_absolute=True), or time it
+        # was completed (is_absolute=False.)
+        self.last_run_time = None
+        self.running = False
+        # scheduled run times of calls to make once the running one is done.
+        self.pending = []
+        # number of consecutive calls that raised an error.
+        self.errors = 0
+        self.stats = _TickStats()
+
+
+class _TickStats(object):
+    """
+    Durations and lateness of the calls to a task's tick().
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.skipped_count = 0
+        self.restarts_count = 0
+        self.total_secs = 0
+        self.last_secs = 0
+        self.max_secs = 0
+        self.last_lateness_secs = 0
+        self.max_lateness_secs = 0
+
+    def add_tick(self, secs, lateness_secs):
+        self.count += 1
+        self.total_secs += secs
+        self.last_secs = secs
+        self.max_secs = max(self.max_secs, secs)
+        self.last_lateness_secs = lateness_secs
+        self.max_lateness_secs = max(self.max_lateness_secs, lateness_secs)
+
+    def to_dict(self):
+        d = {
+            "ticks_count": self.count,
+            "skipped_ticks_count": self.skipped_count,
+            "restarts_count": self.restarts_count
+            }
+        if self.count:
+            d["avg_tick_secs"] = round(self.total_secs / self.count, 3)
+            d["last_tick_secs"] = round(self.last_secs, 3)
+            d["max_tick_secs"] = round(self.max_secs, 3)
+            d["last_lateness_secs"] = round(self.last_lateness_secs, 3)
+            d["max_lateness_secs"] = round(self.max_lateness_secs, 3)
+        return d
@@ -30,6 +30,7 @@
 import json
 import logging
 import socket
+import threading
 import time
 from ssl import CertificateError
 
@@ -37,6 +38,7 @@ from pdagent import http
 from pdagent.constants import ConsumeEvent, EVENTS_API_BASE
 from pdagent.pdqueue import EmptyQueueError
 from pdagent.pdthread import RepeatingTask
+from pdagent.thirdparty.six import string_types
 from pdagent.thirdparty.six.moves.urllib.error import HTTPError, URLError
 from pdagent.thirdparty.six.moves.urllib.request import Request
 
@@ -50,43 +52,121 @@ class SendEventTask(RepeatingTask):
             self,
             pd_queue,
             send_interval_secs,
-            cleanup_interval_secs,
-            cleanup_threshold_secs,
             source_address='0.0.0.0',
+            compressor=None,
+            min_interval_secs=None,
+            max_interval_secs=None
             ):
-        RepeatingTask.__init__(self, send_interval_secs, False)
+        # the interval adapts to the queue between the min and max intervals
+        # (by default, both send_interval_secs), starting at, and returning to
+        # send_interval_secs when events can't be sent right now.
+        self._interval = _AdaptiveInterval(
+            send_interval_secs,
+            min_interval_secs or send_interval_secs,
+            max_interval_secs or send_interval_secs
+            )
+        RepeatingTask.__init__(self, self._interval.secs, False)
         self.pd_queue = pd_queue
-        self.cleanup_interval_secs = cleanup_interval_secs
-        self.cleanup_threshold_secs = cleanup_threshold_secs
-        self.last_cleanup_time = 0
         self._source_address = source_address
         self._http = http  # to ease unit testing.
+        self._compressor = compressor or http.RequestCompressor()
+        self._recorded_requests_count = 0
+        self._last_prune_time = None
+        self._time = time  # to ease unit testing.
+        # reconfigure() is called from outside the task runner; tick()
+        # applies the new settings before its next pass.
+        self._pending_config = None
+        self._pending_config_lock = threading.Lock()
+
+    def reconfigure(
+            self,
+            send_interval_secs,
+            source_address,
+            min_interval_secs=None,
+            max_interval_secs=None
+            ):
+        # takes effect at the start of the next tick(), so that a tick in
+        # progress keeps using the settings it started with. Wake the task
+        # to apply the new settings right away.
+        interval = _AdaptiveInterval(
+            send_interval_secs,
+            min_interval_secs or send_interval_secs,
+            max_interval_secs or send_interval_secs
+            )
+        with self._pending_config_lock:
+            self._pending_config = (interval, source_address)
+
+    def _apply_pending_config(self):
+        with self._pending_config_lock:
+            pending_config = self._pending_config
+            self._pending_config = None
+        if pending_config:
+            self._interval, self._source_address = pending_config
+            self.set_interval_secs(self._interval.secs)
 
     def tick(self):
+        self._apply_pending_config()
+
         # flush the event queue.
         logger.debug("Flushing event queue")
         try:
-            self.pd_queue.flush(self.send_event, self.is_stop_invoked)
+            pass_stats = self.pd_queue.flush(
+                self.send_event, self.is_stop_invoked
+                ) or {}
+            if pass_stats.get("throttled"):
+                # the back-off schedule decides when events can be sent.
+                self._interval.throttled()
+            elif pass_stats.get("limit_reached") or \
+                    pass_stats.get("events_count"):
+                # more events are queued, or are likely on their way.
+                self._interval.busy()
+            else:
+                self._interval.idle()
         except EmptyQueueError:
             logger.debug("Nothing to do - queue is empty!")
+            self._interval.idle()
         except IOError:
             logger.error("I/O error while flushing queue:", exc_info=True)
+            self._interval.throttled()
         except:
             logger.error("Error while flushing queue:", exc_info=True)
+            self._interval.throttled()
+        self.set_interval_secs(self._interval.secs)
+
+        # publish compression totals for the local stats, as they change.
+        if self._compressor.min_bytes and \
+                self._compressor.requests_count != \
+                self._recorded_requests_count:
+            try:
+                compression_stats = self._compressor.get_stats()
+                self.pd_queue.record_compression_stats(compression_stats)
+                self._recorded_requests_count = \
+                    compression_stats["compressed_requests_count"]
+            except:
+                logger.error(
+                    "Error while recording compression stats:", exc_info=True
+                    )
 
-        # clean up if required.
-        secs_since_cleanup = int(time.time()) - self.last_cleanup_time
-        if secs_since_cleanup >= self.cleanup_interval_secs:
+        # keep the deduplication index small, which needs no more than the
+        # base send interval, however often the queue is flushed.
+        now = self._time.time()
+        if self._last_prune_time is None or \
+                now - self._last_prune_time >= self._interval.base_secs:
+            self._last_prune_time = now
             try:
-                self.pd_queue.cleanup(self.cleanup_threshold_secs)
+                self.pd_queue.prune_dedup_index()
             except:
-                logger.error("Error while cleaning up queue:", exc_info=True)
-            self.last_cleanup_time = int(time.time())
+                logger.error(
+                    "Error while pruning dedup index:", exc_info=True
+                    )
 
-    def send_event(self, json_event_str, event_id):
+    def send_event(self, json_event, event_id):
         request = Request(EVENTS_API_BASE)
         request.add_header("Content-type", "application/json")
-        request.data = json_event_str.encode()
+        # queued events are bytes, which are sent without copying.
+        if not isinstance(json_event, bytes):
+            json_event = json_event.encode()
+        self._compressor.set_data(request, json_event)
 
         try:
             response = self._http.urlopen(request,
@@ -152,6 +232,9 @@ class SendEventTask(RepeatingTask):
             # times, but never consider this event as erroneous.
             return ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED
         elif status_code >= 400 and status_code < 500:
+            if _is_service_key_rejection(result):
+                # no event of this service key will be accepted.
+                return ConsumeEvent.BAD_SVCKEY
             return ConsumeEvent.BAD_ENTRY
         elif status_code >= 500 and status_code < 600:
             # Hmm. Could be server-side problem, or a bad entry.
@@ -161,3 +244,40 @@ class SendEventTask(RepeatingTask):
         else:
             # anything 3xx and >= 600 -- we don't know what this means!!
             return ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED
+
+
+class _AdaptiveInterval(object):
+    """
+    The interval until the next flush: the min interval while there is work
+    to do, the base interval while service keys are backing off, and a
+    doubling interval up to the max interval while the queue is idle.
+    """
+
+    def __init__(self, base_secs, min_secs, max_secs):
+        assert 0 < min_secs <= max_secs
+        self.min_secs = min_secs
+        self.max_secs = max_secs
+        self.base_secs = min(max(base_secs, min_secs), max_secs)
+        self.secs = self.base_secs
+
+    def busy(self):
+        self.secs = self.min_secs
+
+    def throttled(self):
+        self.secs = self.base_secs
+
+    def idle(self):
+        self.secs = min(self.secs * 2, self.max_secs)
+
+
+def _is_service_key_rejection(result):
+    # error responses name the service key when the key itself is rejected,
+    # e.g. "Service key is the wrong length (should be 32 characters)".
+    try:
+        messages = [result.get("message")] + list(result.get("errors") or [])
+    except (AttributeError, TypeError):
+        return False
+    return any(
+        "service key" in m.lower()
+        for m in messages if isinstance(m, string_types)
+        )
@@ -0,0 +1,170 @@
+#
+# Copyright (c) 2013-2014, PagerDuty, Inc. <info@pagerduty.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the copyright holder nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# Measures queue throughput with and without a RAM queue directory.
+#
+# Usage: python scripts/bench-queue.py [--events N] [--ram-dir DIR]
+#                                      [--success-policy POLICY]
+#
+# The given number of events is queued in a temporary queue and then flushed
+# through a consumer that accepts every event, once with pdq/ and tmp/ in the
+# outqueue and once with them in a RAM queue directory (see ram_queue_dir in
+# pdagent.conf). The enqueue and flush rates of each mode are reported. The
+# RAM queue directory is created under --ram-dir, which defaults to /dev/shm
+# if it exists. Succeeded events are kept in suc/ on disk by default, which
+# means a copy across file systems for each event sent in the RAM mode; use
+# --success-policy receipt to measure the mode without it.
+#
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+_PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _PROJECT_DIR)
+
+from pdagent.constants import ConsumeEvent
+from pdagent.jsonstore import JsonStore
+from pdagent.pdqueue import PDQEnqueuer, PDQueue, QUEUE_SUBDIRS, \
+    RAM_QUEUE_SUBDIRS, SUCCESS_POLICIES
+from pdagent.thirdparty.filelock import FileLock
+
+
+_BENCH_SERVICE_KEY = "pdagent-bench-queue"
+_BENCH_EVENT = (
+    '{"description":"Queue benchmark","details":{},'
+    '"event_type":"trigger","service_key":"%s"}' % _BENCH_SERVICE_KEY
+    )
+
+
+def new_queue(work_dir, ram_queue_dir, success_policy):
+    queue_dir = os.path.join(work_dir, "outqueue")
+    db_dir = os.path.join(work_dir, "db")
+    for subdir in QUEUE_SUBDIRS:
+        os.makedirs(os.path.join(queue_dir, subdir))
+    if ram_queue_dir:
+        for subdir in RAM_QUEUE_SUBDIRS:
+            os.makedirs(os.path.join(ram_queue_dir, subdir))
+    os.makedirs(db_dir)
+    enqueuer = PDQEnqueuer(
+        queue_dir=queue_dir,
+        lock_class=FileLock,
+        time_calc=time,
+        enqueue_file_mode=0o644,
+        default_umask=0o22,
+        ram_queue_dir=ram_queue_dir
+        )
+    queue = PDQueue(
+        queue_dir=queue_dir,
+        lock_class=FileLock,
+        time_calc=time,
+        event_size_max_bytes=4 * 1024 * 1024,
+        backoff_interval=5,
+        retry_limit_for_possible_errors=3,
+        backoff_db=JsonStore("backoff", db_dir),
+        counter_db=JsonStore("aggregates", db_dir),
+        success_policy=success_policy,
+        ram_queue_dir=ram_queue_dir
+        )
+    return enqueuer, queue
+
+
+def run(events, ram_parent_dir, success_policy):
+    work_dir = tempfile.mkdtemp(prefix="pdagent-bench-")
+    ram_work_dir = None
+    ram_queue_dir = None
+    if ram_parent_dir:
+        ram_work_dir = tempfile.mkdtemp(
+            prefix="pdagent-bench-", dir=ram_parent_dir
+            )
+        ram_queue_dir = os.path.join(ram_work_dir, "outqueue")
+    try:
+        enqueuer, queue = new_queue(
+            work_dir, ram_queue_dir, success_policy
+            )
+
+        start = time.time()
+        for _ in range(events):
+            enqueuer.enqueue(_BENCH_SERVICE_KEY, _BENCH_EVENT)
+        enqueue_secs = time.time() - start
+
+        start = time.time()
+        queue.flush(lambda s, e: ConsumeEvent.CONSUMED, lambda: False)
+        flush_secs = time.time() - start
+    finally:
+        shutil.rmtree(work_dir)
+        if ram_work_dir:
+            shutil.rmtree(ram_work_dir)
+    return enqueue_secs, flush_secs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure queue throughput with and without a RAM queue."
+        )
+    parser.add_argument(
+        "--events", type=int, default=2000,
+        help="number of events to queue and flush (default: 2000)"
+        )
+    parser.add_argument(
+        "--ram-dir",
+        default="/dev/shm" if os.path.isdir("/dev/shm") else None,
+        help="directory to create the RAM queue in (default: /dev/shm)"
+        )
+    parser.add_argument(
+        "--success-policy", choices=SUCCESS_POLICIES, default="keep",
+        help="what to do with succeeded events (default: keep)"
+        )
+    args = parser.parse_args()
+    if not args.ram_dir:
+        print("FAIL: no RAM directory, use --ram-dir", file=sys.stderr)
+        return 1
+
+    for mode, ram_dir in [("disk", None), ("ram", args.ram_dir)]:
+        enqueue_secs, flush_secs = run(
+            args.events, ram_dir, args.success_policy
+            )
+        print(
+            "%-4s: enqueue %.0f events/s; flush %.0f events/s" % (
+                mode,
+                args.events / max(enqueue_secs, 1e-6),
+                args.events / max(flush_secs, 1e-6)
+                )
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
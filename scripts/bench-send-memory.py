@@ -0,0 +1,186 @@
+#
+# Copyright (c) 2013-2014, PagerDuty, Inc. <info@pagerduty.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the copyright holder nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# Measures the memory used to send a large queued event.
+#
+# Usage: python scripts/bench-send-memory.py [--size-kb KB] [--no-validation]
+#                                            [--max-copies N]
+#
+# An event of about the given size is queued in a temporary queue and sent
+# through the agent's send path, with the HTTP connection replaced by one that
+# only records the request. The peak memory allocated while the event is
+# processed is reported, along with the number of event-sized copies it
+# amounts to. The exit code is non-zero if that is more than the given number
+# of copies, so this can be used to catch memory regressions. Requires Python
+# 3.4+ (tracemalloc).
+#
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+
+_PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _PROJECT_DIR)
+
+from pdagent.jsonstore import JsonStore
+from pdagent.pdagentutil import make_event_validator
+from pdagent.pdqueue import PDQEnqueuer, PDQueue
+from pdagent.sendevent import SendEventTask
+from pdagent.thirdparty.filelock import FileLock
+
+
+_BENCH_SERVICE_KEY = "pdagent-bench-send-memory"
+_QUEUE_SUBDIRS = ["pdq", "tmp", "suc", "err", "dup", "pack"]
+
+
+class _RecordingResponse:
+
+    def getcode(self):
+        return 200
+
+    def read(self):
+        return b'{"status":"success","message":"Event processed"}'
+
+    def close(self):
+        pass
+
+
+class _RecordingUrlLib:
+
+    def __init__(self):
+        self.data_len = None
+
+    def urlopen(self, request, **kwargs):
+        self.data_len = len(request.data)
+        return _RecordingResponse()
+
+
+def make_event(size_bytes):
+    event = {
+        "service_key": _BENCH_SERVICE_KEY,
+        "event_type": "trigger",
+        "description": "Send memory benchmark",
+        "details": {"padding": ""},
+        }
+    padding_len = size_bytes - len(json.dumps(event))
+    event["details"]["padding"] = "x" * max(padding_len, 0)
+    return json.dumps(event, separators=(",", ":"), sort_keys=True)
+
+
+def new_queue(work_dir, event_size_max_bytes, validate):
+    queue_dir = os.path.join(work_dir, "outqueue")
+    db_dir = os.path.join(work_dir, "db")
+    for subdir in _QUEUE_SUBDIRS:
+        os.makedirs(os.path.join(queue_dir, subdir))
+    os.makedirs(db_dir)
+    enqueuer = PDQEnqueuer(
+        queue_dir=queue_dir,
+        lock_class=FileLock,
+        time_calc=__import__("time"),
+        enqueue_file_mode=0o644,
+        default_umask=0o22
+        )
+    queue = PDQueue(
+        queue_dir=queue_dir,
+        lock_class=FileLock,
+        time_calc=__import__("time"),
+        event_size_max_bytes=event_size_max_bytes,
+        backoff_interval=5,
+        retry_limit_for_possible_errors=3,
+        backoff_db=JsonStore("backoff", db_dir),
+        counter_db=JsonStore("aggregates", db_dir),
+        event_validator=make_event_validator() if validate else None
+        )
+    return enqueuer, queue
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure memory used to send a large queued event."
+        )
+    parser.add_argument(
+        "--size-kb", type=int, default=4096,
+        help="approximate size of the event in KB (default: 4096)"
+        )
+    parser.add_argument(
+        "--no-validation", action="store_true",
+        help="send the event without validating it first"
+        )
+    parser.add_argument(
+        "--max-copies", type=float,
+        help="fail if peak memory is more than this many event-sized copies"
+        )
+    args = parser.parse_args()
+
+    event = make_event(args.size_kb * 1024)
+    work_dir = tempfile.mkdtemp(prefix="pdagent-bench-")
+    try:
+        enqueuer, queue = new_queue(
+            work_dir, len(event) + 1, not args.no_validation
+            )
+        enqueuer.enqueue(_BENCH_SERVICE_KEY, event)
+        del event
+
+        task = SendEventTask(queue, 30, None)
+        task._http = _RecordingUrlLib()
+
+        tracemalloc.start()
+        queue.flush(task.send_event, lambda: False)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(work_dir)
+
+    sent = task._http.data_len
+    if sent is None:
+        print("FAIL: event was not sent", file=sys.stderr)
+        return 1
+    copies = float(peak) / sent
+    print(
+        "event: %.1f KB sent; peak memory: %.1f KB (%.2f copies)" %
+        (sent / 1024.0, peak / 1024.0, copies)
+        )
+    if args.max_copies and copies > args.max_copies:
+        print(
+            "FAIL: %.2f copies > %.2f copies" % (copies, args.max_copies),
+            file=sys.stderr
+            )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+#
+# Copyright (c) 2013-2014, PagerDuty, Inc. <info@pagerduty.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the copyright holder nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#
+# Measures cold-start cost of the agent's command-line entry points.
+#
+# Usage: python scripts/bench-startup.py [-n RUNS] [--max-wall-ms MS]
+#                                        [--max-import-ms MS]
+#
+# Every entry point is run RUNS times in the development layout; the median
+# and maximum wall time are reported, along with the total import time of a
+# single run (Python 3.7+, using -X importtime) and its heaviest imports.
+# The exit code is non-zero if a median wall time or an import time is over
+# the given budget, so this can be used to catch startup regressions. The wall
+# time budget defaults to 60 ms; use --max-wall-ms 0 to turn it off (e.g. on
+# slow machines.)
+#
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+_PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_BENCH_SERVICE_KEY = "pdagent-bench-startup"
+# default budget for the median wall time of an entry point, in ms.
+_DEFAULT_MAX_WALL_MS = 60
+
+ENTRY_POINTS = [
+    ("pd-send", [
+        "bin/pd-send.py", "-k", _BENCH_SERVICE_KEY, "-t", "trigger",
+        "-d", "Startup benchmark", "-q",
+        ]),
+    ("pd-queue", ["bin/pd-queue.py", "status", "-k", _BENCH_SERVICE_KEY]),
+    ]
+
+
+def ensure_dev_dirs():
+    tmp_dir = os.path.join(_PROJECT_DIR, "tmp")
+    outqueue_dir = os.path.join(tmp_dir, "outqueue")
+    for d in ["pdq", "tmp", "suc", "err", "dup", "pack"]:
+        d = os.path.join(outqueue_dir, d)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    db_dir = os.path.join(tmp_dir, "db")
+    if not os.path.isdir(db_dir):
+        os.makedirs(db_dir)
+    return outqueue_dir
+
+
+def remove_bench_events(outqueue_dir):
+    suffix = "_%s.txt" % _BENCH_SERVICE_KEY
+    for d in ["pdq", "tmp"]:
+        d = os.path.join(outqueue_dir, d)
+        for fname in os.listdir(d):
+            if fname.endswith(suffix):
+                os.remove(os.path.join(d, fname))
+
+
+def run(args, import_time=False):
+    cmd = [sys.executable]
+    if import_time:
+        cmd.extend(["-X", "importtime"])
+    cmd.extend(args)
+    # installed agents run from compiled bytecode, so let the warm-up run
+    # write .pyc files even where that is turned off.
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    start = time.time()
+    proc = subprocess.Popen(
+        cmd, cwd=_PROJECT_DIR, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    _, err = proc.communicate()
+    elapsed_ms = (time.time() - start) * 1000
+    if proc.returncode != 0:
+        raise SystemExit(
+            "Command failed: %s\n%s" % (" ".join(args), err.decode())
+            )
+    return elapsed_ms, err.decode()
+
+
+def parse_import_times(importtime_output):
+    # returns (total, [(cumulative, module), ...]) for top-level imports, in
+    # milliseconds. Lines look like:
+    # import time: self [us] | cumulative | imported package
+    total = 0.0
+    top_level = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue  # header line
+        name = parts[2]
+        if name.startswith("  "):
+            continue  # nested import; already in its parent's cumulative.
+        cumulative_ms = int(parts[1]) / 1000.0
+        total += cumulative_ms
+        top_level.append((cumulative_ms, name.strip()))
+    top_level.sort(reverse=True)
+    return total, top_level
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure startup time of agent entry points."
+        )
+    parser.add_argument(
+        "-n", "--runs", type=int, default=20,
+        help="number of timed runs per entry point (default: 20)"
+        )
+    parser.add_argument(
+        "--max-wall-ms", type=float, default=_DEFAULT_MAX_WALL_MS,
+        help="fail if the median wall time of an entry point exceeds this "
+        "(default: %d; 0 for no limit)" % _DEFAULT_MAX_WALL_MS
+        )
+    parser.add_argument(
+        "--max-import-ms", type=float,
+        help="fail if the import time of an entry point exceeds this"
+        )
+    args = parser.parse_args()
+
+    outqueue_dir = ensure_dev_dirs()
+    has_importtime = sys.version_info >= (3, 7)
+    failures = []
+    try:
+        for name, entry_args in ENTRY_POINTS:
+            run(entry_args)  # warm up caches, config snapshot, .pyc files.
+            times = sorted(run(entry_args)[0] for _ in range(args.runs))
+            median_ms = times[len(times) // 2]
+            print(
+                "%-10s wall: median %.1f ms, max %.1f ms (%d runs)" %
+                (name, median_ms, times[-1], args.runs)
+                )
+            if args.max_wall_ms and median_ms > args.max_wall_ms:
+                failures.append(
+                    "%s median wall time %.1f ms > %.1f ms" %
+                    (name, median_ms, args.max_wall_ms)
+                    )
+
+            if not has_importtime:
+                print("%-10s imports: n/a (requires Python 3.7+)" % name)
+                continue
+            import_ms, top_level = \
+                parse_import_times(run(entry_args, import_time=True)[1])
+            print(
+                "%-10s imports: %.1f ms; heaviest: %s" %
+                (name, import_ms, ", ".join(
+                    "%s %.1f ms" % (m, t) for (t, m) in top_level[:5]
+                    ))
+                )
+            if args.max_import_ms and import_ms > args.max_import_ms:
+                failures.append(
+                    "%s import time %.1f ms > %.1f ms" %
+                    (name, import_ms, args.max_import_ms)
+                    )
+    finally:
+        remove_bench_events(outqueue_dir)
+
+    for failure in failures:
+        print("FAIL:", failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
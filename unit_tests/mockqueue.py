@@ -42,6 +42,10 @@ class MockQueue:
         self.expected_cleanup_age = cleanup_age_secs
         self.consume_code = None
         self.cleaned_up = False
+        self.packed = False
+        self.flush_stats = None
+        self.prune_count = 0
+        self.compression_stats = None
 
     def get_stats(self, detailed_snapshot=False):
         if detailed_snapshot == self.expected_detailed_snapshot:
@@ -53,10 +57,26 @@ class MockQueue:
 
     def flush(self, consume_func, stop_check_func):
         self.consume_code = consume_func(self.event, self.event)
+        return self.flush_stats
 
-    def cleanup(self, before):
+    def prune_dedup_index(self):
+        self.prune_count += 1
+
+    def record_compression_stats(self, compression_stats):
+        self.compression_stats = compression_stats
+
+    def pack(self):
+        self.packed = True
+
+    def cleanup(self, before, slice_secs=0, pause_secs=0, stop_check_func=None):
         if before == self.expected_cleanup_age:
             self.cleaned_up = True
+            return {
+                "removed_files_count": 0,
+                "removed_packs_count": 0,
+                "completed": True,
+                "duration_secs": 0
+                }
         else:
             raise Exception(
                 "Received cleanup_before=%s, expected=%s" %
@@ -32,8 +32,10 @@ class MockUrlLib:
     def __init__(self):
         self.request = None
         self.response = None
+        self.urlopen_kwargs = None
 
     def urlopen(self, request, **kwargs):
         self.request = request
+        self.urlopen_kwargs = kwargs
         return self.response
 
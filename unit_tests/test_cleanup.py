@@ -0,0 +1,113 @@
+#
+# Copyright (c) 2013-2014, PagerDuty, Inc. <info@pagerduty.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the copyright holder nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from contextlib import contextmanager
+import logging
+import platform
+import unittest
+
+import pdagent.cleanup
+from pdagent.cleanup import CleanupTask, _get_ioprio_syscalls, \
+    _low_io_priority
+from unit_tests.mockqueue import MockQueue
+
+
+logging.basicConfig(level=logging.CRITICAL)
+
+CLEANUP_FREQUENCY_SEC = 60
+CLEANUP_AGE_SEC = 120
+
+
+class CleanupTest(unittest.TestCase):
+
+    def new_cleanup_task(self):
+        c = CleanupTask(
+            MockQueue(cleanup_age_secs=CLEANUP_AGE_SEC),
+            CLEANUP_FREQUENCY_SEC,
+            CLEANUP_AGE_SEC
+            )
+        self.io_priority_lowered = []
+
+        @contextmanager
+        def io_priority():
+            self.io_priority_lowered.append(True)
+            yield
+            self.io_priority_lowered.append(False)
+        c._io_priority = io_priority
+        return c
+
+    def test_pack_and_cleanup(self):
+        c = self.new_cleanup_task()
+        c.tick()
+        self.assertTrue(c.pd_queue.packed)
+        self.assertTrue(c.pd_queue.cleaned_up)
+        # done at a lower I/O priority, which is then restored.
+        self.assertEqual(self.io_priority_lowered, [True, False])
+
+    def test_pack_errors(self):
+        def erroneous_pack(*args, **kwargs):
+            raise Exception
+
+        c = self.new_cleanup_task()
+        c.pd_queue.pack = erroneous_pack
+        c.tick()
+        # pack errors are handled, and cleanup is still invoked.
+        self.assertTrue(c.pd_queue.cleaned_up)
+
+    def test_cleanup_errors(self):
+        def erroneous_cleanup(*args, **kwargs):
+            raise Exception
+
+        c = self.new_cleanup_task()
+        c.pd_queue.cleanup = erroneous_cleanup
+        c.tick()
+        # cleanup errors have been handled.
+        self.assertEqual(self.io_priority_lowered, [True, False])
+
+    def test_low_io_priority(self):
+        # works, or does nothing, wherever this runs.
+        with _low_io_priority():
+            pass
+
+    def test_ioprio_pointer_size_mismatch(self):
+        # e.g. a 32-bit Python on a 64-bit kernel uses other syscall numbers.
+        syscalls = pdagent.cleanup._IOPRIO_SYSCALLS
+        pdagent.cleanup._IOPRIO_SYSCALLS = {
+            (platform.machine(), 2): (251, 252),
+            }
+        pdagent.cleanup._ioprio_syscalls = None
+        try:
+            self.assertEqual(_get_ioprio_syscalls(), None)
+        finally:
+            pdagent.cleanup._IOPRIO_SYSCALLS = syscalls
+            pdagent.cleanup._ioprio_syscalls = None
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+#
+# Copyright (c) 2013-2014, PagerDuty, Inc. <info@pagerduty.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the copyright holder nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import unittest
+
+import pdagent.config
+from pdagent.config import AgentConfig, ConfigError, RELOADABLE_KEYS, \
+    _load_config_snapshot, _parse_main_config, _store_config_snapshot
+
+
+_TEST_DIR = os.path.join("/tmp", "test_config")
+_TEST_CONF_FILE = os.path.join(_TEST_DIR, "pdagent.conf")
+_TEST_SNAPSHOT_FILE = os.path.join(_TEST_DIR, "config_snapshot.json")
+
+_CONF_TEMPLATE = """
+[Main]
+send_interval_secs = %(send_interval_secs)s
+cleanup_interval_secs = 10800
+cleanup_threshold_secs = 604800
+backoff_interval_secs = 30
+retry_limit_for_possible_errors = 3
+source_address = 0.0.0.0
+flush_policy = %(flush_policy)s
+"""
+
+
+class AgentConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree(_TEST_DIR, ignore_errors=True)
+        try:
+            os.makedirs(_TEST_DIR)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.write_conf()
+        self.config = AgentConfig(
+            False,
+            {"data_dir": _TEST_DIR},
+            _parse_main_config(_TEST_CONF_FILE),
+            _TEST_CONF_FILE
+            )
+
+    def tearDown(self):
+        shutil.rmtree(_TEST_DIR, ignore_errors=True)
+
+    def write_conf(self, send_interval_secs=10, flush_policy="fifo"):
+        with open(_TEST_CONF_FILE, "w") as f:
+            f.write(_CONF_TEMPLATE % {
+                "send_interval_secs": send_interval_secs,
+                "flush_policy": flush_policy,
+                })
+
+    def test_reload_unchanged(self):
+        main_config = dict(self.config.get_main_config())
+        self.assertEqual(self.config.reload(), {})
+        self.assertEqual(self.config.get_main_config(), main_config)
+
+    def test_reload(self):
+        main_config = self.config.get_main_config()
+        self.write_conf(send_interval_secs=5, flush_policy="round_robin")
+        changes = self.config.reload()
+        self.assertEqual(changes, {
+            "send_interval_secs": (10, 5),
+            "send_interval_max_secs": (10.0, 5.0),
+            "flush_policy": ("fifo", "round_robin"),
+            })
+        # only reloadable values are updated, in the same main config.
+        self.assertTrue("flush_policy" not in RELOADABLE_KEYS)
+        self.assertTrue(self.config.get_main_config() is main_config)
+        self.assertEqual(main_config["send_interval_secs"], 5)
+        self.assertEqual(main_config["send_interval_max_secs"], 5.0)
+        self.assertEqual(main_config["flush_policy"], "fifo")
+        # values that need a restart are reported until then.
+        self.assertEqual(self.config.reload(), {
+            "flush_policy": ("fifo", "round_robin"),
+            })
+
+    def test_max_send_interval(self):
+        # by default, the send interval doesn't back off past its usual value.
+        main_config = self.config.get_main_config()
+        self.assertEqual(main_config["send_interval_max_secs"], 10.0)
+        # the max send interval is never less than the send interval.
+        self.write_conf(send_interval_secs=90)
+        self.config.reload()
+        main_config = self.config.get_main_config()
+        self.assertEqual(main_config["send_interval_max_secs"], 90.0)
+
+    def test_reload_invalid(self):
+        main_config = dict(self.config.get_main_config())
+        self.write_conf(send_interval_secs="often")
+        self.assertRaises(ConfigError, self.config.reload)
+        self.write_conf(send_interval_secs=5, flush_policy="random")
+        self.assertRaises(ConfigError, self.config.reload)
+        # nothing is updated.
+        self.assertEqual(self.config.get_main_config(), main_config)
+
+    def test_snapshot(self):
+        main_config = _parse_main_config(_TEST_CONF_FILE)
+        _store_config_snapshot(
+            _TEST_CONF_FILE, _TEST_SNAPSHOT_FILE, main_config
+            )
+        self.assertEqual(
+            _load_config_snapshot(_TEST_CONF_FILE, _TEST_SNAPSHOT_FILE),
+            main_config
+            )
+        # the snapshot is not used once the snapshot version changes...
+        version = pdagent.config._CONFIG_SNAPSHOT_VERSION
+        pdagent.config._CONFIG_SNAPSHOT_VERSION = version + 1
+        try:
+            self.assertEqual(
+                _load_config_snapshot(_TEST_CONF_FILE, _TEST_SNAPSHOT_FILE),
+                None
+                )
+        finally:
+            pdagent.config._CONFIG_SNAPSHOT_VERSION = version
+        # ...or the config file changes.
+        self.write_conf(send_interval_secs=5)
+        self.assertEqual(
+            _load_config_snapshot(_TEST_CONF_FILE, _TEST_SNAPSHOT_FILE),
+            None
+            )
+
+    def test_snapshot_version(self):
+        # snapshots hold parsed defaults, so a change to the defaults needs a
+        # new snapshot version. Update both below when that happens.
+        defaults_hash = hashlib.sha1(json.dumps(
+            pdagent.config._MAIN_CONFIG_DEFAULTS, sort_keys=True
+            ).encode()).hexdigest()
+        self.assertEqual(
+            (pdagent.config._CONFIG_SNAPSHOT_VERSION, defaults_hash),
+            (4, "f1201453464cc5f397096a2b5ef5c0638d7f2633")
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -27,6 +27,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import gzip
+import io
 import json
 import logging
 import unittest
@@ -85,6 +87,16 @@ class HeartbeatTest(unittest.TestCase):
         }
         self.assertEqual(json.loads(hb._urllib2.request.data.decode('utf-8')), expected)
 
+    def test_set_source_address(self):
+        hb = self.new_heartbeat_task()
+        hb.set_source_address('127.0.0.1')
+        # nothing changes until the next tick.
+        self.assertEqual(hb._source_address, '0.0.0.0')
+        hb.tick()
+        self.assertEqual(
+            hb._urllib2.urlopen_kwargs["source_address"], '127.0.0.1'
+            )
+
     def test_data(self):
         hb = self.new_heartbeat_task()
         hb.tick()
@@ -96,6 +108,34 @@ class HeartbeatTest(unittest.TestCase):
         }
         self.assertEqual(json.loads(hb._urllib2.request.data.decode('utf-8')), expected)
 
+    def test_compressed_data(self):
+        hb = self.new_heartbeat_task()
+        hb._compressor = http.RequestCompressor(min_bytes=1)
+        hb.tick()
+        request = hb._urllib2.request
+        self.assertEqual(request.get_header("Content-encoding"), "gzip")
+        data = gzip.GzipFile(fileobj=io.BytesIO(request.data)).read()
+        # totals of compressions before this heartbeat are reported.
+        self.assertEqual(
+            json.loads(data.decode('utf-8'))["compression_stats"][
+                "compressed_requests_count"
+                ],
+            0
+            )
+        self.assertEqual(hb._compressor.requests_count, 1)
+
+    def test_task_stats(self):
+        hb = self.new_heartbeat_task()
+        hb._task_scheduler = Mock()
+        hb._task_scheduler.get_stats.return_value = {
+            "HeartbeatTask": {"ticks_count": 1}
+            }
+        hb.tick()
+        self.assertEqual(
+            json.loads(hb._urllib2.request.data.decode('utf-8'))["task_stats"],
+            {"HeartbeatTask": {"ticks_count": 1}}
+            )
+
     def test_new_frequency(self):
         hb = self.new_heartbeat_task()
         hb._urllib2.response = MockResponse(
@@ -27,14 +27,21 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import gzip
+import io
+import json
 import unittest
 import socket
 import ssl
 from os.path import dirname, join, realpath
+from threading import Thread
 
 import pdagent.thirdparty.six as six
-from pdagent.http import urlopen
+from pdagent.http import RequestCompressor, urlopen
+from pdagent.thirdparty.six.moves.BaseHTTPServer import \
+    HTTPServer, BaseHTTPRequestHandler
 from pdagent.thirdparty.six.moves.urllib.error import URLError
+from pdagent.thirdparty.six.moves.urllib.request import Request
 from unit_tests.simplehttpsserver import SimpleHTTPSServer
 
 
@@ -103,5 +110,78 @@ class PDVerifiedHttpsTest(unittest.TestCase):
         res = urlopen(_make_url(_SERVER, protocol="http"))
         self.assertEqual(res.getcode(), _SUCCESS_RESPONSE_CODE)
 
+
+class _DecodingHandler(BaseHTTPRequestHandler):
+    # stands in for the events API: decodes gzipped request bodies, and
+    # responds with what it received.
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        encoding = self.headers.get("Content-Encoding")
+        if encoding == "gzip":
+            body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+        response = json.dumps({
+            "encoding": encoding,
+            "body": body.decode(),
+            }).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class RequestCompressorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.httpd = HTTPServer(("localhost", 0), _DecodingHandler)
+        self.server_thread = Thread(target=self.httpd.serve_forever)
+        self.server_thread.start()
+        self.url = _make_url(
+            "localhost", protocol="http", port=self.httpd.server_address[1]
+            )
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.server_thread.join()
+
+    def post(self, compressor, data):
+        req = Request(self.url)
+        compressor.set_data(req, data)
+        res = urlopen(req)
+        try:
+            return json.loads(res.read().decode())
+        finally:
+            res.close()
+
+    def test_compressed(self):
+        compressor = RequestCompressor(min_bytes=100, level=9)
+        data = json.dumps({"details": {"log": "line\n" * 1000}}).encode()
+        result = self.post(compressor, data)
+        self.assertEqual(result["encoding"], "gzip")
+        self.assertEqual(result["body"].encode(), data)
+        stats = compressor.get_stats()
+        self.assertEqual(stats["compressed_requests_count"], 1)
+        self.assertEqual(stats["uncompressed_bytes"], len(data))
+        self.assertTrue(0 < stats["compressed_bytes"] < len(data))
+        self.assertTrue(stats["compression_ratio"] > 10)
+
+    def test_below_threshold(self):
+        compressor = RequestCompressor(min_bytes=100)
+        result = self.post(compressor, b'{"event_type":"trigger"}')
+        self.assertEqual(result["encoding"], None)
+        self.assertEqual(result["body"], '{"event_type":"trigger"}')
+        self.assertEqual(compressor.get_stats()["compressed_requests_count"], 0)
+
+    def test_off(self):
+        compressor = RequestCompressor()
+        result = self.post(compressor, b"x" * 1000)
+        self.assertEqual(result["encoding"], None)
+        self.assertEqual(compressor.get_stats()["compression_ratio"], None)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -27,7 +27,9 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import json
 import logging
+import mock
 import os
 import shutil
 import stat
@@ -36,6 +38,7 @@ import time
 import unittest
 
 from pdagent.constants import ConsumeEvent, EnqueueWarnings
+from pdagent.pdagentutil import make_event_validator
 from pdagent.pdqueue import PDQEnqueuer, PDQueue, EmptyQueueError
 from pdagent import pdqueue
 
@@ -124,7 +127,11 @@ class PDQueueTest(unittest.TestCase):
             shutil.rmtree(TEST_DB_DIR)
         os.makedirs(TEST_DB_DIR)
 
-    def new_queue(self):
+    def tearDown(self):
+        shutil.rmtree(TEST_QUEUE_DIR, ignore_errors=True)
+        shutil.rmtree(TEST_DB_DIR, ignore_errors=True)
+
+    def new_queue(self, event_size_max_bytes=10, **queue_kwargs):
         mock_time = MockTime()
         eq = PDQEnqueuer(
             queue_dir=TEST_QUEUE_DIR,
@@ -137,11 +144,12 @@ class PDQueueTest(unittest.TestCase):
             queue_dir=TEST_QUEUE_DIR,
             lock_class=NoOpLock,
             time_calc=mock_time,
-            event_size_max_bytes=10,
+            event_size_max_bytes=event_size_max_bytes,
             backoff_interval=BACKOFF_INTERVAL,
             retry_limit_for_possible_errors=ERROR_RETRY_LIMIT,
             backoff_db=MockDB(),
-            counter_db=MockDB()
+            counter_db=MockDB(),
+            **queue_kwargs
             )
         return eq, q
 
@@ -219,9 +227,9 @@ class PDQueueTest(unittest.TestCase):
                 self.assertEqual(event_id, i)
                 return ConsumeEvent.CONSUMED
             return consume
-        q.dequeue(verify_and_consume("foo", f_foo))
-        q.dequeue(verify_and_consume("bar", f_bar))
-        q.dequeue(verify_and_consume("baz", f_baz))
+        q.dequeue(verify_and_consume(b"foo", f_foo))
+        q.dequeue(verify_and_consume(b"bar", f_bar))
+        q.dequeue(verify_and_consume(b"baz", f_baz))
 
         # check queue is empty
         self.assertEqual(q._queued_files(), [])
@@ -279,7 +287,7 @@ class PDQueueTest(unittest.TestCase):
         f_foo, _ = eq.enqueue("svckey", "foo")
 
         def erroneous_consume_foo(s, i):
-            self.assertEqual("foo", s)
+            self.assertEqual(b"foo", s)
             self.assertEqual(f_foo, i)
             return ConsumeEvent.BAD_ENTRY
         q.dequeue(erroneous_consume_foo)
@@ -359,14 +367,14 @@ class PDQueueTest(unittest.TestCase):
 
         def consume_with_backoff(s, i):
             events_processed.append(s)
-            if count == 1 and s == "baz" and i == e2_1:
+            if count == 1 and s == b"baz" and i == e2_1:
                 # good service key; processed only once.
                 return ConsumeEvent.CONSUMED
-            elif count <= max_total_attempts and s == "foo" and i == e1_1:
+            elif count <= max_total_attempts and s == b"foo" and i == e1_1:
                 # while back-off limit is not exceeded for bad event, only first
                 # event for service key is processed.
                 return ConsumeEvent.BACKOFF_SVCKEY_BAD_ENTRY
-            elif count == max_total_attempts and s == "bar" and i == e1_2:
+            elif count == max_total_attempts and s == b"bar" and i == e1_2:
                 # when back-off limit has exceeded, bad event is kicked out, and
                 # next event is finally processed.
                 return ConsumeEvent.CONSUMED
@@ -379,12 +387,15 @@ class PDQueueTest(unittest.TestCase):
         # flush once.
         count += 1
         events_processed = []
-        q.flush(consume_with_backoff, lambda: False)
-        self.assertEqual(events_processed, ["foo", "baz"])  # 1 bad, 1 good
+        pass_stats = q.flush(consume_with_backoff, lambda: False)
+        self.assertEqual(events_processed, [b"foo", b"baz"])  # 1 bad, 1 good
         self.assertEqual(q._queued_files(), [e1_1, e1_2])  # 2 from bad svckey
         self.assertEqual(len(q._queued_files("err")), 0)  # no error yet.
         self._assertBackoffData(q, [("svckey1", 1, 0)])
         self._assertCounterData(q, (1, 0))
+        # the pass reports that a service key is backing off.
+        self.assertTrue(pass_stats["throttled"])
+        self.assertEqual(pass_stats, q.get_stats()["last_flush"])
 
         # retry immediately. later-retriable events must not be processed.
         events_processed = []
@@ -401,7 +412,7 @@ class PDQueueTest(unittest.TestCase):
             count += 1
             events_processed = []
             q.flush(consume_with_backoff, lambda: False)
-            self.assertEqual(events_processed, ["foo"])  # bad event
+            self.assertEqual(events_processed, [b"foo"])  # bad event
             self.assertEqual(q._queued_files(), [e1_1, e1_2])  # bad svckey's
             self.assertEqual(len(q._queued_files("err")), 0)  # no error yet
             self._assertBackoffData(q, [("svckey1", i, i-1)])
@@ -413,7 +424,7 @@ class PDQueueTest(unittest.TestCase):
         count += 1
         events_processed = []
         q.flush(consume_with_backoff, lambda: False)
-        self.assertEqual(events_processed, ["foo", "bar"])  # bad + next events
+        self.assertEqual(events_processed, [b"foo", b"bar"])  # bad + next events
         self.assertEqual(len(q._queued_files()), 0)
         self.assertEqual(
             q._queued_files("err"),
@@ -447,16 +458,16 @@ class PDQueueTest(unittest.TestCase):
 
         def consume_with_backoff(s, i):
             events_processed.append(s)
-            if count == 1 and s == "baz":
+            if count == 1 and s == b"baz":
                 # good service key; processed only once.
                 return ConsumeEvent.CONSUMED
-            elif count <= max_total_attempts + 1 and s == "foo" and i == e1_1:
+            elif count <= max_total_attempts + 1 and s == b"foo" and i == e1_1:
                 # until, and even after, back-off limit has exceeded, bad event
                 # is processed. (Next event is processed only when bad event
                 # becomes good.)
                 return ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED
             elif count == max_total_attempts + 2 and \
-                    ((s == "foo" and i == e1_1) or s == "bar" and i == e1_2):
+                    ((s == b"foo" and i == e1_1) or s == b"bar" and i == e1_2):
                 # next event finally processed because all events are now good.
                 return ConsumeEvent.CONSUMED
             else:
@@ -468,7 +479,7 @@ class PDQueueTest(unittest.TestCase):
         count += 1
         events_processed = []
         q.flush(consume_with_backoff, lambda: False)
-        self.assertEqual(events_processed, ["foo", "baz"])  # 1 bad, 1 good
+        self.assertEqual(events_processed, [b"foo", b"baz"])  # 1 bad, 1 good
         self.assertEqual(q._queued_files(), [e1_1, e1_2])  # 2 from bad svckey
         self.assertEqual(len(q._queued_files("err")), 0)  # no error yet.
         self._assertBackoffData(q, [("svckey1", 1, 0)])
@@ -489,7 +500,7 @@ class PDQueueTest(unittest.TestCase):
             count += 1
             events_processed = []
             q.flush(consume_with_backoff, lambda: False)
-            self.assertEqual(events_processed, ["foo"])  # bad event
+            self.assertEqual(events_processed, [b"foo"])  # bad event
             self.assertEqual(q._queued_files(), [e1_1, e1_2])  # bad svckey's
             self.assertEqual(len(q._queued_files("err")), 0)  # no error yet
             self._assertBackoffData(q, [("svckey1", i, i-1)])
@@ -502,7 +513,7 @@ class PDQueueTest(unittest.TestCase):
             count += 1
             events_processed = []
             q.flush(consume_with_backoff, lambda: False)
-            self.assertEqual(events_processed, ["foo"])  # bad event
+            self.assertEqual(events_processed, [b"foo"])  # bad event
             self.assertEqual(q._queued_files(), [e1_1, e1_2])  # bad svckey's
             self.assertEqual(len(q._queued_files("err")), 0)  # still no errors
             self._assertBackoffData(
@@ -516,7 +527,7 @@ class PDQueueTest(unittest.TestCase):
         count += 1
         events_processed = []
         q.flush(consume_with_backoff, lambda: False)
-        self.assertEqual(events_processed, ["foo", "bar"])  # all good events
+        self.assertEqual(events_processed, [b"foo", b"bar"])  # all good events
         self.assertEqual(len(q._queued_files()), 0)
         self.assertEqual(len(q._queued_files("err")), 0)   # no errors
         self._assertBackoffData(q, None)
@@ -542,7 +553,7 @@ class PDQueueTest(unittest.TestCase):
 
         def consume_with_stopall(s, i):
             events_processed.append(s)
-            if count == 1 and s == "foo" and i == f_foo:
+            if count == 1 and s == b"foo" and i == f_foo:
                 # first time, we'll ask that no further events be processed.
                 return ConsumeEvent.STOP_ALL
             elif count == 2:
@@ -557,7 +568,7 @@ class PDQueueTest(unittest.TestCase):
         count += 1
         events_processed = []
         q.flush(consume_with_stopall, lambda: False)
-        self.assertEqual(events_processed, ["foo"])
+        self.assertEqual(events_processed, [b"foo"])
         self.assertEqual(len(q._queued_files()), 3)  # 2 from bad svckey
         self.assertEqual(len(q._queued_files("err")), 0)  # no error events
         self._assertCounterData(q, (0, 0))
@@ -566,7 +577,7 @@ class PDQueueTest(unittest.TestCase):
         count += 1
         events_processed = []
         q.flush(consume_with_stopall, lambda: False)
-        self.assertEqual(events_processed, ["foo", "bar", "baz"])
+        self.assertEqual(events_processed, [b"foo", b"bar", b"baz"])
         self.assertEqual(len(q._queued_files()), 0)
         self.assertEqual(len(q._queued_files("err")), 0)  # no error events
         self._assertCounterData(q, (3, 0))
@@ -576,6 +587,682 @@ class PDQueueTest(unittest.TestCase):
             EmptyQueueError, q.dequeue, lambda s: ConsumeEvent.CONSUMED
             )
 
+    def test_flush_round_robin(self):
+        # service keys must take turns, starting with the oldest event.
+        eq, q = self.new_queue(flush_policy="round_robin")
+        for (svc_key, e) in [
+                ("svckey1", "e11"), ("svckey1", "e12"), ("svckey1", "e13"),
+                ("svckey2", "e21"), ("svckey3", "e31"), ("svckey2", "e22"),
+                ]:
+            eq.enqueue(svc_key, e)
+            q.time.sleep(0.05)
+
+        events_processed = []
+
+        def consume(s, i):
+            s = s.decode()
+            events_processed.append(s)
+            return ConsumeEvent.CONSUMED
+        q.flush(consume, lambda: False)
+        self.assertEqual(
+            events_processed, ["e11", "e21", "e31", "e12", "e22", "e13"]
+            )
+        self.assertEqual(len(q._queued_files()), 0)
+
+    def test_flush_priority(self):
+        # triggers must go first, but never ahead of an earlier event of the
+        # same incident.
+        eq, q = self.new_queue(event_size_max_bytes=1000, flush_policy="priority")
+
+        def event(event_type, incident_key, name):
+            return json.dumps({
+                "event_type": event_type,
+                "incident_key": incident_key,
+                "description": name
+                })
+        for (svc_key, e) in [
+                ("svckey1", event("resolve", "i1", "r1")),
+                ("svckey1", event("acknowledge", "i2", "a2")),
+                ("svckey2", event("trigger", "i3", "t3")),
+                ("svckey1", event("trigger", "i1", "t1")),
+                ("svckey1", event("trigger", None, "t")),
+                ("svckey2", event("resolve", "i3", "r3")),
+                ("svckey1", "bad json"),
+                ]:
+            eq.enqueue(svc_key, e)
+            q.time.sleep(0.05)
+
+        events_processed = []
+
+        def consume(s, i):
+            s = s.decode()
+            try:
+                events_processed.append(json.loads(s)["description"])
+            except ValueError:
+                events_processed.append(s)
+            return ConsumeEvent.CONSUMED
+        q.flush(consume, lambda: False)
+        self.assertEqual(
+            events_processed, ["t3", "t", "bad json", "a2", "r1", "t1", "r3"]
+            )
+        # parsed event info is not held on to after events leave the queue.
+        self.assertEqual(len(q._event_info), 7)
+        self.assertRaises(EmptyQueueError, q.flush, consume, lambda: False)
+        eq.enqueue("svckey1", event("trigger", "i4", "t4"))
+        q.flush(consume, lambda: False)
+        self.assertEqual(list(q._event_info.values()), [("trigger", "i4")])
+
+    def test_flush_limits(self):
+        eq, q = self.new_queue(max_events_per_pass=2)
+        for e in ["e1", "e2", "e3"]:
+            eq.enqueue("svckey1", e)
+            q.time.sleep(1)
+
+        events_processed = []
+
+        def consume(s, i):
+            s = s.decode()
+            events_processed.append(s)
+            q.time.sleep(3)  # simulate slow send.
+            return ConsumeEvent.CONSUMED
+        q.flush(consume, lambda: False)
+        self.assertEqual(events_processed, ["e1", "e2"])
+        self.assertEqual(q.get_stats()["last_flush"], {
+            "policy": "fifo",
+            "events_count": 2,
+            "duration_secs": 6,
+            "limit_reached": True,
+            # e1 waited 3 secs before the pass; e2 waited 2 + 3 secs.
+            "avg_queueing_delay_secs": 4,
+            "max_queueing_delay_secs": 5
+            })
+        q.flush(consume, lambda: False)
+        self.assertEqual(events_processed, ["e1", "e2", "e3"])
+        self.assertEqual(q.get_stats()["last_flush"]["limit_reached"], False)
+
+        # time limit is checked before every event.
+        eq, q = self.new_queue(max_secs_per_pass=5)
+        for e in ["e1", "e2", "e3"]:
+            eq.enqueue("svckey1", e)
+        events_processed = []
+        q.flush(consume, lambda: False)
+        self.assertEqual(events_processed, ["e1", "e2"])
+        self.assertEqual(q.get_stats()["last_flush"]["limit_reached"], True)
+
+    def test_expiry(self):
+        eq, q = self.new_queue(
+            event_ttl_secs=10,
+            event_ttl_secs_by_service_key={"svckey2": 0, "svckey3": 30}
+            )
+        for svc_key in ["svckey1", "svckey2", "svckey3"]:
+            eq.enqueue(svc_key, "old")
+        q.time.sleep(20)
+        eq.enqueue("svckey1", "new")
+
+        events_processed = []
+
+        def consume(s, i):
+            s = s.decode()
+            events_processed.append(s)
+            return ConsumeEvent.CONSUMED
+        q.flush(consume, lambda: False)
+        self.assertEqual(events_processed, ["old", "old", "new"])
+        self.assertEqual(len(q._queued_files("err")), 1)
+        self.assertTrue(q._queued_files("err")[0].endswith("_svckey1.txt"))
+        self.assertEqual(q.get_stats()["aggregate"]["expired_events_count"], 1)
+
+        # expired events are not handed out by dequeue either.
+        eq.enqueue("svckey1", "old")
+        q.time.sleep(20)
+        q.dequeue(consume)
+        self.assertEqual(events_processed, ["old", "old", "new"])
+        self.assertEqual(q.get_stats()["aggregate"]["expired_events_count"], 2)
+
+    def test_compaction(self):
+        def event(event_type, incident_key, name):
+            return json.dumps({
+                "event_type": event_type,
+                "incident_key": incident_key,
+                "description": name
+                })
+        events = [
+            ("svckey1", event("trigger", "i1", "t1")),
+            ("svckey1", event("acknowledge", "i1", "a1")),
+            ("svckey2", event("trigger", "i1", "t1'")),
+            ("svckey1", event("resolve", "i1", "r1")),
+            ("svckey1", event("acknowledge", "i2", "a2")),
+            ("svckey1", event("resolve", "i2", "r2")),
+            ("svckey1", event("trigger", "i1", "t1 again")),
+            ("svckey1", "bad json"),
+            ]
+
+        def flush(q):
+            events_processed = []
+
+            def consume(s, i):
+                s = s.decode()
+                try:
+                    events_processed.append(json.loads(s)["description"])
+                except ValueError:
+                    events_processed.append(s)
+                return ConsumeEvent.CONSUMED
+            q.flush(consume, lambda: False)
+            return events_processed
+
+        # compaction is off by default.
+        eq, q = self.new_queue(event_size_max_bytes=1000)
+        for (svc_key, e) in events:
+            eq.enqueue(svc_key, e)
+            q.time.sleep(0.05)
+        self.assertEqual(len(flush(q)), len(events))
+
+        eq, q = self.new_queue(
+            event_size_max_bytes=1000, compaction="keep_resolve"
+            )
+        for (svc_key, e) in events:
+            eq.enqueue(svc_key, e)
+            q.time.sleep(0.05)
+        self.assertEqual(
+            flush(q), ["t1'", "r1", "r2", "t1 again", "bad json"]
+            )
+        self.assertEqual(len(q._queued_files("suc")), len(events))
+        self.assertEqual(
+            q.get_stats()["aggregate"]["compacted_events_count"], 3
+            )
+
+        eq, q = self.new_queue(
+            event_size_max_bytes=1000,
+            compaction="drop_resolved",
+            compaction_target="err"
+            )
+        for (svc_key, e) in events:
+            eq.enqueue(svc_key, e)
+            q.time.sleep(0.05)
+        # r2 is kept since the incident was not triggered in the queue.
+        self.assertEqual(flush(q), ["t1'", "r2", "t1 again", "bad json"])
+        self.assertEqual(len(q._queued_files("err")), 4)
+        self.assertEqual(
+            q.get_stats()["aggregate"]["compacted_events_count"], 4
+            )
+
+    def test_dedup_after_failed_enqueue(self):
+        eq, q = self.new_queue()
+        dedup_eq = PDQEnqueuer(
+            queue_dir=TEST_QUEUE_DIR,
+            lock_class=NoOpLock,
+            time_calc=q.time,
+            enqueue_file_mode=0o644,
+            default_umask=0o22,
+            dedup_window_secs=60,
+            quota_max_entries=1
+            )
+        usage_file = q._abspath("", pdqueue.QUEUE_USAGE_FILE)
+        write_file(usage_file, json.dumps({"bytes": 10, "entries": 1}))
+
+        # the queue is full, and the event is not recorded as queued...
+        self.assertRaises(
+            pdqueue.QueueFullError, dedup_eq.enqueue, "svckey1", "e1"
+            )
+        self.assertEqual(q._queued_files("dup"), [])
+
+        # ...so that a retry queues it once there is room.
+        write_file(usage_file, json.dumps({"bytes": 0, "entries": 0}))
+        f, problems = dedup_eq.enqueue("svckey1", "e1")
+        self.assertNotEqual(f, None)
+        self.assertEqual(problems, [])
+        self.assertEqual(q._queued_files(), [f])
+        self.assertEqual(len(q._queued_files("dup")), 1)
+
+        # a failure while queueing also removes the marker.
+        def failing_link(*args, **kwargs):
+            raise OSError("link failed")
+        dedup_eq._link_with_retry = failing_link
+        self.assertRaises(OSError, dedup_eq.enqueue, "svckey1", "e2")
+        self.assertEqual(len(q._queued_files("dup")), 1)
+        del dedup_eq._link_with_retry
+        f2, _ = dedup_eq.enqueue("svckey1", "e2")
+        self.assertEqual(q._queued_files(), [f, f2])
+
+    def test_dedup(self):
+        eq, q = self.new_queue(dedup_window_secs=60, dedup_max_entries=2)
+        eq.dedup_window_secs = 60
+        # start in the middle of a dedup bucket.
+        q.time.sleep(90 - int(q.time.time()) % 60)
+
+        def event(name, queued_at):
+            return json.dumps({
+                "description": name,
+                "agent": {"queued_at": queued_at}
+                })
+
+        f, problems = eq.enqueue("svckey1", event("e1", "t1"))
+        self.assertNotEqual(f, None)
+        self.assertEqual(problems, [])
+        # the queue time does not make an event different.
+        q.time.sleep(20)
+        f, problems = eq.enqueue("svckey1", event("e1", "t2"))
+        self.assertEqual(f, None)
+        self.assertEqual(problems, [EnqueueWarnings.DUPLICATE_EVENT])
+        # the service key and the rest of the event do.
+        self.assertNotEqual(eq.enqueue("svckey2", event("e1", "t2"))[0], None)
+        self.assertNotEqual(eq.enqueue("svckey1", event("e2", "t2"))[0], None)
+        self.assertEqual(len(q._queued_files()), 3)
+
+        # the window is not cut short by the next bucket.
+        q.time.sleep(30)
+        self.assertEqual(eq.enqueue("svckey1", event("e1", "t3"))[0], None)
+        q.time.sleep(20)
+        self.assertNotEqual(eq.enqueue("svckey1", event("e1", "t4"))[0], None)
+        self.assertEqual(eq.enqueue("svckey1", event("e1", "t5"))[0], None)
+        self.assertEqual(len(q._queued_files()), 4)
+
+        # old markers are pruned, and then those of the oldest buckets beyond
+        # the limit.
+        self.assertEqual(len(q._queued_files("dup")), 4)
+        q.prune_dedup_index()
+        markers = q._queued_files("dup")
+        self.assertEqual(len(markers), 2)
+        self.assertTrue(
+            markers[-1].endswith(pdqueue._dedup_hash("svckey1", event("e1", "")))
+            )
+        q.time.sleep(120)
+        q.prune_dedup_index()
+        self.assertEqual(len(q._queued_files("dup")), 0)
+
+        # a broken index does not stop events from being queued.
+        shutil.rmtree(os.path.join(TEST_QUEUE_DIR, "dup"))
+        self.assertNotEqual(eq.enqueue("svckey1", event("e1", "t5"))[0], None)
+        self.assertNotEqual(eq.enqueue("svckey1", event("e1", "t5"))[0], None)
+
+    def test_storm_control(self):
+        eq, q = self.new_queue(
+            event_size_max_bytes=1000,
+            storm_max_triggers=3,
+            storm_window_secs=60
+            )
+
+        def event(event_type, incident_key):
+            return json.dumps({
+                "event_type": event_type,
+                "incident_key": incident_key,
+                "description": "%s %s" % (event_type, incident_key)
+                })
+
+        events_processed = []
+
+        def consume(s, i):
+            events_processed.append(json.loads(s))
+            return ConsumeEvent.CONSUMED
+
+        def flush():
+            del events_processed[:]
+            q.flush(consume, lambda: False)
+            return [e["description"] for e in events_processed]
+
+        # triggers within the limit are sent as usual.
+        for i in range(3):
+            eq.enqueue("svckey1", event("trigger", "i%d" % i))
+        self.assertEqual(len(flush()), 3)
+        self.assertFalse("storms" in q.get_stats())
+
+        # the storm starts, and the pending triggers are summarized.
+        q.time.sleep(10)
+        for i in range(3, 5):
+            eq.enqueue("svckey1", event("trigger", "i%d" % i))
+        eq.enqueue("svckey1", event("resolve", "i0"))
+        eq.enqueue("svckey2", event("trigger", "j0"))
+        self.assertEqual(sorted(flush()), ["resolve i0", "trigger j0"])
+        self.assertEqual(
+            q.get_stats()["storms"]["svckey1"]["suppressed_events_count"], 2
+            )
+        summary = flush()
+        self.assertEqual(len(summary), 1)
+        summary = events_processed[0]
+        self.assertEqual(summary["service_key"], "svckey1")
+        self.assertEqual(summary["incident_key"], pdqueue.STORM_INCIDENT_KEY)
+        self.assertEqual(summary["details"]["aggregated_events_count"], 2)
+        self.assertEqual(
+            summary["details"]["incident_keys_sample"], ["i3", "i4"]
+            )
+        # the summarized triggers were not sent.
+        self.assertEqual(len(q._queued_files("err")), 2)
+
+        # further triggers are held back until the next summary is due.
+        q.time.sleep(10)
+        eq.enqueue("svckey1", event("trigger", "i5"))
+        eq.enqueue("svckey1", event("acknowledge", "i5"))
+        self.assertEqual(flush(), ["acknowledge i5"])
+        self.assertEqual(len(q._queued_files()), 1)
+
+        # the storm is over once the rate goes down, and the held back
+        # triggers are summarized.
+        q.time.sleep(60)
+        self.assertEqual(flush(), [])
+        self.assertFalse("storms" in q.get_stats())
+        self.assertEqual(
+            q.get_stats()["aggregate"]["storm_suppressed_events_count"], 3
+            )
+        self.assertEqual(len(flush()), 1)
+        self.assertEqual(
+            events_processed[0]["details"]["incident_keys_sample"], ["i5"]
+            )
+        eq.enqueue("svckey1", event("trigger", "i6"))
+        self.assertEqual(flush(), ["trigger i6"])
+
+    def test_rejected_service_key(self):
+        eq, q = self.new_queue(
+            rejected_keys_db=MockDB(), rejected_key_ttl_secs=60
+            )
+        for svc_key in ["svckey1", "svckey1", "svckey2", "svckey1"]:
+            eq.enqueue(svc_key, svc_key)
+            q.time.sleep(1)
+
+        events_processed = []
+
+        def consume(s, i):
+            s = s.decode()
+            events_processed.append(s)
+            if s == "svckey1":
+                return ConsumeEvent.BAD_SVCKEY
+            return ConsumeEvent.CONSUMED
+
+        # the remaining events of a rejected key fail without being sent.
+        q.flush(consume, lambda: False)
+        self.assertEqual(events_processed, ["svckey1", "svckey2"])
+        self.assertEqual(len(q._queued_files("err")), 3)
+        self.assertEqual(
+            q.get_stats()["rejected_service_keys"], {"svckey1": 60}
+            )
+        self.assertEqual(q.get_stats()["aggregate"]["failed_events_count"], 3)
+
+        # the rejection is persisted, and holds until it expires...
+        eq, q = self.new_queue(
+            rejected_keys_db=q.rejected_keys_info._db,
+            rejected_key_ttl_secs=60
+            )
+        q.time.sleep(10)
+        eq.enqueue("svckey1", "svckey1")
+        q.flush(consume, lambda: False)
+        self.assertEqual(len(events_processed), 2)
+        q.time.sleep(60)
+        eq.enqueue("svckey1", "svckey1")
+        q.flush(consume, lambda: False)
+        self.assertEqual(len(events_processed), 3)
+
+        # ... or until events of the key are retried.
+        self.assertEqual(q.resurrect("svckey1"), 5)
+        self.assertFalse("rejected_service_keys" in q.get_stats())
+        q.dequeue(consume)
+        self.assertEqual(len(events_processed), 4)
+
+    def test_skip_redundant_events(self):
+        eq, q = self.new_queue(
+            event_size_max_bytes=1000,
+            incident_states_db=MockDB(),
+            incident_states_max_entries=2,
+            incident_states_ttl_secs=3600
+            )
+
+        def event(event_type, incident_key):
+            return json.dumps({
+                "event_type": event_type,
+                "incident_key": incident_key
+                })
+
+        events_processed = []
+
+        def consume(s, i):
+            events_processed.append(json.loads(s))
+            return ConsumeEvent.CONSUMED
+
+        def flush(*events):
+            del events_processed[:]
+            for (event_type, incident_key) in events:
+                eq.enqueue("svckey1", event(event_type, incident_key))
+                q.time.sleep(0.01)
+            q.flush(consume, lambda: False)
+            return [
+                (e["event_type"], e["incident_key"]) for e in events_processed
+                ]
+
+        # events of unknown or unresolved incidents are sent.
+        self.assertEqual(
+            flush(("acknowledge", "i1"), ("resolve", "i1"), ("resolve", "i1")),
+            [("acknowledge", "i1"), ("resolve", "i1")]
+            )
+        self.assertEqual(flush(("acknowledge", "i1")), [])
+        self.assertEqual(
+            q.get_stats()["incident_states"],
+            {"entries_count": 1, "lookups_count": 4, "hits_count": 2}
+            )
+        self.assertEqual(
+            q.get_stats()["aggregate"]["redundant_events_count"], 2
+            )
+        self.assertEqual(len(q._queued_files("suc")), 4)
+
+        # a new trigger makes the incident resolvable again.
+        self.assertEqual(
+            flush(("trigger", "i1"), ("resolve", "i1")),
+            [("trigger", "i1"), ("resolve", "i1")]
+            )
+
+        # states are persisted, and the least recently updated are evicted.
+        eq, q = self.new_queue(
+            event_size_max_bytes=1000,
+            incident_states_db=q.incident_state_info._db,
+            incident_states_max_entries=2,
+            incident_states_ttl_secs=3600
+            )
+        q.time.sleep(10)
+        self.assertEqual(flush(("resolve", "i1")), [])
+        flush(("resolve", "i2"), ("resolve", "i3"))
+        self.assertEqual(flush(("resolve", "i1")), [("resolve", "i1")])
+
+        # states expire.
+        q.time.sleep(3601)
+        self.assertEqual(flush(("resolve", "i1")), [("resolve", "i1")])
+
+    def test_event_validation(self):
+        eq, q = self.new_queue(
+            event_size_max_bytes=10000,
+            event_validator=make_event_validator(max_description_len=10)
+            )
+
+        def event(**fields):
+            d = {"service_key": "svckey1"}
+            d.update(fields)
+            return json.dumps(d)
+        valid_events = [
+            event(event_type="trigger", description="d"),
+            event(event_type="acknowledge", incident_key="i"),
+            ]
+        invalid_events = [
+            "bad json",
+            "[]",
+            event(event_type="trigger", description="d", service_key=""),
+            event(event_type="snooze", incident_key="i"),
+            event(event_type="trigger"),
+            event(event_type="trigger", description="   "),
+            event(event_type="trigger", description="d" * 11),
+            event(event_type="trigger", description=1),
+            event(event_type="resolve"),
+            ]
+        for e in valid_events + invalid_events:
+            eq.enqueue("svckey1", e)
+            q.time.sleep(0.01)
+
+        events_processed = []
+
+        def consume(s, i):
+            s = s.decode()
+            events_processed.append(s)
+            return ConsumeEvent.CONSUMED
+        q.flush(consume, lambda: False)
+        self.assertEqual(events_processed, valid_events)
+        self.assertEqual(len(q._queued_files("err")), len(invalid_events))
+        stats = q.get_stats()
+        self.assertEqual(
+            stats["aggregate"]["invalid_events_count"], len(invalid_events)
+            )
+        self.assertEqual(
+            stats["last_flush"]["validated_events_count"],
+            len(valid_events) + len(invalid_events)
+            )
+        self.assertTrue("validation_secs" in stats["last_flush"])
+
+    def test_consume_bytes(self):
+        eq, q = self.new_queue(
+            event_size_max_bytes=10000,
+            event_validator=make_event_validator()
+            )
+        e = json.dumps({
+            "service_key": "svckey1",
+            "event_type": "trigger",
+            "description": u"d\u00e9j\u00e0 vu",
+            }, ensure_ascii=False)
+        eq.enqueue("svckey1", e)
+
+        events_processed = []
+
+        def consume(s, i):
+            events_processed.append(s)
+            return ConsumeEvent.CONSUMED
+        q.flush(consume, lambda: False)
+        # validated events are passed on as bytes, like unparsed ones.
+        self.assertEqual(events_processed, [e.encode("utf-8")])
+
+    def test_payload_cache(self):
+        eq, q = self.new_queue(payload_cache_max_bytes=8)
+        for (svc_key, e) in [
+                ("svckey1", "a1"), ("svckey2", "b1"), ("svckey3", "c1"),
+                ("svckey4", "toolong12"), ("svckey1", "a2")
+                ]:
+            eq.enqueue(svc_key, e)
+            q.time.sleep(1)
+
+        events_processed = []
+        consume_codes = {"a1": ConsumeEvent.CONSUMED}
+
+        def consume(s, i):
+            s = s.decode()
+            events_processed.append(s)
+            return consume_codes.get(
+                s, ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED
+                )
+
+        # events that stay queued are cached, within the byte budget.
+        q.flush(consume, lambda: False)
+        self.assertEqual(
+            sorted(q.payload_cache._entries.keys()),
+            sorted(f for f in q._queued_files() if not "svckey4" in f)
+            )
+        self.assertEqual(q.get_stats()["payload_cache"], {
+            "entries_count": 3,
+            "bytes": 6,
+            "max_bytes": 8,
+            "hits_count": 0,
+            "misses_count": 0,
+            "evictions_count": 0
+            })
+
+        # retries are served from memory...
+        q.time.sleep(BACKOFF_INTERVAL)
+        del events_processed[:]
+        q.flush(consume, lambda: False)
+        self.assertEqual(events_processed, ["b1", "c1", "toolong12", "a2"])
+        stats = q.get_stats()["payload_cache"]
+        self.assertEqual(stats["hits_count"], 3)
+        self.assertEqual(stats["misses_count"], 0)
+
+        # ... unless the file has changed, and within the byte budget.
+        q.time.sleep(BACKOFF_INTERVAL)
+        fname_b1 = [f for f in q._queued_files() if "svckey2" in f][0]
+        with open(q._abspath("pdq", fname_b1), "w") as f:
+            f.write("b1 chg")
+        del events_processed[:]
+        q.flush(consume, lambda: False)
+        self.assertEqual(events_processed, ["b1 chg", "c1", "toolong12", "a2"])
+        stats = q.get_stats()["payload_cache"]
+        self.assertTrue(stats["evictions_count"] > 0)
+        # (the changed event, and the evicted events that were read again.)
+        self.assertEqual(stats["misses_count"], 3)
+        self.assertTrue(stats["bytes"] <= 8)
+        self.assertEqual(
+            stats["bytes"],
+            sum(len(p) for (_, p) in q.payload_cache._entries.values())
+            )
+
+    def test_prefetch(self):
+        eq, q = self.new_queue(prefetch_events=2)
+        for (svc_key, e) in [
+                ("svckey1", "a1"), ("svckey1", "a2"), ("svckey2", "b1"),
+                ("svckey3", "c1"), ("svckey2", "b2"), ("svckey3", "c2")
+                ]:
+            eq.enqueue(svc_key, e)
+            q.time.sleep(1)
+
+        events_processed = []
+
+        def consume(s, i):
+            s = s.decode()
+            events_processed.append(s)
+            # give read-ahead a chance to fill its buffer.
+            time.sleep(0.05)
+            if s == "b1":
+                return ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED
+            return ConsumeEvent.CONSUMED
+
+        q.flush(consume, lambda: False)
+        self.assertEqual(events_processed, ["a1", "a2", "b1", "c1", "c2"])
+        # every event after the first was read ahead.
+        self.assertEqual(
+            q.get_stats()["last_flush"]["prefetched_events_count"], 4
+            )
+
+        # events of backed-off service keys are not read ahead.
+        eq.enqueue("svckey2", "b3")
+        eq.enqueue("svckey4", "d1")
+        opened = []
+        real_open = open
+
+        def recording_open(path, *args):
+            opened.append(os.path.basename(path))
+            return real_open(path, *args)
+        with mock.patch.object(pdqueue, "open", recording_open, create=True):
+            q.flush(consume, lambda: False)
+        self.assertEqual(events_processed[-1], "d1")
+        self.assertFalse(any("svckey2" in f for f in opened))
+
+    def test_prefetch_skips_failing_service_key(self):
+        eq, q = self.new_queue(prefetch_events=1)
+        for (svc_key, e) in [
+                ("svckey1", "a1"), ("svckey2", "b1"), ("svckey2", "b2"),
+                ("svckey2", "b3"), ("svckey1", "a2")
+                ]:
+            eq.enqueue(svc_key, e)
+            q.time.sleep(1)
+
+        def consume(s, i):
+            if s == b"a1":
+                return ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED
+            return ConsumeEvent.CONSUMED
+
+        # once a service key fails in a pass, its later events are not read
+        # ahead.
+        opened = []
+        real_open = open
+
+        def recording_open(path, *args):
+            opened.append(os.path.basename(path))
+            return real_open(path, *args)
+        with mock.patch.object(pdqueue, "open", recording_open, create=True):
+            q.flush(consume, lambda: False)
+        # (a1 and a2 remain queued.)
+        queued = q._queued_files()
+        self.assertEqual(len(queued), 2)
+        self.assertTrue(queued[0] in opened)
+        self.assertFalse(queued[1] in opened)
+
     def test_enqueue_never_blocks(self):
         # test that a read lock during dequeue does not block an enqueue
         eq, q = self.new_queue()
@@ -673,7 +1360,7 @@ class PDQueueTest(unittest.TestCase):
             time.sleep(0.1)
             self.assertEqual(trace, ["q1_A1", "q1_A2", "q2_A1"])
             # consume the item
-            trace.append("q1_C:" + s)
+            trace.append("q1_C:" + s.decode())
             return ConsumeEvent.CONSUMED
 
         q1.dequeue(consume1)
@@ -917,6 +1604,556 @@ class PDQueueTest(unittest.TestCase):
         # counters should not be touched.
         self._assertCounterData(q, None)
 
+    def test_reconfigure_backoff(self):
+        eq, q = self.new_queue()
+        e1, _ = eq.enqueue("svckey1", "foo")
+        e2, _ = eq.enqueue("svckey2", "bar")
+
+        def consume(s, i):
+            if s == b"foo":
+                return ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED
+            return ConsumeEvent.BACKOFF_SVCKEY_BAD_ENTRY
+        q.flush(consume, lambda: False)
+        self._assertBackoffData(q, [("svckey1", 1, 0), ("svckey2", 1, 0)])
+
+        # keys already backing off keep their retry times...
+        q.reconfigure_backoff(BACKOFF_INTERVAL * 4, 0)
+        q.flush(consume, lambda: False)
+        self._assertBackoffData(q, [("svckey1", 1, 0), ("svckey2", 1, 0)])
+
+        # ...and later back-offs use the new settings.
+        q.time.sleep(BACKOFF_INTERVAL)
+        q.flush(consume, lambda: False)
+        retry_at = int(q.time.time() + BACKOFF_INTERVAL * 4)
+        self.assertEqual(q.backoff_info._db.get(), {
+            "attempts": {"svckey1": 2},
+            "next_retries": {"svckey1": retry_at}
+            })
+        # (with a retry limit of 0, bar is now considered a bad event.)
+        self.assertEqual(q._queued_files("err"), [e2])
+
+    def test_stats_are_copies(self):
+        # stats are taken on another thread than the flush, so they must not
+        # share dicts that the flush changes.
+        eq, q = self.new_queue()
+        eq.enqueue("svckey1", "a1")
+        q.flush(lambda s, i: ConsumeEvent.CONSUMED, lambda: False)
+        q._storms["svckey1"] = {
+            "started_on": "2014-03-18T00:00:00Z",
+            "last_summary_time": None,
+            "suppressed_events_count": 0
+            }
+        stats = q.get_stats()
+        self.assertEqual(stats["aggregate"]["successful_events_count"], 1)
+        q.counter_info.increment_success()
+        q.counter_info.increment_failure()
+        q._storms["svckey2"] = q._storms["svckey1"]
+        self.assertEqual(stats["aggregate"]["successful_events_count"], 1)
+        self.assertFalse("failed_events_count" in stats["aggregate"])
+        self.assertEqual(list(stats["storms"].keys()), ["svckey1"])
+
+    def test_compression_stats(self):
+        compression_db = MockDB()
+        eq, q = self.new_queue(compression_db=compression_db)
+        self.assertTrue("compression" not in q.get_stats())
+        stats = {"compressed_requests_count": 2, "compression_ratio": 3.0}
+        q.record_compression_stats(stats)
+        self.assertEqual(q.get_stats()["compression"], stats)
+        # other processes report what the agent recorded.
+        eq, q2 = self.new_queue(compression_db=compression_db)
+        self.assertEqual(q2.get_stats()["compression"], stats)
+
+    def test_cleanup_time_sliced(self):
+        eq, q = self.new_queue()
+        old_time = int(q.time.time()) - 2000
+        for i in range(4):
+            fname = "%d_svckey%d.txt" % ((old_time + i) * 1000 * 1000, i)
+            fpath = os.path.join(q.queue_dir, "err", fname)
+            os.close(os.open(fpath, os.O_CREAT))
+
+        # every removal takes a second; after every 2 seconds of work, the
+        # cleanup pauses for 10 seconds.
+        real_mock_time = q.time.time
+        sleeps = []
+
+        def ticking_time():
+            q.time._time_sec += 1
+            return real_mock_time()
+
+        def recording_sleep(duration_sec):
+            sleeps.append(duration_sec)
+            q.time._time_sec += duration_sec
+
+        q.time.time = ticking_time
+        q.time.sleep = recording_sleep
+
+        stats = q.cleanup(1500, slice_secs=2, pause_secs=10)
+        self.assertEqual(stats["removed_files_count"], 4)
+        self.assertEqual(stats["removed_packs_count"], 0)
+        self.assertTrue(stats["completed"])
+        self.assertTrue(len(sleeps) > 0)
+        self.assertTrue(all(s == 10 for s in sleeps))
+        self.assertTrue(stats["duration_secs"] >= 10 * len(sleeps))
+        self.assertEqual(q._queued_files("err"), [])
+        self.assertEqual(q.get_stats()["last_cleanup"], stats)
+
+    def test_cleanup_stop_check(self):
+        eq, q = self.new_queue()
+        old_time = int(q.time.time()) - 2000
+        fnames = []
+        for i in range(3):
+            fname = "%d_svckey%d.txt" % ((old_time + i) * 1000 * 1000, i)
+            os.close(os.open(
+                os.path.join(q.queue_dir, "err", fname), os.O_CREAT
+                ))
+            fnames.append(fname)
+
+        # stop after the first removal; the rest is left for the next run.
+        stats = q.cleanup(1500, stop_check_func=lambda: True)
+        self.assertEqual(stats["removed_files_count"], 1)
+        self.assertFalse(stats["completed"])
+        self.assertEqual(q._queued_files("err"), fnames[1:])
+
+        stats = q.cleanup(1500)
+        self.assertEqual(stats["removed_files_count"], 2)
+        self.assertTrue(stats["completed"])
+        self.assertEqual(q._queued_files("err"), [])
+
+    def test_success_receipts(self):
+        eq, q = self.new_queue(
+            event_size_max_bytes=1000,
+            success_policy="receipt",
+            receipt_log_max_bytes=300,
+            incident_states_db=MockDB(),
+            incident_states_max_entries=10,
+            incident_states_ttl_secs=3600
+            )
+
+        def event(event_type, incident_key):
+            return json.dumps({
+                "service_key": "svckey1",
+                "event_type": event_type,
+                "incident_key": incident_key,
+                })
+        fnames = []
+        for e in [
+                event("trigger", "i1"), event("resolve", "i1"),
+                event("acknowledge", "i1"), event("trigger", "i2"),
+                ]:
+            fnames.append(eq.enqueue("svckey1", e)[0])
+            q.time.sleep(0.5)
+        consume_codes = {
+            fnames[0]: ConsumeEvent.CONSUMED,
+            fnames[1]: ConsumeEvent.CONSUMED,
+            fnames[3]: ConsumeEvent.BAD_ENTRY,
+            }
+        q.flush(lambda s, i: consume_codes[i], lambda: False)
+
+        # sent and redundant events are removed instead of kept.
+        self.assertEqual(q._queued_files(), [])
+        self.assertEqual(q._queued_files("suc"), [])
+        self.assertEqual(q._queued_files("err"), [fnames[3]])
+        receipts = q.receipt_log.read()
+        self.assertEqual(
+            [(r["event"], r["incident_key"], r["status"]) for r in receipts],
+            [
+                (fnames[0], "i1", "sent"),
+                (fnames[1], "i1", "sent"),
+                (fnames[2], "i1", "redundant"),
+            ])
+        self.assertEqual(
+            [r["latency_secs"] for r in receipts], [2.0, 1.5, 1.0]
+            )
+        # the log was rotated on the way.
+        self.assertTrue(os.path.exists(q.receipt_log.path + ".1"))
+
+        # succeeded events are counted from receipts.
+        stats = q.get_stats(detailed_snapshot=True)
+        self.assertEqual(stats["snapshot"]["succeeded_events"]["count"], 3)
+        self.assertEqual(stats["snapshot"]["failed_events"]["count"], 1)
+        self.assertEqual(stats["aggregate"]["successful_events_count"], 2)
+
+    def test_concurrent_queue_usage_writes(self):
+        # the flush and cleanup can publish the usage at the same time.
+        eq, q = self.new_queue()
+        usage_file = q._abspath("", pdqueue.QUEUE_USAGE_FILE)
+        errors = []
+
+        def write_usage(n):
+            try:
+                for i in range(100):
+                    pdqueue._write_queue_usage(usage_file, {"n": n, "i": i})
+            except Exception as e:
+                errors.append(e)
+        threads = [Thread(target=write_usage, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(json.loads(read_file(usage_file))["i"], 99)
+        # no temp files are left behind.
+        self.assertEqual(
+            [f for f in os.listdir(q._abspath("", ""))
+                if f.startswith(pdqueue.QUEUE_USAGE_FILE)],
+            [pdqueue.QUEUE_USAGE_FILE]
+            )
+
+    def test_quota(self):
+        eq, q = self.new_queue(quota_max_bytes=100, quota_max_entries=20)
+        quota_eq = PDQEnqueuer(
+            queue_dir=TEST_QUEUE_DIR,
+            lock_class=NoOpLock,
+            time_calc=q.time,
+            enqueue_file_mode=0o644,
+            default_umask=0o22,
+            quota_max_bytes=100,
+            quota_max_entries=20
+            )
+        # events are queued while there is no published usage.
+        fnames = []
+        for i in range(9):
+            fnames.append(quota_eq.enqueue("svckey1", "event%d" % i)[0])
+            q.time.sleep(0.01)
+        q.flush(lambda s, i: ConsumeEvent.CONSUMED, lambda: False)
+
+        # 9 events of 6 bytes are within 90% of the quota.
+        usage = json.loads(read_file(q._abspath("", pdqueue.QUEUE_USAGE_FILE)))
+        self.assertEqual(usage["bytes"], 54)
+        self.assertEqual(usage["entries"], 9)
+        self.assertEqual(usage["states"]["suc"], {"bytes": 54, "entries": 9})
+        self.assertEqual(q._queued_files("suc"), fnames)
+
+        # up to 90% of the quota, nothing is pruned.
+        for i in range(6):
+            fnames.append(quota_eq.enqueue("svckey2", "event%d" % i)[0])
+            q.time.sleep(0.01)
+        q.flush(lambda s, i: ConsumeEvent.BAD_ENTRY, lambda: False)
+        usage = q.get_stats()["usage"]
+        self.assertEqual(usage["bytes"], 90)
+        self.assertEqual(usage["states"]["err"], {"bytes": 36, "entries": 6})
+        self.assertEqual(q._queued_files("suc"), fnames[:9])
+
+        # going above 90% of the quota prunes the oldest succeeded events.
+        q.resurrect("svckey2")
+        eq.enqueue("svckey3", "x" * 10)
+        q.flush(lambda s, i: ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED,
+                lambda: False)
+        usage = q.get_stats()["usage"]
+        self.assertEqual(usage["bytes"], 88)
+        self.assertEqual(usage["states"]["pdq"]["entries"], 7)
+        self.assertEqual(q._queued_files("suc"), fnames[2:9])
+
+        # events that would go over the quota are not queued.
+        self.assertRaises(
+            pdqueue.QueueFullError, quota_eq.enqueue, "svckey1", "x" * 13
+            )
+        quota_eq.enqueue("svckey1", "x" * 12)
+        # unless no quota is configured.
+        eq.enqueue("svckey1", "x" * 13)
+
+    def test_ram_queue_usage(self):
+        ram_dir = os.path.join(_TEST_DIR, "test_ram_queue")
+        if os.path.exists(ram_dir):
+            shutil.rmtree(ram_dir)
+        for t in pdqueue.RAM_QUEUE_SUBDIRS:
+            os.makedirs(os.path.join(ram_dir, t))
+        self.addCleanup(shutil.rmtree, ram_dir)
+        eq, q = self.new_queue(ram_queue_dir=ram_dir, quota_max_entries=10)
+        ram_eq = PDQEnqueuer(
+            queue_dir=TEST_QUEUE_DIR,
+            lock_class=NoOpLock,
+            time_calc=q.time,
+            enqueue_file_mode=0o644,
+            default_umask=0o22,
+            ram_queue_dir=ram_dir
+            )
+        ram_eq.enqueue("svckey1", "e1")
+        ram_eq.enqueue("svckey1", "e22")
+        # pending events in RAM count towards the quota.
+        q.flush(
+            lambda s, i: ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED,
+            lambda: False
+            )
+        usage = q.get_stats()["usage"]
+        self.assertEqual(usage["states"]["pdq"], {"bytes": 5, "entries": 2})
+
+    def test_ram_queue(self):
+        ram_dir = os.path.join(_TEST_DIR, "test_ram_queue")
+        if os.path.exists(ram_dir):
+            shutil.rmtree(ram_dir)
+        for t in pdqueue.RAM_QUEUE_SUBDIRS:
+            os.makedirs(os.path.join(ram_dir, t))
+        self.addCleanup(shutil.rmtree, ram_dir)
+        eq, q = self.new_queue(ram_queue_dir=ram_dir, ram_spill_secs=5)
+        ram_eq = PDQEnqueuer(
+            queue_dir=TEST_QUEUE_DIR,
+            lock_class=NoOpLock,
+            time_calc=q.time,
+            enqueue_file_mode=0o644,
+            default_umask=0o22,
+            ram_queue_dir=ram_dir
+            )
+
+        def disk_files(ftype):
+            return sorted(os.listdir(os.path.join(TEST_QUEUE_DIR, ftype)))
+
+        # events are queued in RAM only.
+        f1, _ = ram_eq.enqueue("svckey1", "e1")
+        q.time.sleep(3)
+        f2, _ = ram_eq.enqueue("svckey2", "e2")
+        q.time.sleep(3)
+        f3, _ = ram_eq.enqueue("svckey1", "e3")
+        self.assertEqual(q._queued_files(), [f1, f2, f3])
+        self.assertEqual(disk_files("pdq"), [])
+
+        # events older than ram_spill_secs are copied to disk in a pass.
+        q.flush(
+            lambda s, i: ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED,
+            lambda: False
+            )
+        self.assertEqual(disk_files("pdq"), [f1])
+        self.assertEqual(q._queued_files(), [f1, f2, f3])
+
+        # events leave both RAM and disk once processed.
+        q.time.sleep(BACKOFF_INTERVAL)
+        consume_codes = {
+            f1: ConsumeEvent.CONSUMED,
+            f2: ConsumeEvent.BAD_ENTRY,
+            f3: ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED,
+            }
+        q.flush(lambda s, i: consume_codes[i], lambda: False)
+        self.assertEqual(q._queued_files(), [f3])
+        self.assertEqual(disk_files("suc"), [f1])
+        self.assertEqual(disk_files("err"), [f2])
+        self.assertEqual(q._queued_files("err"), [f2])
+        self.assertEqual(disk_files("pdq"), [f3])
+
+        # retried events go back to RAM.
+        q.resurrect()
+        self.assertEqual(q._queued_files(), [f2, f3])
+        self.assertEqual(read_file(q._abspath("pdq", f2)), "e2")
+
+        # everything is spilled when stopping, and replayed when starting
+        # over with an empty RAM queue.
+        self.assertEqual(q.spill(), 1)
+        self.assertEqual(disk_files("pdq"), [f2, f3])
+        for fname in q._queued_files():
+            os.remove(q._abspath("pdq", fname))
+        _, q2 = self.new_queue(ram_queue_dir=ram_dir)
+        self.assertEqual(q2.replay_spill(), 2)
+        self.assertEqual(q2._queued_files(), [f2, f3])
+        self.assertEqual(read_file(q2._abspath("pdq", f3)), "e3")
+        q2.flush(lambda s, i: ConsumeEvent.CONSUMED, lambda: False)
+        self.assertEqual(q2._queued_files(), [])
+        self.assertEqual(disk_files("pdq"), [])
+        self.assertEqual(disk_files("suc"), [f1, f2, f3])
+
+    def test_ram_queue_not_ready(self):
+        ram_dir = os.path.join(_TEST_DIR, "test_ram_queue")
+        if os.path.exists(ram_dir):
+            shutil.rmtree(ram_dir)
+        self.addCleanup(shutil.rmtree, ram_dir, True)
+
+        # before the agent makes the RAM queue directories (e.g. after a
+        # reboot), events are queued on disk rather than lost.
+        eq, q = self.new_queue()
+        ram_eq = PDQEnqueuer(
+            queue_dir=TEST_QUEUE_DIR,
+            lock_class=NoOpLock,
+            time_calc=q.time,
+            enqueue_file_mode=0o644,
+            default_umask=0o22,
+            ram_queue_dir=ram_dir
+            )
+        f1, _ = ram_eq.enqueue("svckey1", "e1")
+        self.assertEqual(
+            os.listdir(os.path.join(TEST_QUEUE_DIR, "pdq")), [f1]
+            )
+
+        # the agent queues them in RAM when it starts.
+        for t in pdqueue.RAM_QUEUE_SUBDIRS:
+            os.makedirs(os.path.join(ram_dir, t))
+        _, ram_q = self.new_queue(ram_queue_dir=ram_dir)
+        self.assertEqual(ram_q.replay_spill(), 1)
+        self.assertEqual(ram_q._queued_files(), [f1])
+        events_processed = []
+
+        def consume(s, i):
+            events_processed.append(s)
+            return ConsumeEvent.CONSUMED
+        ram_q.flush(consume, lambda: False)
+        self.assertEqual(events_processed, [b"e1"])
+        self.assertEqual(
+            os.listdir(os.path.join(TEST_QUEUE_DIR, "pdq")), []
+            )
+
+    def test_head_checkpoint(self):
+        head_db = MockDB()
+        eq, q = self.new_queue(head_db=head_db, head_checkpoint_events=2)
+        f1, _ = eq.enqueue("svckey1", "e1")
+        q.time.sleep(0.05)
+        f2, _ = eq.enqueue("svckey2", "e2")
+        q.time.sleep(0.05)
+        f3, _ = eq.enqueue("svckey3", "e3")
+        q.time.sleep(0.05)
+        f4, _ = eq.enqueue("svckey4", "e4")
+
+        # the oldest events still queued after a pass are remembered.
+        consume_codes = {
+            f1: ConsumeEvent.CONSUMED,
+            f2: ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED,
+            f3: ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED,
+            f4: ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED,
+            }
+        q.flush(lambda s, i: consume_codes[i], lambda: False)
+        self.assertEqual(head_db.get(), {"events": [f2, f3]})
+        self.assertEqual(q.get_stats()["startup"], {
+            "time_to_first_send_secs": 0.15,
+            "head_events_count": 0
+            })
+
+        # after a restart, they are sent before the queue is scanned, and
+        # every event is sent once.
+        _, q2 = self.new_queue(head_db=head_db, head_checkpoint_events=2)
+        calls = []
+        queued_files = q2._queued_files
+
+        def scan(ftype="pdq"):
+            calls.append("scan")
+            return queued_files(ftype)
+
+        def consume(s, i):
+            calls.append(i)
+            return ConsumeEvent.CONSUMED
+
+        q2._queued_files = scan
+        q2.flush(consume, lambda: False)
+        self.assertEqual(calls, [f2, f3, "scan", f4])
+        self.assertEqual(head_db.get(), {"events": []})
+        self.assertEqual(q2.get_stats()["startup"]["head_events_count"], 2)
+
+        # later passes scan the queue first.
+        f5, _ = eq.enqueue("svckey1", "e5")
+        del calls[:]
+        q2.flush(consume, lambda: False)
+        self.assertEqual(calls, ["scan", "scan", f5])
+
+        # the checkpoint is not used with compaction.
+        head_db.set({"events": [f5]})
+        _, q3 = self.new_queue(
+            head_db=head_db, head_checkpoint_events=2,
+            compaction="keep_resolve"
+            )
+        self.assertEqual(q3.head_events_count, 0)
+
+    def test_read_event_bad_names(self):
+        eq, q = self.new_queue()
+        fname, _ = eq.enqueue("svckey1", "a1")
+        self.assertEqual(q.read_event(fname), ("pdq", b"a1"))
+        # names that aren't queue file names are not looked up on disk.
+        opened = []
+        real_open = open
+
+        def recording_open(path, *args):
+            opened.append(path)
+            return real_open(path, *args)
+        with mock.patch.object(pdqueue, "open", recording_open, create=True):
+            for name in [
+                    "../../../etc/passwd",
+                    "/etc/passwd",
+                    "1_../../../etc/passwd.txt",
+                    "../pdq/" + fname,
+                    "." + fname,
+                    "svckey1.txt",
+                    ]:
+                self.assertEqual(q.read_event(name), None)
+        self.assertEqual(opened, [])
+
+    def test_pack(self):
+        eq, q = self.new_queue(pack_after_secs=50, pack_max_events=2)
+        fnames = []
+        for (svc_key, e) in [
+                ("svckey1", "a1"), ("svckey2", "b1"), ("svckey1", "a2"),
+                ("svckey2", "b2"), ("svckey1", "a3"),
+                ]:
+            fnames.append(eq.enqueue(svc_key, e)[0])
+            q.time.sleep(0.01)
+        consume_codes = {"a1": ConsumeEvent.CONSUMED}
+        q.flush(
+            lambda s, i: consume_codes.get(s.decode(), ConsumeEvent.BAD_ENTRY),
+            lambda: False
+            )
+        self.assertEqual(len(q._queued_files("err")), 4)
+
+        # nothing is old enough to pack yet.
+        self.assertEqual(q.pack(), 0)
+        q.time.sleep(60)
+        f_new, _ = eq.enqueue("svckey1", "a4")
+        q._unsafe_change_event_type(f_new, "pdq", "err")
+        self.assertEqual(q.pack(), 5)
+        self.assertEqual(q._queued_files("suc"), [])
+        self.assertEqual(q._queued_files("err"), [f_new])
+        # 1 pack of succeeded events, 2 packs of failed events.
+        self.assertEqual(
+            len([f for f in q._queued_files("pack") if f.endswith(".pack")]),
+            3
+            )
+
+        # packed events are still shown and counted.
+        self.assertEqual(q.read_event(fnames[0]), ("suc", b"a1"))
+        self.assertEqual(q.read_event(fnames[3]), ("err", b"b2"))
+        self.assertEqual(q.read_event(f_new), ("err", b"a4"))
+        self.assertEqual(q.read_event("1_nosuchkey.txt"), None)
+        self.assertEqual(
+            q.list_events("svckey1"),
+            [
+                (fnames[0], "suc", True),
+                (fnames[2], "err", True),
+                (fnames[4], "err", True),
+                (f_new, "err", False),
+            ])
+        stats = q.get_stats(detailed_snapshot=True)
+        self.assertEqual(stats["snapshot"]["succeeded_events"]["count"], 1)
+        self.assertEqual(stats["snapshot"]["failed_events"]["count"], 5)
+
+        # failed events are retried from packs, keeping their place in queue.
+        self.assertEqual(q.resurrect("svckey1"), 3)
+        self.assertEqual(q._queued_files(), [fnames[2], fnames[4], f_new])
+        self.assertEqual(read_file(q._abspath("pdq", fnames[2])), "a2")
+        self.assertEqual(
+            [e for e in q.list_events() if e[2]],
+            [(fnames[0], "suc", True), (fnames[1], "err", True),
+             (fnames[3], "err", True)]
+            )
+
+        # packs are cleaned up as a whole, once their newest event expires.
+        q.cleanup(30)
+        self.assertEqual(q._queued_files("pack"), [])
+        self.assertEqual(len(q._queued_files()), 3)
+
+    def test_pack_large_events(self):
+        eq, q = self.new_queue(pack_after_secs=50)
+        # events are copied into packs in chunks smaller than these.
+        big = ["a" * 100000, "b" * 150000]
+        fnames = []
+        for e in big:
+            f, _ = eq.enqueue("svckey1", e)
+            q._unsafe_change_event_type(f, "pdq", "err")
+            fnames.append(f)
+            q.time.sleep(0.01)
+        q.time.sleep(60)
+        self.assertEqual(q.pack(), 2)
+        self.assertEqual(q.read_event(fnames[1]), ("err", big[1].encode()))
+
+        # a pack is not written if its events are gone.
+        self.assertEqual(q._pack_files("err", ["1_nosuchkey.txt"]), 0)
+        self.assertEqual(len(q._queued_files("pack")), 2)
+
+        self.assertEqual(q.resurrect("svckey1"), 2)
+        self.assertEqual(q._queued_files(), fnames)
+        self.assertEqual(read_file(q._abspath("pdq", fnames[0])), big[0])
+        self.assertEqual(q._queued_files("pack"), [])
 
     def _assertBackoffData(self, q, data):
         backup_data = q.backoff_info._db.get()
@@ -31,7 +31,8 @@ import logging
 import time
 import unittest
 
-from pdagent.pdthread import RepeatingTask, RepeatingTaskThread
+from pdagent.pdthread import RepeatingTask, RepeatingTaskScheduler, \
+    RepeatingTaskThread
 
 
 logging.basicConfig(level=logging.CRITICAL)
@@ -46,6 +47,16 @@ def _start_repeating_thread(f, interval_secs, is_absolute):
     return t
 
 
+def _make_task(name, f, interval_secs, is_absolute):
+    class T(RepeatingTask):
+        def tick(self):
+            f()
+
+        def get_name(self):
+            return name
+    return T(interval_secs, is_absolute)
+
+
 class RepeatingTaskThreadTest(unittest.TestCase):
 
     def test_basic(self):
@@ -74,12 +85,57 @@ class RepeatingTaskThreadTest(unittest.TestCase):
             time.sleep(0.1)
             t.stop_async()
             time.sleep(0.1)
-            self.assertTrue(t.is_alive())
-            time.sleep(1.0)
             self.assertFalse(t.is_alive())
         finally:
             t.stop_and_join()
 
+    def test_wake(self):
+        trace = []
+
+        def f():
+            trace.append(42)
+        t = _start_repeating_thread(f, 5, False)
+        try:
+            time.sleep(0.1)
+            self.assertEqual(trace, [42])
+            t.wake()
+            time.sleep(0.1)
+            self.assertEqual(trace, [42, 42])
+        finally:
+            t.stop_and_join()
+
+    def test_wake_keeps_alignment(self):
+        trace = []
+
+        def f():
+            trace.append(time.time())
+        t = _start_repeating_thread(f, 1, True)
+        try:
+            time.sleep(0.5)
+            t.wake()
+            time.sleep(0.6)
+            # the extra run does not move the next one.
+            self.assertEqual(len(trace), 3)
+            self.assertAlmostEqual(trace[2] - trace[0], 1.0, delta=0.05)
+        finally:
+            t.stop_and_join()
+
+    def test_reschedule(self):
+        trace = []
+
+        def f():
+            trace.append(42)
+        t = _start_repeating_thread(f, 5, False)
+        try:
+            time.sleep(0.1)
+            self.assertEqual(trace, [42])
+            t._rtask.set_interval_secs(1)
+            t.reschedule()
+            time.sleep(1.0)
+            self.assertEqual(trace, [42, 42])
+        finally:
+            t.stop_and_join()
+
     def test_strict(self):
         trace = []
 
@@ -185,5 +241,178 @@ class RepeatingTaskThreadTest(unittest.TestCase):
         finally:
             t.stop_and_join()
 
+    def test_strict_keeps_alignment(self):
+        def f():
+            trace.append(time.time())
+            if len(trace) == 1:
+                time.sleep(1.5)
+        trace = []
+        t = _start_repeating_thread(f, 1, True)
+        try:
+            time.sleep(3.1)
+            # the overdue run happens right away, and later runs are still
+            # aligned to the first one.
+            self.assertEqual(len(trace), 4)
+            self.assertAlmostEqual(trace[1] - trace[0], 1.5, delta=0.05)
+            self.assertAlmostEqual(trace[2] - trace[0], 2.0, delta=0.05)
+            self.assertAlmostEqual(trace[3] - trace[0], 3.0, delta=0.05)
+        finally:
+            t.stop_and_join()
+
+
+class RepeatingTaskSchedulerTest(unittest.TestCase):
+
+    def test_basic(self):
+        trace = []
+        s = RepeatingTaskScheduler(2)
+        s.add_task(_make_task("a", lambda: trace.append("a"), 1, False))
+        s.add_task(_make_task("b", lambda: trace.append("b"), 1, True))
+        s.start()
+        try:
+            time.sleep(0.1)
+            # both tasks are run immediately on startup...
+            self.assertEqual(sorted(trace), ["a", "b"])
+            time.sleep(1.0)
+            # ...and then every interval.
+            self.assertEqual(sorted(trace), ["a", "a", "b", "b"])
+        finally:
+            s.stop_and_join()
+        time.sleep(1.0)
+        self.assertEqual(len(trace), 4)
+        stats = s.get_stats()
+        self.assertEqual(stats["a"]["ticks_count"], 2)
+        self.assertEqual(stats["b"]["overrun_policy"], "coalesce")
+
+    def test_sub_second_interval(self):
+        trace = []
+        s = RepeatingTaskScheduler(1)
+        s.add_task(_make_task("a", lambda: trace.append("a"), 0.2, False))
+        s.start()
+        try:
+            time.sleep(0.5)
+            # on startup, and then at 0.2 and 0.4 secs.
+            self.assertEqual(trace, ["a", "a", "a"])
+        finally:
+            s.stop_and_join()
+
+    def test_bounded_workers(self):
+        trace = []
+
+        def slow():
+            trace.append("slow")
+            time.sleep(0.5)
+        s = RepeatingTaskScheduler(1)
+        s.add_task(_make_task("slow", slow, 5, False))
+        s.add_task(_make_task("quick", lambda: trace.append("quick"), 5, False))
+        s.start()
+        try:
+            time.sleep(0.1)
+            # the only worker is busy with the slow task.
+            self.assertEqual(trace, ["slow"])
+            time.sleep(0.5)
+            self.assertEqual(trace, ["slow", "quick"])
+            stats = s.get_stats()
+            self.assertAlmostEqual(
+                stats["slow"]["last_tick_secs"], 0.5, delta=0.05
+                )
+            self.assertAlmostEqual(
+                stats["quick"]["max_lateness_secs"], 0.5, delta=0.1
+                )
+        finally:
+            s.stop_and_join()
+
+    def test_overrun_policies(self):
+        traces = {"skip": [], "coalesce": [], "queue": []}
+
+        def make_tick(policy):
+            def f():
+                traces[policy].append(42)
+                if len(traces[policy]) == 1:
+                    time.sleep(2.5)
+            return f
+        s = RepeatingTaskScheduler(3)
+        for policy in traces:
+            s.add_task(_make_task(policy, make_tick(policy), 1, True), policy)
+        s.start()
+        try:
+            time.sleep(2.7)
+            # the runs due at 1 and 2 seconds are dropped, made once, or
+            # both made.
+            self.assertEqual(len(traces["skip"]), 1)
+            self.assertEqual(len(traces["coalesce"]), 2)
+            self.assertEqual(len(traces["queue"]), 3)
+            stats = s.get_stats()
+            self.assertEqual(stats["skip"]["skipped_ticks_count"], 2)
+            self.assertEqual(stats["coalesce"]["skipped_ticks_count"], 1)
+            self.assertEqual(stats["queue"]["skipped_ticks_count"], 0)
+            time.sleep(0.4)
+            # all of them are back on schedule.
+            for policy in traces:
+                self.assertEqual(
+                    stats[policy]["ticks_count"] + 1,
+                    s.get_stats()[policy]["ticks_count"]
+                    )
+        finally:
+            s.stop_and_join()
+        self.assertRaises(ValueError, s.add_task, _make_task(
+            "bad", lambda: None, 1, True
+            ), "bad")
+
+    def test_wake_and_stop(self):
+        trace = []
+        task = _make_task("a", lambda: trace.append(42), 5, False)
+        s = RepeatingTaskScheduler(1)
+        s.add_task(task)
+        s.start()
+        try:
+            time.sleep(0.1)
+            self.assertEqual(trace, [42])
+            s.wake(task)
+            time.sleep(0.1)
+            self.assertEqual(trace, [42, 42])
+            task.set_interval_secs(1)
+            s.reschedule(task)
+            time.sleep(1.0)
+            self.assertEqual(trace, [42, 42, 42])
+            s.stop_async()
+            time.sleep(0.1)
+            self.assertFalse(s.is_alive())
+            self.assertTrue(task.is_stop_invoked())
+        finally:
+            s.stop_and_join()
+
+    def test_tick_exception(self):
+        def f():
+            trace.append(time.time())
+            if len(trace) <= 3:
+                raise Exception("foo")
+        trace = []
+        exits = []
+        s = RepeatingTaskScheduler(
+            1, restart_backoff_secs=0.2,
+            exit_callback=lambda: exits.append(42)
+            )
+        s.add_task(_make_task("a", f, 1, False))
+        s.add_task(_make_task("b", lambda: None, 1, False))
+        s.start()
+        try:
+            time.sleep(1.5)
+            # the failing task is run again with a doubling back-off, and
+            # then on schedule once it works; other tasks are not affected.
+            self.assertEqual(len(trace), 4)
+            for i, delay in enumerate([0.2, 0.4, 0.8]):
+                self.assertAlmostEqual(
+                    trace[i + 1] - trace[i], delay, delta=0.05
+                    )
+            stats = s.get_stats()
+            self.assertEqual(stats["a"]["restarts_count"], 3)
+            self.assertEqual(stats["b"]["ticks_count"], 2)
+            self.assertTrue(s.is_alive())
+            self.assertEqual(exits, [])
+            self.assertFalse(s.is_stop_invoked())
+        finally:
+            s.stop_and_join()
+        self.assertEqual(exits, [42])
+
 if __name__ == "__main__":
     unittest.main()
@@ -45,8 +45,6 @@ logging.basicConfig(level=logging.CRITICAL)
 
 FREQUENCY_SEC = 30
 SEND_TIMEOUT_SEC = 1
-CLEANUP_FREQUENCY_SEC = 60
-CLEANUP_AGE_SEC = 120
 INCIDENT_KEY = "123"
 DEFAULT_RESPONSE_DATA = json.dumps({
     "status": "success",
@@ -70,35 +68,172 @@ class SendEventTest(unittest.TestCase):
         s = SendEventTask(
             self.mock_queue(),
             FREQUENCY_SEC,
-            CLEANUP_FREQUENCY_SEC,
-            CLEANUP_AGE_SEC,
             source_address
         )
         s._http = MockUrlLib()
         return s
 
     def mock_queue(self):
-        return MockQueue(
-            event=SAMPLE_EVENT,
-            cleanup_age_secs=CLEANUP_AGE_SEC
-            )
+        return MockQueue(event=SAMPLE_EVENT)
 
     def mock_response(self, code=200, data=DEFAULT_RESPONSE_DATA):
         return MockResponse(code, data)
 
-    def test_source_address_send_and_cleanup(self):
+    def test_source_address_send(self):
         s = self.new_send_event_task('127.0.0.1')
         s._http.response = self.mock_response()
         s.tick()
         self.assertEqual(s.pd_queue.consume_code, ConsumeEvent.CONSUMED)
-        self.assertTrue(s.pd_queue.cleaned_up)
 
-    def test_send_and_cleanup(self):
+    def test_send(self):
         s = self.new_send_event_task()
         s._http.response = self.mock_response()
         s.tick()
         self.assertEqual(s.pd_queue.consume_code, ConsumeEvent.CONSUMED)
-        self.assertTrue(s.pd_queue.cleaned_up)
+        # cleanup is left to CleanupTask.
+        self.assertFalse(s.pd_queue.cleaned_up)
+
+    def test_send_bytes_event(self):
+        s = self.new_send_event_task()
+        s.pd_queue.event = SAMPLE_EVENT.encode()
+        s._http.response = self.mock_response()
+        s.tick()
+        self.assertEqual(s.pd_queue.consume_code, ConsumeEvent.CONSUMED)
+        # the queued bytes are passed to the connection as they are.
+        self.assertIs(s._http.request.data, s.pd_queue.event)
+
+    def test_compression_stats(self):
+        s = SendEventTask(
+            self.mock_queue(), FREQUENCY_SEC,
+            compressor=http.RequestCompressor(min_bytes=1)
+            )
+        s._http = MockUrlLib()
+        s._http.response = self.mock_response()
+        s.tick()
+        # totals are recorded for the local stats.
+        self.assertEqual(
+            s.pd_queue.compression_stats["compressed_requests_count"], 1
+            )
+        # ...only when they change.
+        s.pd_queue.compression_stats = None
+        s.pd_queue.flush = lambda *args: None
+        s.tick()
+        self.assertEqual(s.pd_queue.compression_stats, None)
+
+    def test_fixed_interval(self):
+        s = self.new_send_event_task()
+        s._http.response = self.mock_response()
+        s.pd_queue.flush_stats = {"events_count": 1}
+        s.tick()
+        self.assertEqual(s.get_interval_secs(), FREQUENCY_SEC)
+        s.pd_queue.flush_stats = None
+        s.tick()
+        self.assertEqual(s.get_interval_secs(), FREQUENCY_SEC)
+
+    def test_adaptive_interval(self):
+        s = SendEventTask(
+            self.mock_queue(), FREQUENCY_SEC, min_interval_secs=0.5,
+            max_interval_secs=100
+            )
+        s._http = MockUrlLib()
+        s._http.response = self.mock_response()
+        self.assertEqual(s.get_interval_secs(), FREQUENCY_SEC)
+
+        # events were sent; check again soon.
+        s.pd_queue.flush_stats = {"events_count": 1, "limit_reached": False}
+        s.tick()
+        self.assertEqual(s.get_interval_secs(), 0.5)
+
+        # idle; back off up to the max interval.
+        s.pd_queue.flush_stats = {"events_count": 0, "limit_reached": False}
+        intervals = []
+        for _ in range(10):
+            s.tick()
+            intervals.append(s.get_interval_secs())
+        self.assertEqual(
+            intervals, [1, 2, 4, 8, 16, 32, 64, 100, 100, 100]
+            )
+
+        # more events than a pass could send.
+        s.pd_queue.flush_stats = {"events_count": 0, "limit_reached": True}
+        s.tick()
+        self.assertEqual(s.get_interval_secs(), 0.5)
+
+        # a service key is backing off, even with more events.
+        s.pd_queue.flush_stats = {
+            "events_count": 5, "limit_reached": True, "throttled": True
+            }
+        s.tick()
+        self.assertEqual(s.get_interval_secs(), FREQUENCY_SEC)
+
+        # errors are treated like back-offs, and an empty queue as idle.
+        s.pd_queue.flush = self._raise(Exception)
+        s.tick()
+        self.assertEqual(s.get_interval_secs(), FREQUENCY_SEC)
+        from pdagent.pdqueue import EmptyQueueError
+        s.pd_queue.flush = self._raise(EmptyQueueError)
+        s.tick()
+        self.assertEqual(s.get_interval_secs(), FREQUENCY_SEC * 2)
+
+    def test_adaptive_interval_default_max(self):
+        # with the default max interval (the send interval), an event queued
+        # after a long idle period is still sent within the send interval.
+        s = SendEventTask(
+            self.mock_queue(), FREQUENCY_SEC, min_interval_secs=0.5
+            )
+        s._http = MockUrlLib()
+        s._http.response = self.mock_response()
+        s.pd_queue.flush_stats = {"events_count": 0, "limit_reached": False}
+        for _ in range(20):
+            s.tick()
+            self.assertTrue(s.get_interval_secs() <= FREQUENCY_SEC)
+        self.assertEqual(s.get_interval_secs(), FREQUENCY_SEC)
+
+    def test_dedup_index_pruning_interval(self):
+        class MockTime:
+            now = 1000.0
+
+            def time(self):
+                return self.now
+
+        s = SendEventTask(
+            self.mock_queue(), FREQUENCY_SEC, min_interval_secs=0.5
+            )
+        s._http = MockUrlLib()
+        s._http.response = self.mock_response()
+        s._time = MockTime()
+        s.tick()
+        # frequent flushes don't prune the index every time...
+        for _ in range(5):
+            s._time.now += 0.5
+            s.tick()
+        self.assertEqual(s.pd_queue.prune_count, 1)
+        # ...but once every send interval.
+        s._time.now += FREQUENCY_SEC
+        s.tick()
+        self.assertEqual(s.pd_queue.prune_count, 2)
+
+    def test_reconfigure(self):
+        s = self.new_send_event_task()
+        s._http.response = self.mock_response()
+        s.reconfigure(5, '127.0.0.1', min_interval_secs=1, max_interval_secs=20)
+        # nothing changes until the next tick.
+        self.assertEqual(s.get_interval_secs(), FREQUENCY_SEC)
+        self.assertEqual(s._source_address, '0.0.0.0')
+        s.tick()
+        self.assertEqual(
+            s._http.urlopen_kwargs["source_address"], '127.0.0.1'
+            )
+        # idle; back off from the new interval up to the new max.
+        self.assertEqual(s.get_interval_secs(), 10)
+        s.tick()
+        s.tick()
+        self.assertEqual(s.get_interval_secs(), 20)
+
+    def _raise(self, exception_class):
+        def f(*args, **kwargs):
+            raise exception_class
+        return f
 
     # --------------------------------------------------------------------------
     # test behaviour for queue-related errors
@@ -112,9 +247,8 @@ class SendEventTest(unittest.TestCase):
         s = self.new_send_event_task()
         s.pd_queue.flush = empty_queue_flush
         s.tick()
+        # empty-queue handled.
         self.assertTrue(s.pd_queue.consume_code is None)
-        # empty-queue handled, and cleanup is still invoked.
-        self.assertTrue(s.pd_queue.cleaned_up)
 
     def test_queue_errors(self):
         def erroneous_queue_flush(*args, **kwargs):
@@ -123,33 +257,19 @@ class SendEventTest(unittest.TestCase):
         s = self.new_send_event_task()
         s.pd_queue.flush = erroneous_queue_flush
         s.tick()
+        # queue error handled.
         self.assertTrue(s.pd_queue.consume_code is None)
-        # queue error handled; cleanup is still invoked.
-        self.assertTrue(s.pd_queue.cleaned_up)
 
-    def test_no_cleanup(self):
-        import time
-
-        s = self.new_send_event_task()
-        s._http.response = self.mock_response()
-        s.last_cleanup_time = int(time.time()) - 1
-        s.tick()
-        # queue is flushed normally...
-        self.assertEqual(s.pd_queue.consume_code, ConsumeEvent.CONSUMED)
-        # ... and cleanup is not invoked because it is not time for it.
-        self.assertFalse(s.pd_queue.cleaned_up)
-
-    def test_cleanup_errors(self):
-        def erroneous_cleanup(*args, **kwargs):
+    def test_dedup_index_errors(self):
+        def erroneous_prune(*args, **kwargs):
             raise Exception
 
         s = self.new_send_event_task()
         s._http.response = self.mock_response()
-        s.pd_queue.cleanup = erroneous_cleanup
+        s.pd_queue.prune_dedup_index = erroneous_prune
         s.tick()
-        # queue is flushed normally...
+        # queue is flushed normally, and pruning errors have been handled.
         self.assertEqual(s.pd_queue.consume_code, ConsumeEvent.CONSUMED)
-        # ... and cleanup errors have been handled.
 
     # --------------------------------------------------------------------------
     # test behaviour for events-API endpoint-related errors.
@@ -169,8 +289,6 @@ class SendEventTest(unittest.TestCase):
             s.pd_queue.consume_code,
             ConsumeEvent.BACKOFF_SVCKEY_NOT_CONSUMED
             )
-        # error handled; cleanup is still invoked.
-        self.assertTrue(s.pd_queue.cleaned_up)
 
     def test_certificate_error(self):
         self._verifyConsumeCodeForError(CertificateError(), ConsumeEvent.STOP_ALL)
@@ -214,6 +332,18 @@ class SendEventTest(unittest.TestCase):
         self._verifyConsumeCodeForHTTPError(400, ConsumeEvent.BAD_ENTRY)
         self._verifyConsumeCodeForHTTPError(499, ConsumeEvent.BAD_ENTRY)
 
+    def test_rejected_service_key(self):
+        s = self.new_send_event_task()
+        s._http.response = self.mock_response(code=400, data=json.dumps({
+            "status": "invalid event",
+            "message": "Event object is invalid",
+            "errors": [
+                "Service key is the wrong length (should be 32 characters)"
+                ]
+            }).encode())
+        s.tick()
+        self.assertEqual(s.pd_queue.consume_code, ConsumeEvent.BAD_SVCKEY)
+
     def test_5xx(self):
         self._verifyConsumeCodeForHTTPError(
             500,
@@ -230,7 +360,6 @@ class SendEventTest(unittest.TestCase):
         s._http.response = self.mock_response(data="bad")
         s.tick()
         self.assertEqual(s.pd_queue.consume_code, ConsumeEvent.CONSUMED)
-        self.assertTrue(s.pd_queue.cleaned_up)
 
     def _verifyConsumeCodeForError(self, exception, expected_code):
         def error(*args, **kwargs):
@@ -240,16 +369,12 @@ class SendEventTest(unittest.TestCase):
         s._http.urlopen = error
         s.tick()
         self.assertEqual(s.pd_queue.consume_code, expected_code)
-        # error handled; cleanup is still invoked.
-        self.assertTrue(s.pd_queue.cleaned_up)
 
     def _verifyConsumeCodeForHTTPError(self, error_code, expected_code):
         s = self.new_send_event_task()
         s._http.response = self.mock_response(code=error_code)
         s.tick()
         self.assertEqual(s.pd_queue.consume_code, expected_code)
-        # error handled; cleanup is still invoked.
-        self.assertTrue(s.pd_queue.cleaned_up)
 
 if __name__ == '__main__':
     unittest.main()